@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+    Compares two result files written by run.py --output.
+
+    Prints the change of throughput and p99 latency of every benchmark
+    found in both files and exits with status 1 if throughput dropped,
+    or p99 latency grew, by more than --threshold percent.
+
+        python benchmarks/compare.py before.json after.json
+"""
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import sys
+import json
+import argparse
+
+KEY = ('operation', 'value_size', 'keys', 'threads')
+
+
+def load(path):
+    with open(path) as report:
+        report = json.load(report)
+    return report, dict((tuple(result[k] for k in KEY), result)
+                        for result in report['results'])
+
+
+def change(before, after):
+    """
+        Returns the relative change from before to after in percent
+    """
+    if not before or after is None:
+        return None
+    return (after - before) * 100.0 / before
+
+
+def _format(percent):
+    if percent is None:
+        return '-'
+    return '%+.1f%%' % percent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='regression in percent, default %(default)s')
+    args = parser.parse_args()
+
+    before_report, before = load(args.before)
+    after_report, after = load(args.after)
+    # reports written before --instance-per-thread shared one instance
+    defaults = {'instance_per_thread': False}
+    for name in ('latency', 'jitter', 'throttle', 'options', 'instance_per_thread'):
+        old, new = before_report.get(name, defaults.get(name)), after_report.get(name, defaults.get(name))
+        if old != new:
+            print('warning: %s differs, %r != %r' % (name, old, new), file=sys.stderr)
+
+    print('%s -> %s' % (before_report.get('commit'), after_report.get('commit')))
+    print('%-9s %8s %6s %7s %10s %10s %9s %9s' %
+          ('operation', 'size', 'keys', 'threads', 'ops/s', 'change', 'p99 ms', 'change'))
+
+    regressions = 0
+    for key in sorted(set(before) & set(after)):
+        old, new = before[key], after[key]
+        throughput = change(old['ops_per_sec'], new['ops_per_sec'])
+        latency = change(old['p99'], new['p99'])
+        regressed = (throughput is not None and throughput < -args.threshold) or \
+                    (latency is not None and latency > args.threshold)
+        regressions += regressed
+        print('%-9s %8d %6d %7d %10.1f %10s %9.2f %9s%s' %
+              (key + (new['ops_per_sec'] or 0, _format(throughput),
+                      (new['p99'] or 0) * 1000, _format(latency),
+                      '  REGRESSION' if regressed else '')))
+
+    missing = set(before) ^ set(after)
+    if missing:
+        print('%d benchmarks are only in one of the files' % len(missing), file=sys.stderr)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
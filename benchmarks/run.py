@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+"""
+    Benchmarks AmazonS3Cache against the S3 stand-in from s3server.py.
+
+    Every operation is measured for every combination of value size, key
+    count and thread count. The results are printed as a table and, with
+    --output, written as JSON which compare.py reads. Extra cache OPTIONS
+    are given as --option NAME=VALUE, e.g. --option SHARDS=16. With
+    --instance-per-thread every thread builds its own cache instance the
+    way django.core.cache.caches does, otherwise they share one.
+
+        PYTHONPATH=. python benchmarks/run.py --output before.json
+"""
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import os
+import ast
+import sys
+import json
+import time
+import platform
+import argparse
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from django.conf import settings
+if not settings.configured:
+    # same as the DEFAULT_ACL of the cache, silences a django-storages warning
+    settings.configure(AWS_DEFAULT_ACL='private')
+
+from boto.s3.connection import OrdinaryCallingFormat
+
+from s3cache import AmazonS3Cache
+from s3server import S3Server
+
+OPERATIONS = ('set', 'get', 'get_miss', 'has_key', 'add', 'touch', 'incr', 'cull', 'clear')
+FORMAT_VERSION = 1
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def _option(value):
+    name, _sep, value = value.partition('=')
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return name, value
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def summarize(latencies, wall_time, errors):
+    latencies = sorted(latencies)
+    calls = len(latencies)
+    return {
+        'calls': calls,
+        'errors': errors,
+        'wall_time': wall_time,
+        'ops_per_sec': calls / wall_time if wall_time else None,
+        'mean': sum(latencies) / calls if calls else None,
+        'p50': percentile(latencies, 0.5),
+        'p90': percentile(latencies, 0.9),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else None,
+    }
+
+
+def run_threads(make_func, keys, threads):
+    """
+        Calls func(key) for every key from threads threads, the keys are
+        split evenly between them. Every thread gets its func from
+        make_func() before the clock starts. Returns the summary of the
+        calls.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(chunk):
+        measured = []
+        failed = 0
+        func = make_func()
+        barrier.wait()
+        for key in chunk:
+            started = time.perf_counter()
+            try:
+                func(key)
+            except Exception:  # pylint: disable=broad-except
+                failed += 1
+            measured.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(measured)
+            errors[0] += failed
+
+    workers = [threading.Thread(target=worker, args=(keys[i::threads],))
+               for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    return summarize(latencies, time.perf_counter() - started, errors[0])
+
+
+def run_once(func):
+    started = time.perf_counter()
+    errors = 0
+    try:
+        func()
+    except Exception:  # pylint: disable=broad-except
+        errors = 1
+    duration = time.perf_counter() - started
+    return summarize([duration], duration, errors)
+
+
+class Benchmark(object):
+    def __init__(self, server, options, instance_per_thread=False):
+        self.server = server
+        self.options = options
+        self.instance_per_thread = instance_per_thread
+
+    def cache(self, **options):
+        params = dict(self.options)
+        params.update(options)
+        params.update({
+            'ACCESS_KEY': 'benchmark',
+            'SECRET_KEY': 'benchmark',
+            'BUCKET_NAME': 'benchmark',
+            'host': '127.0.0.1',
+            'port': self.server.port,
+            'use_ssl': False,
+            'calling_format': OrdinaryCallingFormat(),
+        })
+        return AmazonS3Cache(None, {'OPTIONS': params})
+
+    def fill(self, cache, keys, value):
+        cache.set_many(dict((key, value) for key in keys))
+        flush = getattr(cache, 'flush', None)
+        if flush is not None:
+            flush()
+
+    def measure(self, operation, size, count, threads):
+        """
+            Returns the summary of operation and the S3 requests it sent,
+            without those which prepared the bucket for it.
+        """
+        value = os.urandom(size)
+        keys = ['key-%d' % i for i in range(count)]
+        cache = self.cache(MAX_ENTRIES=0)
+        cache.clear()
+
+        if operation == 'incr':
+            # every thread increments the same counters, value_size is not used
+            self.fill(cache, keys[:max(count // 100, 1)], 0)
+        elif operation not in ('set', 'add', 'get_miss'):
+            self.fill(cache, keys, value)
+        if operation == 'cull':
+            # culls every CULL_FREQUENCY-th key, the default is every third
+            cache = self.cache(MAX_ENTRIES=max(count // 2, 1))
+
+        def _func(instance):
+            if operation == 'set':
+                return lambda key: instance.set(key, value)
+            if operation == 'add':
+                return lambda key: instance.add(key, value)
+            if operation in ('get', 'get_miss'):
+                return instance.get
+            if operation == 'has_key':
+                return instance.has_key
+            if operation == 'touch':
+                return instance.touch
+            counters = max(count // 100, 1)
+            return lambda key: instance.incr('key-%d' % (int(key[4:]) % counters))
+
+        def _make_func():
+            if self.instance_per_thread:
+                # same as django.core.cache.caches in a request thread
+                return _func(self.cache(MAX_ENTRIES=0))
+            return _func(cache)
+
+        self.requests()
+        if operation in ('set', 'add', 'get', 'get_miss', 'has_key', 'touch', 'incr'):
+            result = run_threads(_make_func, keys, threads)
+        elif operation == 'clear':
+            result = run_once(cache.clear)
+        elif operation == 'cull':
+            result = run_once(cache._cull)  # pylint: disable=protected-access
+        else:
+            raise ValueError('Unknown operation %s' % operation)
+
+        flush = getattr(cache, 'flush', None)
+        if flush is not None:
+            # write-behind uploads belong to the measured operation
+            flush()
+        result['requests'] = self.requests()
+        return result
+
+    def requests(self):
+        with self.server._lock:  # pylint: disable=protected-access
+            requests = dict(self.server.requests)
+            self.server.requests.clear()
+        return requests
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _format(seconds):
+    if seconds is None:
+        return '-'
+    return '%.2f' % (seconds * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--operations', default=','.join(OPERATIONS),
+                        help='comma separated, default %(default)s')
+    parser.add_argument('--sizes', type=_int_list, default=[128, 16384, 262144],
+                        help='value sizes in bytes, default 128,16384,262144')
+    parser.add_argument('--keys', type=_int_list, default=[100, 1000],
+                        help='key counts, default 100,1000')
+    parser.add_argument('--threads', type=_int_list, default=[1, 8],
+                        help='thread counts, default 1,8')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='seconds added to every S3 request, default %(default)s')
+    parser.add_argument('--jitter', type=float, default=0.002,
+                        help='maximum random seconds added on top, default %(default)s')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--throttle', type=float, default=0.0,
+                        help='fraction of S3 requests answered with 503 Slow Down')
+    parser.add_argument('--option', type=_option, action='append', default=[],
+                        metavar='NAME=VALUE', help='cache OPTIONS entry, may be repeated')
+    parser.add_argument('--instance-per-thread', action='store_true',
+                        help='build a cache instance in every thread like Django does '
+                             'instead of sharing one')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    operations = [op for op in args.operations.split(',') if op]
+    unknown = set(operations) - set(OPERATIONS)
+    if unknown:
+        parser.error('unknown operations: %s' % ', '.join(sorted(unknown)))
+
+    server = S3Server(latency=args.latency, jitter=args.jitter, seed=args.seed,
+                      throttle=args.throttle)
+    server.start()
+    benchmark = Benchmark(server, dict(args.option), args.instance_per_thread)
+
+    results = []
+    print('%-9s %8s %6s %7s %6s %10s %9s %9s %9s %9s' %
+          ('operation', 'size', 'keys', 'threads', 'errors', 'ops/s',
+           'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    try:
+        for operation in operations:
+            for size in args.sizes:
+                for count in args.keys:
+                    for threads in args.threads:
+                        if operation in ('clear', 'cull') and threads != args.threads[0]:
+                            # single call, the thread count doesn't apply
+                            continue
+                        result = benchmark.measure(operation, size, count, threads)
+                        result.update({
+                            'operation': operation,
+                            'value_size': size,
+                            'keys': count,
+                            'threads': threads,
+                        })
+                        results.append(result)
+                        print('%-9s %8d %6d %7d %6d %10.1f %9s %9s %9s %9s' %
+                              (operation, size, count, threads, result['errors'],
+                               result['ops_per_sec'] or 0, _format(result['p50']),
+                               _format(result['p90']), _format(result['p99']),
+                               _format(result['max'])))
+                        sys.stdout.flush()
+    finally:
+        server.stop()
+
+    if args.output:
+        report = {
+            'version': FORMAT_VERSION,
+            'commit': _git_commit(),
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'latency': args.latency,
+            'jitter': args.jitter,
+            'seed': args.seed,
+            'throttle': args.throttle,
+            'options': dict(args.option),
+            'instance_per_thread': args.instance_per_thread,
+            'results': results,
+        }
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True, default=repr)
+
+
+if __name__ == '__main__':
+    main()
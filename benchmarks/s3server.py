@@ -0,0 +1,341 @@
+"""
+    In-memory stand-in for the subset of the Amazon S3 REST API which
+    the cache backend uses, with injected latency. Used by run.py, see
+    README.rst. Requests are neither authenticated nor persisted.
+
+    Run it stand-alone with:
+
+        python benchmarks/s3server.py --port 9000 --latency 0.02
+"""
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import re
+import time
+import random
+import hashlib
+import argparse
+import threading
+from socketserver import ThreadingMixIn
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from email.utils import formatdate
+from urllib.parse import urlsplit, parse_qs, unquote
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+S3_NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+MAX_KEYS = 1000
+META_PREFIX = 'x-amz-meta-'
+# single ranges only
+RANGE = re.compile(r'bytes=(\d+)-(\d*)$')
+
+
+class S3Object(object):
+    def __init__(self, body, content_type, metadata):
+        self.body = body
+        self.content_type = content_type
+        self.metadata = metadata
+        self.etag = '"%s"' % hashlib.md5(body).hexdigest()
+        self.last_modified = time.time()
+
+
+class S3Server(ThreadingMixIn, HTTPServer):
+    """
+        Keeps the objects of every bucket in memory. Every request is
+        answered after latency seconds plus a random delay of up to
+        jitter seconds, drawn from a generator seeded with seed so runs
+        can be repeated. The throttle fraction of the requests is answered
+        with 503 Slow Down instead.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, jitter=0.0, seed=0, throttle=0.0):
+        HTTPServer.__init__(self, address, S3RequestHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle = throttle
+        self.buckets = {}
+        self.requests = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # makes conditional writes atomic
+        self.write_lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def delay(self, request):
+        """
+            Waits before request is answered, returns True if it
+            should be throttled
+        """
+        with self._lock:
+            self.requests[request] = self.requests.get(request, 0) + 1
+            delay = self.latency
+            if self.jitter:
+                delay += self._random.uniform(0, self.jitter)
+            throttled = bool(self.throttle) and self._random.random() < self.throttle
+        if delay:
+            time.sleep(delay)
+        return throttled
+
+    def bucket(self, name):
+        with self._lock:
+            return self.buckets.setdefault(name, {})
+
+    def start(self):
+        """
+            Serves requests on a daemon thread, returns the thread
+        """
+        thread = threading.Thread(target=self.serve_forever, name='s3server')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class S3RequestHandler(BaseHTTPRequestHandler):
+    """
+        Path style requests only, i.e. boto's OrdinaryCallingFormat.
+    """
+    protocol_version = 'HTTP/1.1'
+    # small responses would otherwise wait for the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def _parse(self):
+        url = urlsplit(self.path)
+        bucket, _sep, key = url.path.lstrip('/').partition('/')
+        query = parse_qs(url.query, keep_blank_values=True)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        return unquote(bucket), unquote(key), query, body
+
+    def _reply(self, status, body=b'', headers=None, head=False):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and not head:
+            self.wfile.write(body)
+
+    def _xml(self, status, xml):
+        body = ('<?xml version="1.0" encoding="UTF-8"?>\n' + xml).encode('utf-8')
+        self._reply(status, body, {'Content-Type': 'application/xml'})
+
+    def _error(self, status, code, key=''):
+        self._xml(status, '<Error><Code>%s</Code><Message>%s</Message><Key>%s</Key></Error>' %
+                  (code, code, escape(key)))
+
+    def _handle(self, method):
+        bucket, key, query, body = self._parse()
+        operation = method if key else method + ' bucket'
+        if 'delete' in query:
+            operation = 'DELETE multiple'
+        if self.server.delay(operation):
+            self._error(503, 'SlowDown', key)
+            return
+
+        objects = self.server.bucket(bucket)
+        handler = getattr(self, '_%s_%s' % (method.lower(), 'object' if key else 'bucket'))
+        handler(objects, key, query, body)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self._handle('GET')
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        self._handle('HEAD')
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        self._handle('PUT')
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self._handle('POST')
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        self._handle('DELETE')
+
+    def _object_headers(self, obj):
+        headers = {
+            'Content-Type': obj.content_type,
+            'ETag': obj.etag,
+            'Last-Modified': formatdate(obj.last_modified, usegmt=True),
+        }
+        for name, value in obj.metadata.items():
+            headers[META_PREFIX + name] = value
+        return headers
+
+    def _get_object(self, objects, key, _query, _body, head=False):
+        obj = objects.get(key)
+        if obj is None:
+            if head:
+                self._reply(404, head=True)
+            else:
+                self._error(404, 'NoSuchKey', key)
+            return
+
+        headers = self._object_headers(obj)
+        if self.headers.get('If-None-Match') == obj.etag:
+            self._reply(304, headers={'ETag': obj.etag}, head=True)
+            return
+
+        match = RANGE.match(self.headers.get('Range', ''))
+        if match is not None and not head:
+            first = int(match.group(1))
+            last = min(int(match.group(2) or len(obj.body) - 1), len(obj.body) - 1)
+            if first > last:
+                self._error(416, 'InvalidRange', key)
+                return
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, len(obj.body))
+            self._reply(206, obj.body[first:last + 1], headers)
+            return
+        self._reply(200, obj.body, headers, head=head)
+
+    def _head_object(self, objects, key, query, body):
+        self._get_object(objects, key, query, body, head=True)
+
+    def _put_object(self, objects, key, _query, body):
+        metadata = dict((name.lower()[len(META_PREFIX):], value)
+                        for (name, value) in self.headers.items()
+                        if name.lower().startswith(META_PREFIX))
+        content_type = self.headers.get('Content-Type', 'application/octet-stream')
+
+        source = self.headers.get('x-amz-copy-source')
+        if source is not None:
+            src_bucket, _sep, src_key = unquote(source).lstrip('/').partition('/')
+            original = self.server.bucket(src_bucket).get(src_key)
+            if original is None:
+                self._error(404, 'NoSuchKey', src_key)
+                return
+            if self.headers.get('x-amz-copy-source-if-match', original.etag) != original.etag:
+                self._error(412, 'PreconditionFailed', src_key)
+                return
+            if self.headers.get('x-amz-metadata-directive', 'COPY').upper() == 'COPY':
+                metadata = dict(original.metadata)
+                content_type = original.content_type
+            obj = S3Object(original.body, content_type, metadata)
+            objects[key] = obj
+            self._xml(200, '<CopyObjectResult><LastModified>%s</LastModified>'
+                           '<ETag>%s</ETag></CopyObjectResult>' %
+                      (_iso8601(obj.last_modified), escape(obj.etag)))
+            return
+
+        obj = S3Object(body, content_type, metadata)
+        with self.server.write_lock:
+            current = objects.get(key)
+            if self.headers.get('If-None-Match') == '*' and current is not None:
+                failed = 412
+            elif 'If-Match' in self.headers and current is None:
+                failed = 404
+            elif 'If-Match' in self.headers and self.headers['If-Match'] != current.etag:
+                failed = 412
+            else:
+                failed = None
+                objects[key] = obj
+
+        if failed == 404:
+            self._error(404, 'NoSuchKey', key)
+        elif failed:
+            self._error(412, 'PreconditionFailed', key)
+        else:
+            self._reply(200, headers={'ETag': obj.etag})
+
+    def _delete_object(self, objects, key, _query, _body):
+        objects.pop(key, None)
+        self._reply(204)
+
+    def _get_bucket(self, objects, _key, query, _body):
+        prefix = query.get('prefix', [''])[0]
+        marker = query.get('marker', [''])[0]
+        max_keys = min(int(query.get('max-keys', [MAX_KEYS])[0]), MAX_KEYS)
+
+        names = sorted(name for name in list(objects)
+                       if name.startswith(prefix) and name > marker)
+        truncated = len(names) > max_keys
+        contents = []
+        for name in names[:max_keys]:
+            obj = objects.get(name)
+            if obj is None:
+                continue
+            contents.append(
+                '<Contents><Key>%s</Key><LastModified>%s</LastModified><ETag>%s</ETag>'
+                '<Size>%d</Size><StorageClass>STANDARD</StorageClass></Contents>' %
+                (escape(name), _iso8601(obj.last_modified), escape(obj.etag), len(obj.body)))
+
+        self._xml(200, '<ListBucketResult xmlns="%s"><Prefix>%s</Prefix><Marker>%s</Marker>'
+                       '<MaxKeys>%d</MaxKeys><IsTruncated>%s</IsTruncated>%s</ListBucketResult>' %
+                  (S3_NS, escape(prefix), escape(marker), max_keys,
+                   'true' if truncated else 'false', ''.join(contents)))
+
+    def _head_bucket(self, _objects, _key, _query, _body):
+        self._reply(200, head=True)
+
+    def _put_bucket(self, _objects, _key, _query, _body):
+        self._reply(200)
+
+    def _post_bucket(self, objects, _key, query, body):
+        if 'delete' not in query:
+            self._error(501, 'NotImplemented')
+            return
+
+        root = ElementTree.fromstring(body)
+        quiet = False
+        deleted = []
+        for element in root.iter():
+            tag = element.tag.rpartition('}')[2]
+            if tag == 'Quiet':
+                quiet = element.text.strip().lower() == 'true'
+            elif tag == 'Key':
+                objects.pop(element.text, None)
+                deleted.append(element.text)
+
+        results = '' if quiet else ''.join('<Deleted><Key>%s</Key></Deleted>' % escape(name)
+                                           for name in deleted)
+        self._xml(200, '<DeleteResult xmlns="%s">%s</DeleteResult>' % (S3_NS, results))
+
+    def _post_object(self, _objects, _key, _query, _body):
+        # multipart uploads are not supported
+        self._error(501, 'NotImplemented')
+
+    def _delete_bucket(self, objects, _key, _query, _body):
+        objects.clear()
+        self._reply(204)
+
+
+def _iso8601(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(timestamp))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='maximum random seconds added on top of latency')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--throttle', type=float, default=0.0,
+                        help='fraction of requests answered with 503 Slow Down')
+    args = parser.parse_args()
+
+    server = S3Server((args.host, args.port), args.latency, args.jitter, args.seed, args.throttle)
+    print('Serving S3 on http://%s:%d' % (args.host, server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
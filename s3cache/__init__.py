@@ -5,18 +5,76 @@
 # Taken directly from django.core.cache.backends.filebased.FileBasedCache
 # and adapted for S3.
 
+import io
+import os
+import math
 import time
+import random
 import hashlib
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, \
+    FIRST_COMPLETED, wait
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
-from storages.backends import s3boto
+from django.core.exceptions import ImproperlyConfigured
 from django.core.files.base import ContentFile
 from django.core.cache.backends.base import BaseCache
 
+from s3cache.aio import AsyncCacheMixin, _metadata_expiry, _metadata_float, _split_body
+from s3cache.bloom import KeyFilter
+from s3cache.buckets import HashRing, LatencyAverage, EXPLORE_RATE
+from s3cache.counters import CounterBuffer
+from s3cache.cull import CullSchedule
+from s3cache.disk import DiskCache
+from s3cache.locks import SingleFlight
+from s3cache.memory import LocalCache
+from s3cache.retry import LatencyWindow, RateLimiter, RetryBudget, RetryPolicy, shared
+from s3cache.segments import SegmentStore, DELETED, SEGMENT_DIR, UNPACKED
+from s3cache.serializers import Codec
+from s3cache.stats import CacheStats
+from s3cache.storage import CacheContentFile, KeyReader, S3CacheStorage, \
+    DELETE_CHUNK_SIZE, DELTA_METADATA, EXPIRY_METADATA, FRESH_METADATA, MIN_PART_SIZE
+from s3cache.writebehind import WriteBehindQueue, DELETE, SET
+
+# name of the object which holds the current generation when GENERATIONS is on
+GENERATION_FILE = 'generation'
+
+# suffix of the lease objects created by get_or_set() when LEASE_TIMEOUT is set
+LEASE_SUFFIX = '.lock'
+
+# how many times touch() looks the object up again when it changes
+# between the HEAD request and the copy
+TOUCH_ATTEMPTS = 3
+
+# how many times incr() retries its conditional PUT when another process
+# changes the value first, with a random delay of up to INCR_BACKOFF seconds
+# doubled after every attempt
+INCR_ATTEMPTS = 10
+INCR_BACKOFF = 0.01
+
+# first calls of hedged reads run on a pool which grows with the reads in
+# flight, the limit is only there because ThreadPoolExecutor needs one
+READ_WORKERS = 1000
+
+_MISSING = object()
+
+# caches of the process, see _after_fork()
+_instances = weakref.WeakSet()
+
+
+def _after_fork():
+    for cache in list(_instances):
+        cache._after_fork()  # pylint: disable=protected-access
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
 def _key_to_file(key):
     """
         All files go into a single flat directory because it's not easier
@@ -32,7 +90,7 @@ def _key_to_file(key):
     """
     return hashlib.sha1(key.encode('utf-8')).hexdigest()
 
-class AmazonS3Cache(BaseCache):
+class AmazonS3Cache(AsyncCacheMixin, BaseCache):
     """
         Amazon S3 cache backend for Django
     """
@@ -43,14 +101,6 @@ class AmazonS3Cache(BaseCache):
 
         BaseCache.__init__(self, params)
 
-        # Amazon and boto have a maximum limit of 1000 for get_all_keys(). See:
-        # http://docs.aws.amazon.com/AmazonS3/latest/API/RESTBucketGET.html
-        # This implementation of the GET operation returns some or all (up to 1000)
-        # of the objects in a bucket....
-
-        if self._max_entries > 1000:
-            self._max_entries = 1000
-
         self._options = params.get('OPTIONS', {})
 
         # backward compatible syntax for s3cache users before v1.2 for easy upgrades
@@ -85,94 +135,1600 @@ class AmazonS3Cache(BaseCache):
         for _n, _v in lowercase_options:
             self._options[_n] = _v
 
-        self._storage = s3boto.S3BotoStorage(
-            acl=_default_acl,
-            bucket=_bucket_name,
-            **self._options
+        # keys are distributed over BUCKETS by consistent hashing and each
+        # one is stored in REPLICAS of them. The first bucket also holds the
+        # generation and the segments of PACKED mode.
+        # the connections are created on first use, see S3CacheStorage
+        self._storages = [self._create_storage(entry, _default_acl)
+                          for entry in self._get_option('BUCKETS') or [_bucket_name]]
+        self._storage = self._storages[0]
+        _bucket_name = self._storage.bucket_name
+        self._ring = None
+        self._replicas = 1
+        if len(self._storages) > 1:
+            self._ring = HashRing(['%s/%s' % (storage.host, storage.bucket_name)
+                                   for storage in self._storages])
+            self._replicas = max(1, min(int(self._get_option('REPLICAS', 1)),
+                                        len(self._storages)))
+            for storage in self._storages:
+                storage.latency = shared(LatencyAverage, (storage.host, storage.bucket_name))
+
+        # Django creates a cache instance for every thread, state which has
+        # to be seen by all threads of the process is shared by the
+        # instances with the same bucket and location, see shared()
+        self._scope = (self._storage.host, self._storage.port, _bucket_name, self._location)
+
+        self._codec = Codec(
+            serializer=self._get_option('SERIALIZER', 'pickle'),
+            compressor=self._get_option('COMPRESSOR'),
+            level=self._get_option('COMPRESS_LEVEL'),
+            min_size=int(self._get_option('COMPRESS_MIN_SIZE', 1024)),
         )
 
+        # values are (un)pickled while they are uploaded/downloaded
+        self._streaming = bool(self._get_option('STREAMING', False))
+        self._stream_part_size = int(self._get_option('STREAM_PART_SIZE', 2 * MIN_PART_SIZE))
+
+        # optional in-process tier in front of S3, see _share_local_state()
+        self._local_max_entries = int(self._get_option('LOCAL_MAX_ENTRIES', 0))
+        self._local_max_bytes = int(self._get_option('LOCAL_MAX_BYTES', 0))
+        self._local_timeout = self._get_option('LOCAL_TIMEOUT', 5)
+
+        # optional tier on local disk which survives restarts and is
+        # shared by the processes of the host
+        self._disk = None
+        _disk_path = self._get_option('DISK_PATH')
+        if _disk_path:
+            self._disk = DiskCache(
+                _disk_path,
+                namespace='%s/%s' % (_bucket_name, self._location),
+                max_bytes=int(self._get_option('DISK_MAX_BYTES', 1024 * 1024 * 1024)),
+                timeout=self._get_option('DISK_TIMEOUT', 60),
+            )
+
+        # culling is checked against an estimate of the number of entries,
+        # kept for the process, which is re-counted every CULL_EVERY writes
+        self._cull_every = int(self._get_option('CULL_EVERY', 100))
+        self._cull_in_background = bool(self._get_option('CULL_IN_BACKGROUND', False))
+        self._culls = shared(CullSchedule, self._scope, every=self._cull_every)
+
+        # all keys are stored under <generation>/ and clear() starts a new one
+        self._generations = bool(self._get_option('GENERATIONS', False))
+        self._generation_timeout = self._get_option('GENERATION_TIMEOUT', 5)
+        self._generation = (None, 0)
+
+        # recent misses are remembered for NEGATIVE_TIMEOUT seconds
+        self._negative_timeout = float(self._get_option('NEGATIVE_TIMEOUT', 0))
+        self._negative_max_entries = int(self._get_option('NEGATIVE_MAX_ENTRIES', 10000))
+
+        # optional filter of the keys in the bucket, rebuilt from a listing
+        # every BLOOM_REFRESH seconds, keys which are not in it are not requested
+        self._bloom_enabled = bool(self._get_option('BLOOM_FILTER', False))
+        self._bloom_capacity = int(self._get_option('BLOOM_CAPACITY', 100000))
+        self._bloom_error_rate = float(self._get_option('BLOOM_ERROR_RATE', 0.01))
+        self._bloom_refresh = float(self._get_option('BLOOM_REFRESH', 300))
+        self._share_local_state()
+
+        # concurrent misses for the same key share a single fetch and recompute,
+        # LEASE_TIMEOUT extends that to other processes for get_or_set()
+        self._flights = shared(SingleFlight, self._scope)
+        self._lease_timeout = float(self._get_option('LEASE_TIMEOUT', 0))
+        self._lease_poll_interval = float(self._get_option('LEASE_POLL_INTERVAL', 0.1))
+
+        # values are served for STALE_TIMEOUT seconds after they expire while
+        # get_or_set() recomputes them in the background, EARLY_EXPIRATION_BETA
+        # makes that happen a bit before they expire
+        self._stale_timeout = float(self._get_option('STALE_TIMEOUT', 0))
+        self._early_beta = float(self._get_option('EARLY_EXPIRATION_BETA', 0))
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+
+        # keys are spread over SHARDS prefixes derived from their hash
+        # because S3 limits the request rate per prefix
+        self._shards = int(self._get_option('SHARDS', 0))
+        if self._shards < 2:
+            self._shards = 0
+        self._shard_width = len('%x' % (self._shards - 1)) if self._shards else 0
+
+        # set() and delete() only queue the request, uploader threads send it
+        # one queue per process so a thread reads what another one queued
+        self._write_behind = None
+        if self._get_option('WRITE_BEHIND', False):
+            self._write_behind_size = int(self._get_option('WRITE_BEHIND_QUEUE_SIZE', 1000))
+            self._write_behind_workers = max(1, int(self._get_option('WRITE_BEHIND_WORKERS', 2)))
+            self._write_behind = self._shared_write_behind()
+
+        # incr() adds to a counter in memory and writes the sum every
+        # COUNTER_FLUSH_INTERVAL seconds, one buffer per process so all
+        # threads count on the same value
+        self._counters = None
+        self._counter_interval = float(self._get_option('COUNTER_FLUSH_INTERVAL', 0))
+        if self._counter_interval:
+            self._counters = self._shared_counters()
+
+        # values of up to PACK_MAX_SIZE bytes are appended to shared
+        # segment objects instead of having an object each, one store per
+        # process so a thread reads what another one packed
+        self._packer = None
+        if self._get_option('PACKED', False) and not self._streaming:
+            self._pack_options = {
+                'max_value_size': int(self._get_option('PACK_MAX_SIZE', 1024)),
+                'segment_size': int(self._get_option('PACK_SEGMENT_SIZE', 1024 * 1024)),
+                'flush_interval': float(self._get_option('PACK_FLUSH_INTERVAL', 1)),
+                'refresh_interval': float(self._get_option('PACK_REFRESH', 60)),
+            }
+            self._packer = self._shared_packer()
+
+        # see stats(), counted for all threads of the process
+        self._stats = shared(CacheStats, self._scope)
+
+        # 5xx responses, e.g. 503 Slow Down, are retried with jittered
+        # exponential backoff while the process has retries left
+        _retry_policy = RetryPolicy(
+            attempts=int(self._get_option('RETRY_ATTEMPTS', 3)),
+            backoff=float(self._get_option('RETRY_BACKOFF', 0.05)),
+            budget=shared(RetryBudget, _bucket_name, float(self._get_option('RETRY_BUDGET', 0.1))),
+            on_retry=lambda: self._stats.incr('retries'),
+        )
+        for storage in self._storages:
+            storage.retry_policy = _retry_policy
+
+        # reads slower than HEDGE_PERCENTILE of the recent ones are sent
+        # twice, see _hedged()
+        self._hedge = None
+        _hedge_percentile = float(self._get_option('HEDGE_PERCENTILE', 0))
+        if _hedge_percentile:
+            self._hedge = shared(LatencyWindow, _bucket_name, _hedge_percentile)
+            self._hedge_min_delay = float(self._get_option('HEDGE_MIN_DELAY', 0.01))
+            self._hedge_workers = int(self._get_option('HEDGE_WORKERS', 20))
+
+        # non-blocking clients used by the async methods, one per event loop
+        self._aclients = weakref.WeakKeyDictionary()
+
+        # worker pool for batch operations, one per process created on
+        # first use
+        self._max_workers = int(self._get_option('MAX_WORKERS', 10))
+        # requests per second of prefetch() and warm()
+        self._warm_rate = float(self._get_option('WARM_RATE', 1000))
+
+        _instances.add(self)
+
+    def _create_storage(self, entry, acl):
+        """
+            Returns the storage of an entry of BUCKETS, the name of a bucket
+            or a dict of the OPTIONS which differ for it, e.g.
+            {'BUCKET_NAME': 'cache-eu', 'host': 's3.eu-west-1.amazonaws.com'}
+        """
+        options = dict(self._options)
+        bucket = entry
+        if isinstance(entry, dict):
+            for name, value in entry.items():
+                if name.upper() == 'LOCATION':
+                    raise ImproperlyConfigured('LOCATION is the same for all BUCKETS')
+                options[name] = value
+                options[name.lower()] = value
+            bucket = options.get('BUCKET_NAME')
+
+        storage = S3CacheStorage(acl=acl, bucket=bucket, **options)
+        storage.pool_size = int(self._get_option('MAX_POOL_CONNECTIONS', 50))
+        return storage
+
+    def _after_fork(self):
+        """
+            Called in the child process after a fork, e.g. by a pre-forking
+            server. Threads of the parent don't exist in the child and the
+            writes it has queued are left to the parent. The connection to
+            S3 is created again on first use, see S3CacheStorage.
+        """
+        self._aclients = weakref.WeakKeyDictionary()
+        self._flights = shared(SingleFlight, self._scope)
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+        self._culls = shared(CullSchedule, self._scope, every=self._cull_every)
+        self._share_local_state()
+        # the child counts its own calls
+        self._stats = shared(CacheStats, self._scope)
+        if self._counters is not None:
+            self._counters.after_fork()
+            self._counters = self._shared_counters()
+        if self._write_behind is not None:
+            self._write_behind.after_fork()
+            self._write_behind = self._shared_write_behind()
+        if self._packer is not None:
+            self._packer.after_fork()
+            self._packer = self._shared_packer()
+
+    def _share_local_state(self):
+        # a value read or a miss seen by one thread is known to the others
+        self._local = None
+        if self._local_max_entries:
+            self._local = shared(LocalCache, (self._scope, 'local'),
+                                 max_entries=self._local_max_entries,
+                                 max_bytes=self._local_max_bytes,
+                                 timeout=self._local_timeout)
+        self._misses = None
+        if self._negative_timeout:
+            self._misses = shared(LocalCache, (self._scope, 'misses'),
+                                  max_entries=self._negative_max_entries,
+                                  timeout=self._negative_timeout)
+        self._bloom = None
+        if self._bloom_enabled:
+            self._bloom = shared(KeyFilter, self._scope, capacity=self._bloom_capacity,
+                                 error_rate=self._bloom_error_rate, refresh=self._bloom_refresh)
+
+    def _shared_packer(self):
+        return shared(SegmentStore, self._scope,
+                      storage=self._storage,
+                      prefix=self._segment_dir,
+                      list_keys=self._iter_dir_keys,
+                      delete=self._delete_names,
+                      submit=self._submit,
+                      error=lambda err: self._stats.error('set', err),
+                      **self._pack_options)
+
+    def _shared_counters(self):
+        return shared(CounterBuffer, self._scope,
+                      interval=self._counter_interval,
+                      write=lambda fname, delta: self._incr(fname, delta),
+                      error=lambda err: self._stats.error('incr', err))
+
+    def _shared_write_behind(self):
+        return shared(WriteBehindQueue, self._scope,
+                      write=self._write_pending, delete=self._delete_pending,
+                      maxsize=self._write_behind_size, workers=self._write_behind_workers)
+
+    @property
+    def _executor(self):
+        return shared(ThreadPoolExecutor, 'batch', self._max_workers)
+
+    def _submit(self, func, *args):
+        """
+            Calls func on the worker pool, inline without one
+        """
+        if self._max_workers < 2:
+            func(*args)
+        else:
+            self._executor.submit(func, *args)
+
+    def _map(self, func, items):
+        """
+            Calls func for every item on the worker pool and returns
+            the results in order. Single items are handled inline.
+        """
+        if len(items) < 2 or self._max_workers < 2:
+            return [func(item) for item in items]
+        return list(self._executor.map(func, items))
+
+    def _storages_of(self, fname):
+        """
+            Returns the storages of the buckets which hold fname,
+            the one which owns it first
+        """
+        if self._ring is None:
+            return [self._storage]
+        digest = fname.rpartition('/')[2][:40]
+        return [self._storages[index] for index in self._ring.lookup(digest, self._replicas)]
+
+    def _owner_of(self, fname):
+        """
+            Returns the storage of the bucket which owns fname. Conditional
+            writes are made there and copied to the other replicas.
+        """
+        return self._storages_of(fname)[0]
+
+    def _nearest(self, fname):
+        """
+            Returns the storage fname is read from, the replica with the
+            lowest average response time
+        """
+        storages = self._storages_of(fname)
+        if len(storages) == 1:
+            return storages[0]
+        if random.random() < EXPLORE_RATE:
+            return random.choice(storages)
+        return min(storages, key=lambda storage: storage.latency.value())
+
+    def _replicate(self, storages, func, operation):
+        """
+            Calls func(storage) for every storage and returns the result of
+            the first one. The others are called on the pool of the process
+            at the same time and their errors are only counted, such a
+            replica serves its previous value until it expires or is
+            written again.
+        """
+        if len(storages) < 2:
+            return func(storages[0]) if storages else None
+
+        executor = shared(ThreadPoolExecutor, 'replicas', self._max_workers * self._replicas)
+        futures = [executor.submit(func, storage) for storage in storages[1:]]
+        try:
+            return func(storages[0])
+        finally:
+            for future in futures:
+                if future.exception() is not None:
+                    self._stats.error(operation, future.exception())
+
+    def _save(self, fname, body, metadata):
+        self._replicate(self._storages_of(fname),
+                        lambda storage: storage.save(fname, CacheContentFile(body, metadata=metadata)),
+                        'set')
+
+    def _key_to_fname(self, key):
+        """
+            Returns the file name of key relative to LOCATION
+        """
+        digest = _key_to_file(key)
+        fname = digest
+        if self._generations:
+            fname = '%d/%s' % (self._known_generation(), fname)
+        if self._shards:
+            fname = '%s/%s' % (self._shard_of(digest), fname)
+        return fname
+
+    def _shard_of(self, digest):
+        """
+            Returns the name of the shard prefix of a key's sha1 digest
+        """
+        return self._shard_name(int(digest[:8], 16) % self._shards)
+
+    def _shard_name(self, shard):
+        return '%0*x' % (self._shard_width, shard)
+
+    def _get_generation(self):
+        """
+            Returns the current generation or None if it isn't known. It is
+            read from S3 at most once every GENERATION_TIMEOUT seconds, also
+            after a failed read. When that fails the last known generation
+            is kept.
+        """
+        if self._generation_expired():
+            try:
+                generation = self._read_generation()
+            except (IOError, OSError, ValueError):
+                generation = self._generation[0]
+            self._generation = (generation, time.time())
+        return self._generation[0]
+
+    def _generation_expired(self):
+        return self._generation[1] + self._generation_timeout < time.time()
+
+    def _generation_unknown(self):
+        """
+            True if GENERATIONS is enabled and the generation has never
+            been read. Keys have no name then, reads are misses and writes
+            are skipped.
+        """
+        return self._generations and self._get_generation() is None
+
+    def _known_generation(self):
+        generation = self._get_generation()
+        if generation is None:
+            raise IOError('The current generation could not be read')
+        return generation
+
+    def _read_generation(self):
+        """
+            Reads the current generation from S3, it is 0 until clear()
+            starts the first one. Raises if the request fails.
+        """
+        try:
+            fobj = self._storage.open(GENERATION_FILE, 'rb')
+        except FileNotFoundError:
+            return 0
+        try:
+            return int(fobj.read())
+        finally:
+            fobj.close()
+
+    def _list_prefix(self, shard=None):
+        """
+            Returns the prefix of the keys which belong to the cache
+            or to one of its shards
+        """
+        path = '%s/' % shard if shard is not None else ''
+        if self._generations:
+            path += '%d/' % self._known_generation()
+        if path:
+            return self._key_name(path)
+        return self._location
+
+    def _list_prefixes(self):
+        """
+            Returns the prefixes of the keys which belong to the cache,
+            one per shard
+        """
+        if not self._shards:
+            return [self._list_prefix()]
+        return [self._list_prefix(self._shard_name(shard)) for shard in range(self._shards)]
+
+    def _segment_dir(self):
+        """
+            Returns the directory of the segments of PACKED mode
+        """
+        if self._generations:
+            return '%s/%d/' % (SEGMENT_DIR, self._known_generation())
+        return SEGMENT_DIR + '/'
+
+    def _iter_dir_keys(self, directory):
+        for page in self._iter_prefix_pages(self._key_name(directory)):
+            for key in page:
+                yield key
+
+    def _delete_names(self, fnames):
+        self._delete_keys([self._key_name(fname) for fname in fnames])
+
+    def _key_name(self, fname):
+        """
+            Returns the name of the S3 key under which fname is stored
+        """
+        name = self._storage._normalize_name(self._storage._clean_name(fname))
+        return self._storage._encode_name(name)
+
+    def _get_option(self, name, default=None):
+        """
+            Returns the value of an OPTIONS entry given either in upper
+            or in lower case.
+        """
+        return self._options.get(name, self._options.get(name.lower(), default))
+
 
     def add(self, key, value, timeout=None, version=None):
-        if self.has_key(key, version=version):
+        if self._generation_unknown() or self.has_key(key, version=version):
             return False
 
         self.set(key, value, timeout, version=version)
         return True
 
     def get(self, key, default=None, version=None):
-        key = self.make_key(key, version=version)
-        self.validate_key(key)
+        with self._stats.measure('get', self):
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            if self._generation_unknown():
+                self._stats.incr('misses')
+                return default
+
+            value, _fresh = self._lookup(self._key_to_fname(key))
+            if value is _MISSING:
+                self._stats.incr('misses')
+                return default
+            self._stats.incr('hits')
+            return value
+
+    def _lookup(self, fname, known_missing=True):
+        """
+            Returns the value of fname, or _MISSING, and False if it should
+            be recomputed, see STALE_TIMEOUT and EARLY_EXPIRATION_BETA.
+            S3 is asked even for keys known to be missing if known_missing
+            is False.
+        """
+        if self._write_behind is not None:
+            entry = self._write_behind.get(fname)
+            if entry is not None:
+                return self._pending_value(entry), True
 
-        fname = _key_to_file(key)
+        if self._local is not None:
+            payload = self._local.get(fname)
+            if payload is not None:
+                return self._codec.loads(payload), True
+
+        if self._packer is not None:
+            result = self._get_packed(fname)
+            if result is not None:
+                return result
+
+        if known_missing and self._known_missing(fname):
+            return _MISSING, True
+
+        if self._streaming:
+            return self._get_streamed(fname, _MISSING), True
+
+        result = self._flights.do(('get', fname), self._fetch, fname)
+        if result is None:
+            return _MISSING, True
+        payload, fresh = result
         try:
-            fobj = self._storage.open(fname, 'rb')
+            return self._codec.loads(payload), fresh
+        except (EOFError, pickle.PickleError):
+            return _MISSING, True
+
+    def _fetch(self, fname):
+        """
+            Downloads fname and returns the encoded value and whether it is
+            fresh or None if it is missing or has expired. Every caller
+            decodes the value itself so concurrent get() calls sharing the
+            download don't share mutable objects.
+        """
+        if self._disk is not None:
+            # entries are served from disk for DISK_TIMEOUT seconds
+            entry = self._disk.get(fname)
+            if entry is not None and entry[5]:
+                return self._disk_hit(fname, entry)
+            return self._hedged(self._fetch_disk, fname, entry)
+        return self._hedged(self._download, fname)
+
+    def _hedged(self, func, *args):
+        """
+            Returns func(*args). With HEDGE_PERCENTILE func is called again
+            on the hedge pool when the first call takes longer than that
+            percentile of recent reads and the first call to answer with
+            a value wins. The other one is left to finish in the background.
+            First calls run on a pool of their own so hedges never hold up
+            reads. Hedges are taken from the retry budget of the process.
+        """
+        if self._hedge is None:
+            return func(*args)
+
+        delay = self._hedge.threshold()
+        if delay is None:
+            return self._timed(func, *args)
+
+        first = shared(ThreadPoolExecutor, 'reads', READ_WORKERS).submit(self._timed, func, *args)
+        try:
+            return first.result(max(delay, self._hedge_min_delay))
+        except FutureTimeoutError:
+            pass
+        if not self._storage.retry_policy.budget.withdraw():
+            return first.result()
+
+        self._stats.incr('hedges')
+        executor = shared(ThreadPoolExecutor, 'hedge', self._hedge_workers)
+        second = executor.submit(self._timed, func, *args)
+        done, pending = wait((first, second), return_when=FIRST_COMPLETED)
+        result = done.pop().result()
+        if result is None and pending:
+            # the faster call failed or found nothing, the other may not
+            result = pending.pop().result()
+        return result
+
+    def _timed(self, func, *args):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self._hedge.record(time.perf_counter() - started)
+
+    def _download(self, fname):
+        """
+            Reads fname from S3 for _fetch()
+        """
+        try:
+            fobj = self._nearest(fname).open(fname, 'rb')
             try:
-                if not self._is_expired(fobj, fname):
-                    return pickle.load(fobj)
+                # metadata comes with the HEAD request done by open()
+                # so expired objects are rejected without reading the body
+                exp = self._get_expiry(fobj)
+                if exp is not None and self._has_expired(exp, fname):
+                    return None
+
+                body_exp = pickle.load(fobj)
+                if exp is None:
+                    exp = body_exp
+                    if self._has_expired(exp, fname):
+                        return None
+
+                payload = fobj.read()
+                self._stats.incr('bytes_read', len(payload))
+                fresh_until = self._get_metadata(fobj, FRESH_METADATA)
+                if self._local is not None:
+                    # stale values are always read from S3 to notice they are stale
+                    self._local.set(fname, fresh_until or exp, payload)
+                return payload, self._is_fresh(fresh_until, self._get_metadata(fobj, DELTA_METADATA))
             finally:
                 fobj.close()
+        except FileNotFoundError:
+            self._remember_miss(fname)
+        except (IOError, OSError, EOFError, pickle.PickleError) as err:
+            self._stats.error('get', err)
+        return None
+
+    def _fetch_disk(self, fname, entry):
+        """
+            Same as _download() through the disk tier. A conditional GET
+            downloads the object again only if it has changed since entry
+            was stored.
+        """
+        try:
+            key = self._nearest(fname).open_key(fname, etag=entry[1] if entry is not None else None)
+            if key is None:
+                self._disk.revalidated(fname)
+                return self._disk_hit(fname, entry)
+
+            try:
+                exp = _metadata_expiry(key.metadata)
+                if exp is not None and self._has_expired(exp, fname):
+                    self._disk.delete(fname)
+                    return None
+                body = key.read()
+            finally:
+                key.close()
+
+            body_exp, payload = _split_body(body)
+            if exp is None:
+                exp = body_exp
+                if self._has_expired(exp, fname):
+                    self._disk.delete(fname)
+                    return None
+        except FileNotFoundError:
+            self._disk.delete(fname)
+            self._remember_miss(fname)
+            return None
+        except (IOError, OSError, EOFError, pickle.PickleError) as err:
+            self._stats.error('get', err)
+            return None
+
+        self._stats.incr('bytes_read', len(payload))
+        fresh_until = _metadata_float(key.metadata, FRESH_METADATA)
+        delta = _metadata_float(key.metadata, DELTA_METADATA)
+        self._disk.set(fname, key.etag, exp, fresh_until, delta, payload)
+        if self._local is not None:
+            self._local.set(fname, fresh_until or exp, payload)
+        return payload, self._is_fresh(fresh_until, delta)
+
+    def _disk_hit(self, fname, entry):
+        payload, _etag, exp, fresh_until, delta, _current = entry
+        if self._local is not None:
+            self._local.set(fname, fresh_until or exp, payload)
+        return payload, self._is_fresh(fresh_until, delta)
+
+    def _get_packed(self, fname):
+        """
+            Same as _lookup() for a value from a segment,
+            returns None if fname isn't packed
+        """
+        try:
+            entry = self._packer.get(fname)
+        except (IOError, OSError) as err:
+            self._stats.error('get', err)
+            return _MISSING, True
+        if entry is None:
+            return None
+        if entry == DELETED:
+            return _MISSING, True
+
+        payload, exp, fresh_until, delta = entry
+        self._stats.incr('bytes_read', len(payload))
+        if self._local is not None:
+            self._local.set(fname, fresh_until or exp, payload)
+        try:
+            return self._codec.loads(payload), self._is_fresh(fresh_until, delta)
+        except (EOFError, pickle.PickleError):
+            return _MISSING, True
+
+    def _is_fresh(self, fresh_until, delta=None):
+        """
+            Returns False once fresh_until has passed. With EARLY_EXPIRATION_BETA
+            it may return False a bit earlier, the longer the value took to
+            compute and the closer to fresh_until, the more likely. This is
+            the XFetch algorithm of Vattani et al., "Optimal Probabilistic
+            Cache Stampede Prevention". Concurrent readers don't all decide
+            to recompute at the same moment.
+        """
+        if fresh_until is None:
+            return True
+
+        now = time.time()
+        if self._early_beta and delta:
+            # log() of a number in (0, 1] is <= 0 so this moves now forward
+            now -= delta * self._early_beta * math.log(1.0 - random.random())
+        return now < fresh_until
+
+    def _get_streamed(self, fname, default=None):
+        """
+            Same as get() but the value is unpickled while it is downloaded
+            instead of buffering the whole body first.
+        """
+        try:
+            reader = self._open_stream(fname)
+            if reader is None:
+                return default
+            try:
+                return self._codec.load(reader)
+            finally:
+                reader.close()
+        except FileNotFoundError:
+            self._remember_miss(fname)
+        except (IOError, OSError, EOFError, pickle.PickleError) as err:
+            self._stats.error('get', err)
+        return default
+
+    def get_stream(self, key, default=None, version=None):
+        """
+            Returns a file-like object which downloads the bytes stored by
+            set_stream() as they are read. The caller must close it.
+            Returns default if the key is missing, has expired or was stored
+            with set().
+        """
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        if self._generation_unknown():
+            return default
+
+        fname = self._key_to_fname(key)
+        try:
+            reader = self._open_stream(fname)
+            if reader is None:
+                return default
+            try:
+                return self._codec.load_stream(reader)
+            except BaseException:
+                reader.close()
+                raise
         except (IOError, OSError, EOFError, pickle.PickleError):
-            pass
+            return default
+
+    def _open_stream(self, fname):
+        """
+            Sends a single GET request for fname and returns a reader
+            positioned after the expiry timestamp or None if the object
+            has expired. The expiry time in metadata is checked before
+            any of the body is downloaded.
+        """
+        reader = io.BufferedReader(KeyReader(self._owner_of(fname).open_key(fname)))
+        try:
+            exp = self._get_expiry(reader.raw)
+            if exp is not None and self._has_expired(exp, fname):
+                reader.close()
+                return None
+
+            body_exp = pickle.load(reader)
+            if exp is None and self._has_expired(body_exp, fname):
+                reader.close()
+                return None
+        except BaseException:
+            reader.close()
+            raise
+        return reader
+
+    def get_or_set(self, key, default, timeout=None, version=None):
+        """
+            Returns the value of key. On a miss default, or its result if it
+            is callable, is stored and returned. Concurrent calls for the
+            same key in this process share a single fetch and a single call
+            of default and all get the same object.
+
+            With LEASE_TIMEOUT processes also take a lease object in S3
+            before calling default. Those which don't get it poll for the
+            value for up to LEASE_TIMEOUT seconds and then call default
+            themselves.
+        """
+        made_key = self.make_key(key, version=version)
+        self.validate_key(made_key)
+        if self._generation_unknown():
+            return default() if callable(default) else default
+        fname = self._key_to_fname(made_key)
+        return self._flights.do(('get_or_set', fname), self._get_or_set, fname, default, timeout)
+
+    def _get_or_set(self, fname, default, timeout):
+        value, fresh = self._lookup(fname)
+        if value is not _MISSING:
+            if not fresh:
+                self._refresh_in_background(fname, default, timeout)
+            return value
+
+        leased = False
+        if self._lease_timeout:
+            leased = self._acquire_lease(fname)
+            if not leased:
+                value = self._wait_for_value(fname)
+                if value is not _MISSING:
+                    return value
+
+        try:
+            return self._recompute(fname, default, timeout)
+        finally:
+            if leased:
+                self._release_lease(fname)
+
+    def _recompute(self, fname, default, timeout):
+        """
+            Stores default, or its result if it is callable, together with
+            the time it took to compute for EARLY_EXPIRATION_BETA.
+        """
+        started = time.time()
+        if callable(default):
+            default = default()
+        if default is not None:
+            self._maybe_cull()
+            self._set(fname, default, timeout, delta=time.time() - started)
         return default
 
+    def _refresh_in_background(self, fname, default, timeout):
+        """
+            Recomputes a stale value on the worker pool while it is still
+            being served. Only one refresh per key runs in this process
+            and with LEASE_TIMEOUT only one in all processes.
+        """
+        with self._refresh_lock:
+            if fname in self._refreshing:
+                return
+            self._refreshing.add(fname)
+
+        def _refresh():
+            try:
+                if self._lease_timeout and not self._acquire_lease(fname):
+                    return
+                try:
+                    self._recompute(fname, default, timeout)
+                finally:
+                    if self._lease_timeout:
+                        self._release_lease(fname)
+            finally:
+                with self._refresh_lock:
+                    self._refreshing.discard(fname)
+
+        self._executor.submit(_refresh)
+
+    def _acquire_lease(self, fname):
+        """
+            Creates the lease object of fname with a conditional PUT.
+            Returns True if this process holds the lease. A lease older
+            than LEASE_TIMEOUT is left by a process which died while
+            holding it, it is deleted and the PUT is tried once more.
+        """
+        name = fname + LEASE_SUFFIX
+        storage = self._owner_of(fname)
+        for _attempt in range(2):
+            exp = time.time() + self._lease_timeout
+            content = CacheContentFile(b'', metadata={EXPIRY_METADATA: repr(exp)})
+            try:
+                if storage.create(name, content):
+                    return True
+
+                lease = storage.bucket.get_key(self._key_name(name))
+                if lease is None:
+                    continue
+                exp = _metadata_expiry(lease.metadata)
+                if exp is None or exp >= time.time():
+                    return False
+                self._delete(name)
+            except (IOError, OSError):
+                return False
+        return False
+
+    def _release_lease(self, fname):
+        try:
+            self._delete(fname + LEASE_SUFFIX)
+        except (IOError, OSError):
+            pass
+
+    def _wait_for_value(self, fname):
+        """
+            Polls for the value stored by the process holding the lease.
+            The miss which made this process try to take the lease is
+            remembered, see NEGATIVE_TIMEOUT and BLOOM_FILTER, so every
+            poll asks S3.
+        """
+        deadline = time.time() + self._lease_timeout
+        while time.time() < deadline:
+            time.sleep(self._lease_poll_interval)
+            value, _fresh = self._lookup(fname, known_missing=False)
+            if value is not _MISSING:
+                self._note_exists(fname)
+                return value
+        return _MISSING
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        missing = object()
+        values = self._map(lambda key: self.get(key, missing, version=version), keys)
+        return dict((k, v) for (k, v) in zip(keys, values) if v is not missing)
+
+    def prefetch(self, keys, version=None, rate=None):
+        """
+            Reads keys on the worker pool into the tiers in memory and on
+            disk, see LOCAL_MAX_ENTRIES and DISK_PATH, so get() doesn't wait
+            for S3 afterwards. At most rate keys per second, WARM_RATE by
+            default, are read from S3. Returns the number of keys found.
+            Does nothing with STREAMING, streamed values aren't kept locally.
+        """
+        if self._streaming or self._generation_unknown():
+            return 0
+
+        limiter = RateLimiter(self._warm_rate if rate is None else rate)
+        fnames = []
+        for key in keys:
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            fnames.append(self._key_to_fname(key))
+
+        def _prefetch(fname):
+            if self._local is not None and self._local.get(fname) is not None:
+                return True
+            limiter.acquire()
+            value, _fresh = self._lookup(fname)
+            return value is not _MISSING
+
+        return sum(self._map(_prefetch, fnames))
+
     def set(self, key, value, timeout=None, version=None):
+        with self._stats.measure('set', self):
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            if self._generation_unknown():
+                return
+
+            fname = self._key_to_fname(key)
+
+            self._maybe_cull()
+
+            self._set(fname, value, timeout)
+
+    def set_many(self, data, timeout=None, version=None):
+        return self._set_many(data, timeout, version)
+
+    def warm(self, data, timeout=None, version=None, rate=None):
+        """
+            Same as set_many() but at most rate values per second, WARM_RATE
+            by default, are written so filling the cache after a deploy or
+            clear() isn't throttled by S3. Returns the keys which could not
+            be stored.
+        """
+        return self._set_many(data, timeout, version,
+                              RateLimiter(self._warm_rate if rate is None else rate))
+
+    def _set_many(self, data, timeout=None, version=None, limiter=None):
+        if self._generation_unknown():
+            return list(data)
+
+        items = []
+        for key, value in data.items():
+            made_key = self.make_key(key, version=version)
+            self.validate_key(made_key)
+            items.append((key, self._key_to_fname(made_key), value))
+
+        self._maybe_cull(len(items))
+
+        def _set(item):
+            if limiter is not None:
+                limiter.acquire()
+            with self._stats.measure('set', self):
+                return self._set(item[1], item[2], timeout)
+
+        results = self._map(_set, items)
+        return [item[0] for (item, stored) in zip(items, results) if not stored]
+
+    def set_stream(self, key, source, timeout=None, version=None):
+        """
+            Stores the bytes read from source, a file-like object or an
+            iterable of bytes, without holding all of them in memory.
+            Read them back with get_stream(), or with get() as a whole.
+            Returns False if they could not be stored.
+        """
         key = self.make_key(key, version=version)
         self.validate_key(key)
+        if self._generation_unknown():
+            return False
 
-        fname = _key_to_file(key)
+        fname = self._key_to_fname(key)
 
-        self._cull()
+        self._maybe_cull()
+
+        return self._write_stream(fname, timeout,
+                                  lambda writer: self._codec.dump_stream(source, writer))
+
+    def _set(self, fname, value, timeout=None, delta=None):
+        """
+            Writes value to S3, returns False if it could not be stored.
+            delta is how many seconds computing value took.
+        """
+        self._note_write(fname)
+        if self._streaming:
+            return self._write_stream(fname, timeout,
+                                      lambda writer: self._codec.dump(value, writer), delta)
 
         try:
-            content = self._dump_object(value, timeout)
-            self._storage.save(fname, ContentFile(content))
-        except (IOError, OSError, EOFError, pickle.PickleError):
-            pass
+            exp, metadata = self._expiry_metadata(timeout, delta)
+            if self._packer is not None:
+                payload = self._codec.dumps(value)
+                if self._packer.accepts(payload):
+                    self._set_packed(fname, payload, exp, metadata)
+                    return True
+                body = pickle.dumps(exp, pickle.HIGHEST_PROTOCOL) + payload
+            else:
+                body = self._serialize(value, exp)
+            if self._write_behind is not None and \
+               self._write_behind.put(fname, (SET, exp, body, metadata)):
+                return True
+            self._save(fname, body, metadata)
+            self._stats.incr('bytes_written', len(body))
+            return True
+        except (IOError, OSError, EOFError, pickle.PickleError) as err:
+            self._stats.error('set', err)
+            return False
+        finally:
+            # after the write so a concurrent get() can't put back the old value
+            self._drop_local(fname)
+
+    def _set_packed(self, fname, payload, exp, metadata):
+        if self._write_behind is not None:
+            # an older queued value must not be uploaded after this one
+            self._write_behind.discard(fname)
+        self._packer.append(fname, payload, exp,
+                            _metadata_float(metadata, FRESH_METADATA),
+                            _metadata_float(metadata, DELTA_METADATA))
+        self._stats.incr('bytes_written', len(payload))
+
+    def _write_pending(self, fname, entry):
+        """
+            Called by the uploader threads of WRITE_BEHIND
+        """
+        _op, _exp, body, metadata = entry
+        try:
+            self._save(fname, body, metadata)
+            self._stats.incr('bytes_written', len(body))
+        except (IOError, OSError) as err:
+            self._stats.error('set', err)
+        finally:
+            self._drop_local(fname)
+
+    def _delete_pending(self, fnames):
+        try:
+            self._delete_fnames(fnames)
+        except (IOError, OSError) as err:
+            self._stats.error('delete', err)
+        finally:
+            for fname in fnames:
+                self._drop_local(fname)
+
+    def _pending_value(self, entry, default=_MISSING):
+        """
+            Returns the value of a queued write or default
+        """
+        if not self._pending_exists(entry):
+            return default
+        return self._codec.loads(_split_body(entry[2])[1])
+
+    def _pending_exists(self, entry):
+        op, exp, _body, _metadata = entry
+        return op == SET and exp >= time.time()
+
+    def flush(self, timeout=None):
+        """
+            Writes the increments added up with COUNTER_FLUSH_INTERVAL and
+            the values packed with PACKED and waits until the writes queued
+            by WRITE_BEHIND are sent to S3. Returns False if that didn't
+            happen within timeout seconds.
+        """
+        if self._counters is not None:
+            self._counters.flush()
+        if self._packer is not None and not self._packer.flush(timeout):
+            return False
+        if self._write_behind is None:
+            return True
+        return self._write_behind.flush(timeout)
+
+    def _write_stream(self, fname, timeout, dump, delta=None):
+        """
+            Calls dump() with a writer which uploads the value in parts of
+            STREAM_PART_SIZE bytes as it is being written.
+        """
+        self._note_write(fname)
+        if self._write_behind is not None:
+            # streams are never queued, don't let a queued value overwrite them
+            self._write_behind.discard(fname)
+
+        try:
+            exp, metadata = self._expiry_metadata(timeout, delta)
+            writer = self._owner_of(fname).open_writer(fname, metadata=metadata,
+                                                       part_size=self._stream_part_size)
+            try:
+                writer.write(pickle.dumps(exp, pickle.HIGHEST_PROTOCOL))
+                dump(writer)
+            except BaseException:
+                writer.abort()
+                raise
+            writer.close()
+            return True
+        except (IOError, OSError, EOFError, pickle.PickleError) as err:
+            self._stats.error('set', err)
+            return False
+        finally:
+            self._drop_local(fname)
 
     def _dump_object(self, value, timeout=None):
+        return self._serialize(value, self._get_expiry_time(timeout))
+
+    def _get_expiry_time(self, timeout=None):
         if timeout is None:
             timeout = self.default_timeout
 
-        content = pickle.dumps(time.time() + timeout, pickle.HIGHEST_PROTOCOL)
-        content += pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        return time.time() + timeout
+
+    def _expiry_metadata(self, timeout=None, delta=None):
+        """
+            Returns the time after which the object is deleted and its
+            metadata. With STALE_TIMEOUT that is STALE_TIMEOUT seconds after
+            the value expires. The expiry time of the value itself is kept
+            in FRESH_METADATA.
+        """
+        exp = self._get_expiry_time(timeout)
+        if not self._stale_timeout and not self._early_beta:
+            return exp, {EXPIRY_METADATA: repr(exp)}
+
+        metadata = {FRESH_METADATA: repr(exp)}
+        if delta is not None:
+            metadata[DELTA_METADATA] = repr(delta)
+        exp += self._stale_timeout
+        metadata[EXPIRY_METADATA] = repr(exp)
+        return exp, metadata
+
+    def _serialize(self, value, exp):
+        """
+            The expiry timestamp is kept at the start of the body for
+            backward compatibility with objects which have no metadata.
+            The value follows, encoded by the configured Codec.
+        """
+        content = pickle.dumps(exp, pickle.HIGHEST_PROTOCOL)
+        content += self._codec.dumps(value)
         return content
 
-    def delete(self, key, version=None):
-        key = self.make_key(key, version=version)
-        self.validate_key(key)
+    def touch(self, key, timeout=None, version=None):
+        """
+            Sets a new expiry time for key without downloading or uploading
+            its value. The object is copied onto itself by S3 with new
+            metadata. Returns False if key doesn't exist.
+        """
+        with self._stats.measure('touch', self):
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            if self._generation_unknown():
+                return False
+            fname = self._key_to_fname(key)
+
+            if self._write_behind is not None:
+                entry = self._write_behind.get(fname)
+                if entry is not None:
+                    if not self._pending_exists(entry):
+                        return False
+                    exp, metadata = self._expiry_metadata(
+                        timeout, _metadata_float(entry[3], DELTA_METADATA))
+                    if self._write_behind.put(fname, (SET, exp, entry[2], metadata)):
+                        return True
+                    self._write_behind.flush()
+
+            if self._packer is not None:
+                touched = self._touch_packed(fname, timeout)
+                if touched is not None:
+                    return touched
+
+            if self._known_missing(fname):
+                return False
+
+            try:
+                return self._touch(fname, timeout)
+            except (IOError, OSError, EOFError, pickle.PickleError) as err:
+                self._stats.error('touch', err)
+                return False
+            finally:
+                # same as after a write
+                self._drop_local(fname)
+
+    def _touch_packed(self, fname, timeout):
+        """
+            Appends a packed value again with the new expiry time, it is
+            small enough to not need a copy in S3. Returns None if fname
+            isn't packed.
+        """
         try:
-            self._delete(_key_to_file(key))
-        except (IOError, OSError):
-            pass
+            entry = self._packer.get(fname)
+        except (IOError, OSError) as err:
+            self._stats.error('touch', err)
+            return False
+        if entry is None:
+            return None
+        if entry == DELETED:
+            return False
+
+        payload, _exp, _fresh_until, delta = entry
+        exp, metadata = self._expiry_metadata(timeout, delta)
+        self._set_packed(fname, payload, exp, metadata)
+        return True
+
+    def _touch(self, fname, timeout):
+        """
+            Reads the metadata of fname with a HEAD request and replaces it
+            if the value hasn't expired. The copy is conditional on the ETag
+            so a concurrent set() is never overwritten with the old value.
+        """
+        storages = self._storages_of(fname)
+        for _attempt in range(TOUCH_ATTEMPTS):
+            key = storages[0].bucket.get_key(self._key_name(fname))
+            if key is None:
+                self._remember_miss(fname)
+                return False
+
+            exp = _metadata_expiry(key.metadata)
+            if exp is None:
+                # written before v1.5, read only the expiry time at the start of the body
+                exp = pickle.loads(key.get_contents_as_string(headers={'Range': 'bytes=0-63'}))
+            if self._has_expired(exp, fname):
+                return False
+
+            _exp, metadata = self._expiry_metadata(
+                timeout, _metadata_float(key.metadata, DELTA_METADATA))
+            if storages[0].replace_metadata(fname, metadata, etag=key.etag):
+                # replicas with a different value are left alone
+                self._replicate(storages[1:], lambda storage: storage.replace_metadata(
+                    fname, metadata, etag=key.etag), 'touch')
+                return True
+        return False
+
+    def incr(self, key, delta=1, version=None):
+        """
+            Adds delta to the value of key with a conditional PUT which fails
+            if the value has changed since it was read, the increment is then
+            retried. The expiry time of the value is kept. Raises ValueError
+            if key doesn't exist, decr() calls incr().
+        """
+        with self._stats.measure('incr', self):
+            made_key = self.make_key(key, version=version)
+            self.validate_key(made_key)
+            fname = self._key_to_fname(made_key)
+
+            if self._counters is not None:
+                value = self._counters.add(fname, delta)
+                if value is not None:
+                    return value
+
+            value = self._incr(fname, delta)
+            if value is _MISSING:
+                raise ValueError("Key '%s' not found" % key)
+
+            if self._counters is not None:
+                self._counters.seed(fname, value)
+            return value
+
+    def _incr(self, fname, delta):
+        """
+            Returns the incremented value of fname or _MISSING if it
+            doesn't exist. Raises IOError if the value keeps changing
+            for INCR_ATTEMPTS attempts.
+        """
+        if self._write_behind is not None and self._write_behind.get(fname) is not None:
+            # the conditional PUT must see the queued value
+            self._write_behind.flush()
+
+        if self._packer is not None:
+            value = self._unpack_counter(fname, delta)
+            if value is not None:
+                return value
+
+        if self._known_missing(fname):
+            return _MISSING
+
+        storages = self._storages_of(fname)
+        for attempt in range(INCR_ATTEMPTS):
+            try:
+                key = storages[0].open_key(fname)
+            except FileNotFoundError:
+                self._remember_miss(fname)
+                return _MISSING
+            try:
+                body = key.read()
+            finally:
+                key.close()
+            self._stats.incr('bytes_read', len(body))
+
+            body_exp, payload = _split_body(body)
+            metadata = dict((name, value) for (name, value) in key.metadata.items()
+                            if name in (EXPIRY_METADATA, FRESH_METADATA, DELTA_METADATA))
+            exp = _metadata_expiry(metadata)
+            if exp is None:
+                exp = body_exp
+            if self._has_expired(exp, fname):
+                return _MISSING
+
+            value = self._codec.loads(payload) + delta
+            metadata[EXPIRY_METADATA] = repr(exp)
+            body = self._serialize(value, exp)
+            if storages[0].replace(fname, CacheContentFile(body, metadata=metadata), key.etag):
+                self._replicate(storages[1:], lambda storage: storage.save(
+                    fname, CacheContentFile(body, metadata=metadata)), 'incr')
+                self._stats.incr('bytes_written', len(body))
+                self._drop_local(fname)
+                return value
+
+            time.sleep(random.uniform(0, INCR_BACKOFF * 2 ** attempt))
+        raise IOError('%s changed during %d attempts to increment it' % (fname, INCR_ATTEMPTS))
+
+    def _unpack_counter(self, fname, delta):
+        """
+            Packed values can't be replaced with a conditional PUT. The
+            incremented value is moved to an object of its own which only
+            the first process to try creates. Returns None if fname isn't
+            packed or another process has moved it first.
+        """
+        entry = self._packer.get(fname)
+        if entry is None:
+            return None
+        if entry == DELETED:
+            return _MISSING
+
+        payload, exp, fresh_until, delta_metadata = entry
+        value = self._codec.loads(payload) + delta
+        metadata = {EXPIRY_METADATA: repr(exp)}
+        if fresh_until is not None:
+            metadata[FRESH_METADATA] = repr(fresh_until)
+        if delta_metadata is not None:
+            metadata[DELTA_METADATA] = repr(delta_metadata)
+
+        body = self._serialize(value, exp)
+        storages = self._storages_of(fname)
+        created = storages[0].create(fname, CacheContentFile(body, metadata=metadata))
+        self._packer.mark(fname, UNPACKED)
+        if not created:
+            return None
+        self._replicate(storages[1:], lambda storage: storage.save(
+            fname, CacheContentFile(body, metadata=metadata)), 'incr')
+        self._stats.incr('bytes_written', len(body))
+        return value
+
+    def _drop_counter(self, fname):
+        """
+            Forgets the increments of fname which haven't been written
+            because its value is being replaced
+        """
+        if self._counters is not None:
+            self._counters.drop(fname)
+
+    def delete(self, key, version=None):
+        with self._stats.measure('delete', self):
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            if self._generation_unknown():
+                return
+            fname = self._key_to_fname(key)
+            self._drop_counter(fname)
+            if self._packer is not None:
+                self._packer.mark(fname, DELETED)
+            try:
+                if self._write_behind is None or \
+                   not self._write_behind.put(fname, (DELETE, None, None, None)):
+                    self._delete(fname)
+            except (IOError, OSError) as err:
+                self._stats.error('delete', err)
+            finally:
+                self._drop_local(fname)
+
+    def delete_many(self, keys, version=None):
+        with self._stats.measure('delete', self):
+            if self._generation_unknown():
+                return
+            fnames = []
+            for key in keys:
+                key = self.make_key(key, version=version)
+                self.validate_key(key)
+                fnames.append(self._key_to_fname(key))
+                self._drop_counter(fnames[-1])
+                if self._packer is not None:
+                    self._packer.mark(fnames[-1], DELETED)
+
+            try:
+                if self._write_behind is not None:
+                    fnames = [fname for fname in fnames
+                              if not self._write_behind.put(fname, (DELETE, None, None, None))]
+                self._delete_fnames(fnames)
+            except (IOError, OSError) as err:
+                self._stats.error('delete', err)
+            finally:
+                for fname in fnames:
+                    self._drop_local(fname)
 
     def _delete(self, fname):
-        self._storage.delete(fname)
+        self._replicate(self._storages_of(fname), lambda storage: storage.delete(fname), 'delete')
+
+    def _delete_fnames(self, fnames):
+        """
+            Same as _delete_keys() for file names which may be held by
+            different buckets
+        """
+        if self._ring is None:
+            self._delete_keys([self._key_name(fname) for fname in fnames])
+            return
+
+        names = {}
+        for fname in fnames:
+            for storage in self._storages_of(fname):
+                names.setdefault(storage, []).append(self._key_name(fname))
+        chunks = []
+        for storage, keys in names.items():
+            chunks.extend((storage.bucket, keys[i:i + DELETE_CHUNK_SIZE])
+                          for i in range(0, len(keys), DELETE_CHUNK_SIZE))
+        self._map(lambda chunk: chunk[0].delete_keys(chunk[1], quiet=True), chunks)
+
+    def _delete_keys(self, keys):
+        """
+            Removes keys from the bucket using multi-object delete requests
+            which are sent in parallel when there are more than 1000 keys.
+        """
+        chunks = [keys[i:i + DELETE_CHUNK_SIZE]
+                  for i in range(0, len(keys), DELETE_CHUNK_SIZE)]
+        bucket = self._storage.bucket
+        self._map(lambda chunk: bucket.delete_keys(chunk, quiet=True), chunks)
 
     def has_key(self, key, version=None):
-        key = self.make_key(key, version=version)
-        self.validate_key(key)
-        fname = _key_to_file(key)
-        try:
-            fobj = self._storage.open(fname, 'rb')
+        with self._stats.measure('has_key', self):
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            if self._generation_unknown():
+                return False
+            fname = self._key_to_fname(key)
+            if self._write_behind is not None:
+                entry = self._write_behind.get(fname)
+                if entry is not None:
+                    return self._pending_exists(entry)
+
+            if self._local is not None and self._local.get(fname) is not None:
+                return True
+            if self._disk is not None:
+                entry = self._disk.get(fname)
+                if entry is not None and entry[5]:
+                    return True
+
+            if self._packer is not None:
+                packed = self._packer.contains(fname)
+                if packed is not None:
+                    return packed
+
+            if self._known_missing(fname):
+                return False
+
             try:
-                return not self._is_expired(fobj, fname)
-            finally:
-                fobj.close()
-        except (IOError, OSError, EOFError, pickle.PickleError):
+                fobj = self._nearest(fname).open(fname, 'rb')
+                try:
+                    exp = self._get_expiry(fobj)
+                    if exp is None:
+                        return not self._is_expired(fobj, fname)
+                    return not self._has_expired(exp, fname)
+                finally:
+                    fobj.close()
+            except FileNotFoundError:
+                self._remember_miss(fname)
+            except (IOError, OSError, EOFError, pickle.PickleError) as err:
+                self._stats.error('has_key', err)
             return False
 
+    def _remember_miss(self, fname):
+        if self._misses is not None:
+            self._misses.set(fname, time.time() + self._misses.timeout, b'')
+
+    def _note_write(self, fname):
+        """
+            Called before fname is written by this process
+        """
+        self._drop_counter(fname)
+        if self._packer is not None:
+            # a packed value written later replaces this mark
+            self._packer.mark(fname, UNPACKED)
+        self._note_exists(fname)
+
+    def _note_exists(self, fname):
+        """
+            Called when fname is known to exist in S3
+        """
+        if self._misses is not None:
+            self._misses.delete(fname)
+        if self._bloom is not None:
+            self._bloom.add(self._key_name(fname))
+
+    def _drop_local(self, fname):
+        """
+            Forgets the copies of fname kept in memory and on disk
+        """
+        if self._local is not None:
+            self._local.delete(fname)
+        if self._disk is not None:
+            self._disk.delete(fname)
+
+    def _known_missing(self, fname):
+        """
+            Returns True if fname is known not to exist without asking S3
+        """
+        if self._misses is not None and self._misses.get(fname) is not None:
+            return True
+
+        if self._bloom is None:
+            return False
+
+        bloom = self._bloom.current
+        if self._bloom.is_stale():
+            self._rebuild_bloom()
+        return bloom is not None and self._key_name(fname) not in bloom
+
+    def _rebuild_bloom(self):
+        """
+            Starts listing the bucket into a new filter on the worker pool.
+            Writes made meanwhile are added to both filters.
+        """
+        bloom = self._bloom.start_build()
+        if bloom is None:
+            return
+
+        def _build():
+            try:
+                for storage in self._storages:
+                    for page in self._iter_key_pages(storage=storage):
+                        for key in page:
+                            bloom.add(key.name)
+            except (IOError, OSError):
+                self._bloom.finish_build(None)
+            else:
+                self._bloom.finish_build(bloom)
+
+        self._executor.submit(_build)
+
+    def _get_expiry(self, fobj):
+        """
+            Returns the expiry timestamp stored in the metadata of an
+            open cache file without reading its body or None if the
+            object doesn't have it.
+        """
+        return self._get_metadata(fobj, EXPIRY_METADATA)
+
+    def _get_metadata(self, fobj, name):
+        """
+            Returns the numeric metadata name of an open cache file or None
+        """
+        key = getattr(fobj, 'key', None)
+        if key is None:
+            return None
+
+        value = key.get_metadata(name)
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+
     def _is_expired(self, fobj, fname):
         """
             Takes an open cache file and determines if it has expired,
             deletes the file if it is has passed its expiry time.
         """
-        exp = pickle.load(fobj)
+        return self._has_expired(pickle.load(fobj), fname)
+
+    def _has_expired(self, exp, fname):
+        """
+            Same as _is_expired() but for an already read expiry timestamp.
+            Expired files are deleted on the worker pool so reads don't
+            wait for the DELETE request.
+        """
         if exp < time.time():
-            self._delete(fname)
+            self._remember_miss(fname)
+            if self._max_workers < 2:
+                self._reclaim(fname)
+            else:
+                self._executor.submit(self._reclaim, fname)
             return True
 
         return False
 
+    def _reclaim(self, fname):
+        try:
+            self._delete(fname)
+        except (IOError, OSError):
+            pass
+
+    def _maybe_cull(self, writes=1):
+        """
+            Called before writes instead of _cull(), see CullSchedule. The
+            first count of the process is always made in the background.
+        """
+        if not self._max_entries or not self._culls.due(self._max_entries, writes):
+            return
+
+        if self._cull_in_background or self._write_behind is not None or \
+           self._culls.count is None:
+            self._executor.submit(self._run_cull)
+        else:
+            self._run_cull()
+
+    def _run_cull(self):
+        try:
+            with self._stats.measure('cull', self):
+                self._cull()
+        finally:
+            self._culls.done()
+
     def _cull(self, frequency=None):
         if frequency is None:
             frequency = self._cull_frequency
@@ -180,35 +1736,230 @@ class AmazonS3Cache(BaseCache):
         if not self._max_entries:
             return
 
-        if int(self._num_entries) < self._max_entries:
-            return
-
         try:
-            keylist = self._storage.bucket.get_all_keys(prefix=self._location)
-        except (IOError, OSError):
-            return
+            num_entries = int(self._num_entries)
+            self._culls.count = num_entries
+            if num_entries < self._max_entries:
+                return
 
-        if not frequency:
-            doomed = keylist
-        else:
-            doomed = [k for (i, k) in enumerate(keylist) if i % frequency == 0]
+            deleted = 0
+            for storage in self._storages:
+                pages = self._iter_key_pages(storage=storage)
+                if self._packer is not None:
+                    # segments are shared by many keys, see compact()
+                    segments = self._key_name(SEGMENT_DIR + '/')
+                    pages = ([k for k in page if not k.name.startswith(segments)]
+                             for page in pages)
+                # every bucket culls its own copies
+                deleted += self._delete_listed(pages, frequency, storage)
+            self._culls.count = num_entries - deleted // self._replicas
+        except (IOError, OSError) as err:
+            self._stats.error('cull', err)
 
-        try:
-            self._storage.bucket.delete_keys(doomed, quiet=True)
-        except (IOError, OSError):
-            pass
+    def _iter_key_pages(self, prefix=None, storage=None):
+        """
+            Yields the keys of the cache in the first bucket, or in storage,
+            or those under prefix if given, one page at a time. With SHARDS
+            the next page of every shard is requested in parallel.
+        """
+        if prefix is not None:
+            return self._iter_prefix_pages(prefix, storage)
 
+        prefixes = self._list_prefixes()
+        if len(prefixes) == 1:
+            return self._iter_prefix_pages(prefixes[0], storage)
+        return self._iter_shard_pages(prefixes, storage)
 
-    def _get_num_entries(self):
+    def _iter_prefix_pages(self, prefix, storage=None):
         """
-            There seems to be an artificial limit of 1000
+            Amazon returns at most 1000 keys for a single listing request, see
+            http://docs.aws.amazon.com/AmazonS3/latest/API/RESTBucketGET.html
+            The next page is requested with the last key seen as marker.
         """
-        return len(self._storage.bucket.get_all_keys(prefix=self._location))
+        bucket = (storage or self._storage).bucket
+        marker = ''
+        while True:
+            page = bucket.get_all_keys(prefix=prefix, marker=marker)
+            if not page:
+                return
+
+            yield page
+
+            if not getattr(page, 'is_truncated', False):
+                return
+            marker = page[-1].name
+
+    def _iter_shard_pages(self, prefixes, storage=None):
+        listings = [self._iter_prefix_pages(prefix, storage) for prefix in prefixes]
+        while listings:
+            pages = self._map(lambda listing: next(listing, None), listings)
+            listings = [l for (l, page) in zip(listings, pages) if page is not None]
+            for page in pages:
+                if page is not None:
+                    yield page
+
+    def _delete_listed(self, pages, frequency=0, storage=None):
+        """
+            Deletes every frequency-th key of the listed pages or all of them
+            if frequency is 0. Every page becomes a multi-object delete request
+            sent on the worker pool while the next page is being listed.
+            At most MAX_WORKERS pages are held in memory.
+
+            Returns the number of deleted keys.
+        """
+        bucket = (storage or self._storage).bucket
+        pending = []
+        deleted = 0
+        position = 0
+        try:
+            for page in pages:
+                if frequency:
+                    doomed = [k for (i, k) in enumerate(page, position) if i % frequency == 0]
+                else:
+                    doomed = list(page)
+                position += len(page)
+                if not doomed:
+                    continue
+
+                if self._max_workers < 2:
+                    bucket.delete_keys(doomed, quiet=True)
+                else:
+                    pending.append(self._executor.submit(bucket.delete_keys, doomed, quiet=True))
+                    while len(pending) > self._max_workers:
+                        pending.pop(0).result()
+                deleted += len(doomed)
+        finally:
+            errors = []
+            for future in pending:
+                if future.exception() is not None:
+                    errors.append(future.exception())
+        if errors:
+            raise errors[0]
+        return deleted
+
+    def _get_num_entries(self):
+        objects = sum(len(page) for storage in self._storages
+                      for page in self._iter_key_pages(storage=storage))
+        return objects // self._replicas
     _num_entries = property(_get_num_entries)
 
     def clear(self):
-        # delete all keys
-        self._cull(0)
+        with self._stats.measure('clear', self):
+            if self._write_behind is not None:
+                self._write_behind.clear()
+
+            if self._local is not None:
+                self._local.clear()
+            if self._disk is not None:
+                self._disk.clear()
+            if self._misses is not None:
+                self._misses.clear()
+            if self._counters is not None:
+                self._counters.clear()
+            if self._bloom is not None:
+                self._bloom.reset()
+            if self._packer is not None:
+                self._packer.clear()
+
+            if self._generations:
+                self._new_generation()
+                return
+
+            # delete all keys
+            try:
+                for storage in self._storages:
+                    self._delete_listed(self._iter_key_pages(storage=storage), storage=storage)
+                if self._packer is not None and self._shards:
+                    # not below any of the shard prefixes
+                    self._delete_listed(self._iter_prefix_pages(
+                        self._key_name(self._segment_dir())))
+                self._culls.count = 0
+            except (IOError, OSError) as err:
+                self._stats.error('clear', err)
+
+    def stats(self):
+        """
+            Returns the metrics collected by the cache instances of the
+            process with the same bucket and location since the first one
+            was created or since reset_stats(), see README.rst
+        """
+        return self._stats.as_dict()
+
+    def reset_stats(self):
+        self._stats.reset()
+
+    def compact(self, min_garbage=0.5):
+        """
+            Rewrites the segments of PACKED mode in which at least
+            min_garbage of the bytes belong to expired, overwritten or
+            deleted values and merges small segments. Returns the number
+            of bytes reclaimed. Does nothing unless PACKED is enabled.
+        """
+        if self._packer is None:
+            return 0
+
+        try:
+            return self._packer.compact(min_garbage)
+        except (IOError, OSError, EOFError, pickle.PickleError) as err:
+            self._stats.error('set', err)
+            return 0
+
+    def _new_generation(self):
+        """
+            Starts a new generation with a single PUT. Keys of older
+            generations are no longer visible and are deleted by sweep().
+        """
+        try:
+            # a failed read must not start an older generation again
+            generation = self._read_generation() + 1
+            self._storage.save(GENERATION_FILE, ContentFile(str(generation).encode('ascii')))
+        except (IOError, OSError, ValueError) as err:
+            self._stats.error('clear', err)
+            return
+
+        self._generation = (generation, time.time())
+        self._culls.count = 0
+
+    def sweep(self):
+        """
+            Deletes the keys of older generations left behind by clear().
+            Does nothing unless GENERATIONS is enabled.
+        """
+        if not self._generations:
+            return
+
+        # always read the generation from S3, another process may have
+        # started a newer one and its keys must not be deleted
+        try:
+            current = self._read_generation()
+        except (IOError, OSError, ValueError):
+            return
+        root = self._key_name('')
+
+        def _is_orphan(key):
+            name = key.name[len(root):]
+            if name == GENERATION_FILE:
+                return False
+            parts = name.split('/')
+            if parts[0] == SEGMENT_DIR:
+                # segments/<generation>/<segment>
+                parts = parts[1:]
+            elif self._shards:
+                # <shard>/<generation>/<sha1>, everything else is left
+                # over from before SHARDS was set
+                if len(parts) != 3:
+                    return True
+                parts = parts[1:]
+            generation = parts[0]
+            return len(parts) < 2 or not generation.isdigit() or int(generation) < current
+
+        try:
+            for storage in self._storages:
+                pages = ([k for k in page if _is_orphan(k)]
+                         for page in self._iter_key_pages(self._location, storage))
+                self._delete_listed(pages, storage=storage)
+        except (IOError, OSError):
+            pass
 
 # For backwards compatibility
 class CacheClass(AmazonS3Cache):
@@ -0,0 +1,381 @@
+"asyncio support for the Amazon S3 cache backend"
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import asyncio
+import functools
+from io import BytesIO
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+    from botocore.exceptions import BotoCoreError, ClientError
+    _CLIENT_ERRORS = (BotoCoreError, ClientError, IOError, OSError)
+except ImportError:
+    get_session = None
+    _CLIENT_ERRORS = (IOError, OSError)
+
+from s3cache.storage import DELETE_CHUNK_SIZE, EXPIRY_METADATA, FRESH_METADATA
+
+# the pickled expiry timestamp at the start of the body fits in this many bytes
+_EXPIRY_RANGE = 'bytes=0-63'
+
+
+def _split_body(body):
+    """
+        Returns the expiry timestamp at the start of body
+        and the encoded value which follows it.
+    """
+    fobj = BytesIO(body)
+    exp = pickle.load(fobj)
+    return exp, fobj.read()
+
+
+def _is_missing(err):
+    """
+        Returns True if err means the object doesn't exist
+    """
+    response = getattr(err, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in ('NoSuchKey', '404')
+
+
+def _metadata_expiry(metadata):
+    return _metadata_float(metadata, EXPIRY_METADATA)
+
+
+def _metadata_float(metadata, name):
+    try:
+        return float(metadata[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class AsyncCacheMixin(object):
+    """
+        Native asyncio versions of the cache methods for AmazonS3Cache.
+
+        When aiobotocore is installed requests are sent by a non-blocking
+        client, one per event loop, with its own connection pool of
+        ASYNC_MAX_CONNECTIONS. Keys and values use the same names and format
+        as the blocking methods. Without aiobotocore the blocking methods
+        are called on the worker pool, so are writes with WRITE_BEHIND
+        because they only have to be queued.
+    """
+    async def _run_sync(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def _aclient(self):
+        loop = asyncio.get_event_loop()
+        future = self._aclients.get(loop)
+        if future is None:
+            future = loop.create_task(self._create_aclient())
+            self._aclients[loop] = future
+
+        try:
+            return await future
+        except Exception:
+            self._aclients.pop(loop, None)
+            raise
+
+    async def _create_aclient(self):
+        storage = self._storage
+        endpoint_url = None
+        if storage.host != storage.connection_class.DefaultHost:
+            endpoint_url = '%s://%s' % ('https' if storage.use_ssl else 'http', storage.host)
+            if storage.port:
+                endpoint_url += ':%d' % storage.port
+
+        config = AioConfig(max_pool_connections=int(self._get_option('ASYNC_MAX_CONNECTIONS', 50)))
+        creator = get_session().create_client(
+            's3',
+            region_name=self._get_option('REGION_NAME'),
+            endpoint_url=endpoint_url,
+            aws_access_key_id=storage.access_key,
+            aws_secret_access_key=storage.secret_key,
+            aws_session_token=storage.security_token,
+            config=config,
+        )
+        return await creator.__aenter__()
+
+    async def aclose(self):
+        """
+            Closes the non-blocking client of the running event loop
+        """
+        future = self._aclients.pop(asyncio.get_event_loop(), None)
+        if future is not None:
+            client = await future
+            await client.close()
+
+    async def _ageneration_unknown(self):
+        # reading the generation blocks so do it on the worker pool
+        if self._generations and self._generation_expired():
+            await self._run_sync(self._get_generation)
+        return self._generation_unknown()
+
+    async def _amaybe_cull(self, writes=1):
+        if not self._max_entries or not self._culls.due(self._max_entries, writes):
+            return
+
+        if self._cull_in_background or self._culls.count is None:
+            self._executor.submit(self._run_cull)
+        else:
+            await self._run_sync(self._run_cull)
+
+    def _put_object_args(self, fname, body, metadata):
+        storage = self._storage
+        args = {
+            'Bucket': storage.bucket_name,
+            'Key': self._key_name(fname),
+            'Body': body,
+            'ContentType': storage.key_class.DefaultContentType,
+            'Metadata': metadata,
+        }
+        if storage.default_acl:
+            args['ACL'] = storage.default_acl
+        if storage.reduced_redundancy:
+            args['StorageClass'] = 'REDUCED_REDUNDANCY'
+        if storage.encryption:
+            args['ServerSideEncryption'] = 'AES256'
+        return args
+
+    async def aadd(self, key, value, timeout=None, version=None):
+        if await self._ageneration_unknown() or await self.ahas_key(key, version=version):
+            return False
+
+        await self.aset(key, value, timeout, version=version)
+        return True
+
+    async def aget(self, key, default=None, version=None):
+        if get_session is None or self._packer is not None or self._disk is not None or \
+           self._ring is not None:
+            return await self._run_sync(self.get, key, default, version=version)
+
+        with self._stats.measure('get', self):
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+
+            missing = object()
+            value = missing
+            if not await self._ageneration_unknown():
+                value = await self._aget(self._key_to_fname(key), missing)
+            if value is missing:
+                self._stats.incr('misses')
+                return default
+            self._stats.incr('hits')
+            return value
+
+    async def _aget(self, fname, default):
+        if self._write_behind is not None:
+            entry = self._write_behind.get(fname)
+            if entry is not None:
+                return self._pending_value(entry, default)
+
+        if self._local is not None:
+            payload = self._local.get(fname)
+            if payload is not None:
+                return self._codec.loads(payload)
+
+        if self._known_missing(fname):
+            return default
+
+        try:
+            client = await self._aclient()
+            response = await client.get_object(Bucket=self._storage.bucket_name,
+                                               Key=self._key_name(fname))
+            body = response['Body']
+            try:
+                exp = _metadata_expiry(response.get('Metadata'))
+                if exp is not None and self._has_expired(exp, fname):
+                    return default
+
+                body_exp, payload = _split_body(await body.read())
+                self._stats.incr('bytes_read', len(payload))
+                if exp is None:
+                    exp = body_exp
+                    if self._has_expired(exp, fname):
+                        return default
+
+                value = self._codec.loads(payload)
+                if self._local is not None:
+                    # stale values are always read from S3 to notice they are stale
+                    fresh_until = _metadata_float(response.get('Metadata'), FRESH_METADATA)
+                    self._local.set(fname, fresh_until or exp, payload)
+                return value
+            finally:
+                body.close()
+        except _CLIENT_ERRORS + (EOFError, pickle.PickleError) as err:
+            if _is_missing(err):
+                self._remember_miss(fname)
+            else:
+                self._stats.error('get', err)
+            return default
+
+    async def aget_many(self, keys, version=None):
+        keys = list(keys)
+        missing = object()
+        values = await asyncio.gather(*[self.aget(key, missing, version=version) for key in keys])
+        return dict((k, v) for (k, v) in zip(keys, values) if v is not missing)
+
+    async def aset(self, key, value, timeout=None, version=None):
+        if get_session is None or self._write_behind is not None or self._packer is not None or \
+           self._ring is not None:
+            return await self._run_sync(self.set, key, value, timeout, version=version)
+
+        with self._stats.measure('set', self):
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            if await self._ageneration_unknown():
+                return
+
+            fname = self._key_to_fname(key)
+
+            await self._amaybe_cull()
+
+            await self._aset(fname, value, timeout)
+
+    async def aset_many(self, data, timeout=None, version=None):
+        if get_session is None or self._write_behind is not None or self._packer is not None or \
+           self._ring is not None:
+            return await self._run_sync(self.set_many, data, timeout, version=version)
+
+        if await self._ageneration_unknown():
+            return list(data)
+
+        items = []
+        for key, value in data.items():
+            made_key = self.make_key(key, version=version)
+            self.validate_key(made_key)
+            items.append((key, self._key_to_fname(made_key), value))
+
+        await self._amaybe_cull(len(items))
+
+        async def _aset(fname, value):
+            with self._stats.measure('set', self):
+                return await self._aset(fname, value, timeout)
+
+        results = await asyncio.gather(*[_aset(fname, value) for (_key, fname, value) in items])
+        return [item[0] for (item, stored) in zip(items, results) if not stored]
+
+    async def _aset(self, fname, value, timeout=None):
+        """
+            Writes value to S3, returns False if it could not be stored.
+        """
+        self._note_write(fname)
+        try:
+            exp, metadata = self._expiry_metadata(timeout)
+            body = self._serialize(value, exp)
+            client = await self._aclient()
+            await client.put_object(**self._put_object_args(fname, body, metadata))
+            self._stats.incr('bytes_written', len(body))
+            return True
+        except _CLIENT_ERRORS + (pickle.PickleError,) as err:
+            self._stats.error('set', err)
+            return False
+        finally:
+            self._drop_local(fname)
+
+    async def atouch(self, key, timeout=None, version=None):
+        # only metadata moves, the blocking version on the worker pool is enough
+        return await self._run_sync(self.touch, key, timeout, version=version)
+
+    async def adelete(self, key, version=None):
+        if get_session is None or self._write_behind is not None or self._packer is not None or \
+           self._ring is not None:
+            return await self._run_sync(self.delete, key, version=version)
+
+        with self._stats.measure('delete', self):
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            if not await self._ageneration_unknown():
+                await self._adelete(self._key_to_fname(key))
+
+    async def _adelete(self, fname):
+        self._drop_counter(fname)
+        try:
+            client = await self._aclient()
+            await client.delete_object(Bucket=self._storage.bucket_name,
+                                       Key=self._key_name(fname))
+        except _CLIENT_ERRORS as err:
+            self._stats.error('delete', err)
+        finally:
+            self._drop_local(fname)
+
+    async def adelete_many(self, keys, version=None):
+        if get_session is None or self._write_behind is not None or self._packer is not None or \
+           self._ring is not None:
+            return await self._run_sync(self.delete_many, keys, version=version)
+
+        with self._stats.measure('delete', self):
+            if await self._ageneration_unknown():
+                return
+            fnames = []
+            for key in keys:
+                key = self.make_key(key, version=version)
+                self.validate_key(key)
+                fnames.append(self._key_to_fname(key))
+                self._drop_counter(fnames[-1])
+
+            names = [{'Key': self._key_name(fname)} for fname in fnames]
+            try:
+                client = await self._aclient()
+                await asyncio.gather(*[
+                    client.delete_objects(Bucket=self._storage.bucket_name,
+                                          Delete={'Objects': names[i:i + DELETE_CHUNK_SIZE],
+                                                  'Quiet': True})
+                    for i in range(0, len(names), DELETE_CHUNK_SIZE)
+                ])
+            except _CLIENT_ERRORS as err:
+                self._stats.error('delete', err)
+            finally:
+                for fname in fnames:
+                    self._drop_local(fname)
+
+    async def ahas_key(self, key, version=None):
+        if get_session is None or self._packer is not None or self._disk is not None or \
+           self._ring is not None:
+            return await self._run_sync(self.has_key, key, version=version)
+
+        with self._stats.measure('has_key', self):
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            if await self._ageneration_unknown():
+                return False
+            fname = self._key_to_fname(key)
+            if self._write_behind is not None:
+                entry = self._write_behind.get(fname)
+                if entry is not None:
+                    return self._pending_exists(entry)
+
+            if self._local is not None and self._local.get(fname) is not None:
+                return True
+
+            if self._known_missing(fname):
+                return False
+
+            bucket_name, name = self._storage.bucket_name, self._key_name(fname)
+            try:
+                client = await self._aclient()
+                response = await client.head_object(Bucket=bucket_name, Key=name)
+                exp = _metadata_expiry(response.get('Metadata'))
+                if exp is None:
+                    # objects written before v1.5 have the expiry only in the body
+                    response = await client.get_object(Bucket=bucket_name, Key=name,
+                                                       Range=_EXPIRY_RANGE)
+                    try:
+                        exp = pickle.load(BytesIO(await response['Body'].read()))
+                    finally:
+                        response['Body'].close()
+            except _CLIENT_ERRORS + (EOFError, pickle.PickleError) as err:
+                if _is_missing(err):
+                    self._remember_miss(fname)
+                else:
+                    self._stats.error('has_key', err)
+                return False
+
+            return not self._has_expired(exp, fname)
@@ -0,0 +1,97 @@
+"Key presence filter for the Amazon S3 cache backend"
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import math
+import time
+import hashlib
+import threading
+
+
+class BloomFilter(object):
+    """
+        Set of strings which may answer that it contains a string which
+        was never added, with probability error_rate as long as no more
+        than capacity strings were added, but never the opposite.
+
+        Bit positions are derived from the md5 digest of a string with
+        double hashing, see Kirsch and Mitzenmacher, "Less Hashing,
+        Same Performance: Building a Better Bloom Filter".
+    """
+    def __init__(self, capacity=100000, error_rate=0.01):
+        capacity = max(int(capacity), 1)
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / float(capacity) * math.log(2))), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, item):
+        digest = hashlib.md5(item.encode('utf-8')).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        positions = self._positions(item)
+        with self._lock:
+            for pos in positions:
+                self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class KeyFilter(object):
+    """
+        BloomFilter of the keys in a bucket which is rebuilt from a listing
+        every refresh seconds, shared by the cache instances of the process.
+        Names added while a new filter is being built are added to both.
+    """
+    def __init__(self, capacity=100000, error_rate=0.01, refresh=300):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh = refresh
+        self.current = None
+        self.building = None
+        self.built_at = 0
+        self._lock = threading.Lock()
+
+    def add(self, name):
+        with self._lock:
+            for bloom in (self.current, self.building):
+                if bloom is not None:
+                    bloom.add(name)
+
+    def is_stale(self):
+        return self.current is None or self.built_at + self.refresh < time.time()
+
+    def start_build(self):
+        """
+            Returns an empty filter to add the listed names to or None
+            if another one is being built already
+        """
+        with self._lock:
+            if self.building is not None:
+                return None
+            self.building = BloomFilter(self.capacity, self.error_rate)
+            return self.building
+
+    def finish_build(self, bloom):
+        """
+            Replaces the current filter with bloom, if the listing failed
+            and bloom is None the current filter is kept for refresh seconds
+        """
+        with self._lock:
+            if bloom is not None:
+                self.current = bloom
+            self.built_at = time.time()
+            self.building = None
+
+    def reset(self):
+        """
+            Starts over with an empty filter, e.g. after the bucket was cleared
+        """
+        with self._lock:
+            self.current = BloomFilter(self.capacity, self.error_rate)
+            self.built_at = time.time()
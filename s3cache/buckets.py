@@ -0,0 +1,80 @@
+"Distribution of keys over several buckets for the Amazon S3 cache backend"
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import bisect
+import hashlib
+import threading
+
+# points of every bucket on the ring, more spread the keys more evenly
+RING_POINTS = 100
+
+# weight of the latest sample in the moving average of the latency
+EWMA_WEIGHT = 0.1
+# a failed request counts as this many seconds so a bucket which
+# fails fast isn't preferred
+FAILURE_LATENCY = 1.0
+# fraction of the reads sent to a random replica so the latency of
+# the others is measured again, e.g. after a region has recovered
+EXPLORE_RATE = 0.02
+
+
+class HashRing(object):
+    """
+        Consistent hashing of sha1 digests onto the buckets named in
+        names. Adding or removing a bucket moves only the keys of that
+        bucket to or from the others, the names rather than the order
+        decide where a key belongs.
+    """
+    def __init__(self, names, points=RING_POINTS):
+        ring = []
+        for index, name in enumerate(names):
+            for point in range(points):
+                digest = hashlib.md5(('%s-%d' % (name, point)).encode('utf-8')).hexdigest()
+                ring.append((int(digest[:8], 16), index))
+        ring.sort()
+        self._positions = [position for (position, _index) in ring]
+        self._indexes = [index for (_position, index) in ring]
+        self.size = len(names)
+
+    def lookup(self, digest, count=1):
+        """
+            Returns the indexes of the count buckets which hold the key of
+            the sha1 hex digest, the first one owns it
+        """
+        count = min(count, self.size)
+        # SHARDS uses the first 8 hex digits already
+        start = bisect.bisect(self._positions, int(digest[8:16], 16))
+        found = []
+        for offset in range(len(self._indexes)):
+            index = self._indexes[(start + offset) % len(self._indexes)]
+            if index not in found:
+                found.append(index)
+                if len(found) == count:
+                    break
+        return found
+
+
+class LatencyAverage(object):
+    """
+        Exponentially weighted moving average of the response times of
+        a bucket, shared by the connections of the process
+    """
+    def __init__(self, weight=EWMA_WEIGHT):
+        self.weight = weight
+        self._value = None
+        self._lock = threading.Lock()
+
+    def record(self, duration):
+        with self._lock:
+            if self._value is None:
+                self._value = duration
+            else:
+                self._value += self.weight * (duration - self._value)
+
+    def value(self):
+        """
+            Returns the average in seconds or 0 before the first response
+            so a bucket which hasn't been used yet is tried
+        """
+        return self._value or 0.0
@@ -0,0 +1,95 @@
+"Batched counters for the Amazon S3 cache backend"
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import atexit
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class CounterBuffer(object):
+    """
+        Increments of counters added up in memory, shared by the cache
+        instances of the process so all threads see the same value.
+
+        A counter is known after seed() has recorded the value read from
+        S3, add() then returns that value plus the increments since. The
+        increments are passed to write(name, delta) at most interval
+        seconds after the first one, by flush() and when the interpreter
+        exits. Write errors are passed to error(err).
+    """
+    def __init__(self, interval, write, error):
+        self.interval = interval
+        self._write = write
+        self._error = error
+        self._counters = {}
+        self._timer = None
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def seed(self, name, value):
+        with self._lock:
+            self._counters.setdefault(name, [value, 0])
+
+    def add(self, name, delta):
+        """
+            Returns the value of name including delta or None if it
+            hasn't been seeded
+        """
+        with self._lock:
+            counter = self._counters.get(name)
+            if counter is None:
+                return None
+            counter[1] += delta
+
+            if self._timer is None:
+                self._timer = threading.Timer(self.interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+            return counter[0] + counter[1]
+
+    def drop(self, name):
+        """
+            Forgets the increments of name which haven't been written
+            because its value is being replaced
+        """
+        if self._counters:
+            with self._lock:
+                self._counters.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+
+    def flush(self):
+        """
+            Writes the increments added up since the last flush. Counters
+            are seeded again by the next incr() so changes made by other
+            processes become visible.
+        """
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        for name, (_value, delta) in counters.items():
+            if not delta:
+                continue
+            try:
+                # a counter which has been deleted meanwhile stays deleted
+                self._write(name, delta)
+            except (IOError, OSError, EOFError, pickle.PickleError) as err:
+                self._error(err)
+
+    def after_fork(self):
+        """
+            Forgets the increments of the parent process, it writes them
+        """
+        self._counters = {}
+        self._timer = None
+        self._lock = threading.Lock()
@@ -0,0 +1,49 @@
+"Culling schedule for the Amazon S3 cache backend"
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import threading
+
+
+class CullSchedule(object):
+    """
+        Estimate of the number of entries in the bucket which decides when
+        it is listed again, shared by the cache instances of the process.
+
+        Listing the bucket costs more than the write itself so the number
+        of entries is estimated by counting writes and the bucket is listed
+        only when the estimate reaches max_entries or after every writes,
+        whichever comes first. The estimate treats every write as a new
+        entry so it errs on the high side. count is None until the bucket
+        has been listed once.
+    """
+    def __init__(self, every=100):
+        self.every = every
+        self.count = None
+        self.running = False
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def due(self, max_entries, writes=1):
+        """
+            Returns True if the caller has to list the bucket and call
+            done() afterwards. Only one caller of the process at a time
+            gets True.
+        """
+        with self._lock:
+            if self.running:
+                return False
+
+            self._writes += writes
+            if self.count is not None:
+                self.count += writes
+                if self.count < max_entries and self._writes < self.every:
+                    return False
+
+            self.running = True
+            return True
+
+    def done(self):
+        with self._lock:
+            self.running = False
+            self._writes = 0
@@ -0,0 +1,221 @@
+"Local disk tier for the Amazon S3 cache backend"
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import os
+import time
+import hashlib
+import tempfile
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+TMP_PREFIX = '.tmp-'
+LOCK_FILE = '.lock'
+# eviction stops when the directory is this much below max_bytes
+EVICT_TO = 0.9
+# temporary files older than this many seconds are left over from a crash
+TMP_MAX_AGE = 300
+
+
+class DiskCache(object):
+    """
+        Values read from S3 kept in files under path so they survive
+        restarts and are shared by the processes of the same host.
+
+        Every file holds the pickled (etag, expiry, fresh_until, delta)
+        of the object followed by the encoded value. Files are written
+        to a temporary name and renamed so readers never see a partial
+        file. The modification time of a file is when its ETag was last
+        confirmed by S3, the access time when it was last read.
+
+        namespace - distinguishes caches which share path, e.g. the bucket
+                    and location;
+        max_bytes - maximum total size of the files, 0 means no limit. The
+                    least recently read files are deleted when a process
+                    has written enough to exceed it;
+        timeout - for how many seconds an entry is served without asking
+                  S3 whether it changed, None means until it expires.
+    """
+    def __init__(self, path, namespace='', max_bytes=0, timeout=60):
+        self.path = path
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        # estimate of the total size, counted when eviction is first due
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, name):
+        """
+            Returns (payload, etag, expiry, fresh_until, delta, current)
+            of name, current is False if it has to be revalidated, or
+            None if there is no entry or it has expired.
+        """
+        path = self._path(name)
+        try:
+            with open(path, 'rb') as fobj:
+                etag, exp, fresh_until, delta = pickle.load(fobj)
+                payload = fobj.read()
+                stat = os.fstat(fobj.fileno())
+        except FileNotFoundError:
+            return None
+        except (IOError, OSError, EOFError, ValueError, pickle.PickleError):
+            self._unlink(path)
+            return None
+
+        now = time.time()
+        if exp < now:
+            self._unlink(path)
+            return None
+
+        current = self.timeout is None or stat.st_mtime + self.timeout >= now
+        try:
+            # the access time records the read even on noatime mounts
+            os.utime(path, (now, stat.st_mtime))
+        except OSError:
+            pass
+        return payload, etag, exp, fresh_until, delta, current
+
+    def set(self, name, etag, exp, fresh_until, delta, payload):
+        header = pickle.dumps((etag, exp, fresh_until, delta), pickle.HIGHEST_PROTOCOL)
+        size = len(header) + len(payload)
+        if self.max_bytes and size > self.max_bytes:
+            return
+
+        path = self._path(name)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            handle, tmp_path = tempfile.mkstemp(prefix=TMP_PREFIX, dir=directory)
+            try:
+                with os.fdopen(handle, 'wb') as fobj:
+                    fobj.write(header)
+                    fobj.write(payload)
+                os.replace(tmp_path, path)
+            except BaseException:
+                self._unlink(tmp_path)
+                raise
+        except (IOError, OSError):
+            # a full or read-only disk only costs the S3 request
+            return
+
+        if self.max_bytes:
+            with self._lock:
+                if self._size is not None:
+                    self._size += size
+                due = self._size is None or self._size > self.max_bytes
+            if due:
+                self.evict()
+
+    def revalidated(self, name):
+        """
+            Records that S3 confirmed the ETag of name just now
+        """
+        try:
+            os.utime(self._path(name))
+        except OSError:
+            pass
+
+    def delete(self, name):
+        self._unlink(self._path(name))
+
+    def clear(self):
+        """
+            Deletes the files of every namespace under path
+        """
+        for path, _stat in self._scan():
+            self._unlink(path)
+        with self._lock:
+            self._size = 0
+
+    def evict(self):
+        """
+            Deletes the least recently read files until their total size is
+            below max_bytes. Only one process of the host evicts at a time,
+            the others carry on.
+        """
+        lock = self._acquire()
+        if lock is False:
+            with self._lock:
+                self._size = int(self.max_bytes * EVICT_TO)
+            return
+        try:
+            files = []
+            total = 0
+            now = time.time()
+            for path, stat in self._scan(include_tmp=True):
+                if os.path.basename(path).startswith(TMP_PREFIX):
+                    if stat.st_mtime + TMP_MAX_AGE < now:
+                        self._unlink(path)
+                    continue
+                files.append((stat.st_atime, stat.st_size, path))
+                total += stat.st_size
+
+            if total > self.max_bytes:
+                files.sort()
+                for _atime, size, path in files:
+                    if total <= self.max_bytes * EVICT_TO:
+                        break
+                    self._unlink(path)
+                    total -= size
+        finally:
+            if lock is not None:
+                lock.close()
+
+        with self._lock:
+            self._size = total
+
+    def _path(self, name):
+        digest = hashlib.sha1(('%s/%s' % (self.namespace, name)).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def _scan(self, include_tmp=False):
+        try:
+            directories = [entry for entry in os.scandir(self.path) if entry.is_dir()]
+        except OSError:
+            return
+        for directory in directories:
+            try:
+                entries = list(os.scandir(directory.path))
+            except OSError:
+                continue
+            for entry in entries:
+                if not include_tmp and entry.name.startswith(TMP_PREFIX):
+                    continue
+                try:
+                    yield entry.path, entry.stat()
+                except OSError:
+                    # deleted by another process
+                    continue
+
+    def _acquire(self):
+        """
+            Returns the open lock file, None if locking isn't supported
+            or False if another process holds the lock
+        """
+        if fcntl is None:
+            return None
+        lock = open(os.path.join(self.path, LOCK_FILE), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return False
+        return lock
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
@@ -0,0 +1,48 @@
+"Request coalescing for the Amazon S3 cache backend"
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+        Makes sure a function runs at most once at a time for the same name
+        in this process. Callers which arrive while it is running wait for
+        it and get the same result, or the same exception.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, name, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(name)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[name] = call
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[name]
+            call.event.set()
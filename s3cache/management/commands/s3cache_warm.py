@@ -0,0 +1,70 @@
+"Warms up an Amazon S3 cache with a batch of known keys"
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import sys
+import json
+
+from django.core.cache import caches, InvalidCacheBackendError
+from django.core.management.base import BaseCommand, CommandError
+
+from s3cache import AmazonS3Cache
+
+
+class Command(BaseCommand):
+    help = ('Reads the keys listed in FILE, one per line, into the DISK_PATH tier of the cache. '
+            'With --values FILE holds a JSON object whose values are stored in S3 instead.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', nargs='?', default='-',
+                            help='file to read, standard input by default')
+        parser.add_argument('--cache', default='default',
+                            help='name of the cache in CACHES, default %(default)s')
+        parser.add_argument('--values', action='store_true',
+                            help='store the keys and values of a JSON object with warm()')
+        parser.add_argument('--timeout', type=float,
+                            help='timeout of the stored values, the default of the cache if not given')
+        parser.add_argument('--key-version', type=int,
+                            help='version of the keys, the VERSION of the cache by default')
+        parser.add_argument('--rate', type=float,
+                            help='requests per second, WARM_RATE of the cache by default')
+
+    def handle(self, *args, **options):
+        try:
+            cache = caches[options['cache']]
+        except InvalidCacheBackendError as err:
+            raise CommandError(str(err))
+        if not isinstance(cache, AmazonS3Cache):
+            raise CommandError('%s is not an AmazonS3Cache' % options['cache'])
+        if not options['values'] and cache._disk is None:  # pylint: disable=protected-access
+            # the tier in memory ends with the command
+            raise CommandError('Reading keys needs DISK_PATH, %s has none' % options['cache'])
+
+        if options['file'] == '-':
+            content = sys.stdin.read()
+        else:
+            try:
+                with open(options['file']) as source:
+                    content = source.read()
+            except (IOError, OSError) as err:
+                raise CommandError(str(err))
+
+        if options['values']:
+            try:
+                data = json.loads(content)
+            except ValueError as err:
+                raise CommandError('Invalid JSON: %s' % err)
+            if not isinstance(data, dict):
+                raise CommandError('Expected a JSON object of keys and values')
+
+            failed = cache.warm(data, timeout=options['timeout'], version=options['key_version'],
+                                rate=options['rate'])
+            cache.flush()
+            self.stdout.write('Stored %d of %d keys' % (len(data) - len(failed), len(data)))
+            for key in failed:
+                self.stderr.write('Failed to store %s' % key)
+            return
+
+        keys = [line.strip() for line in content.splitlines() if line.strip()]
+        found = cache.prefetch(keys, version=options['key_version'], rate=options['rate'])
+        self.stdout.write('Found %d of %d keys' % (found, len(keys)))
@@ -0,0 +1,90 @@
+"In-process memory tier for the Amazon S3 cache backend"
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class LocalCache(object):
+    """
+        Bounded LRU kept in front of S3 by AmazonS3Cache.
+
+        Entries are stored as the serialized payload read from S3 together
+        with the expiry timestamp written by _dump_object(). Keeping bytes
+        instead of live objects makes the byte limit exact and avoids
+        handing out the same mutable object to different callers.
+
+        max_entries - maximum number of entries, 0 means no limit;
+        max_bytes - maximum total size of payloads, 0 means no limit;
+        timeout - how many seconds an entry may be served locally before it
+                  has to be read from S3 again, None means until it expires.
+    """
+    def __init__(self, max_entries=0, max_bytes=0, timeout=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def size(self):
+        """
+            Total size of the payloads currently held in memory
+        """
+        return self._size
+
+    def get(self, name, default=None):
+        """
+            Returns the payload stored under name or default if it is
+            missing, expired or has been held longer than timeout.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._data.pop(name, None)
+            if entry is None:
+                return default
+
+            expiry, stored_at, payload = entry
+            if expiry < now or \
+               (self.timeout is not None and stored_at + self.timeout < now):
+                self._size -= len(payload)
+                return default
+
+            # re-insert to mark as most recently used
+            self._data[name] = entry
+            return payload
+
+    def set(self, name, expiry, payload):
+        with self._lock:
+            self._pop(name)
+
+            if self.max_bytes and len(payload) > self.max_bytes:
+                return
+
+            self._data[name] = (expiry, time.time(), payload)
+            self._size += len(payload)
+
+            while (self.max_entries and len(self._data) > self.max_entries) or \
+                  (self.max_bytes and self._size > self.max_bytes):
+                _name, (_exp, _stored_at, _payload) = self._data.popitem(last=False)
+                self._size -= len(_payload)
+
+    def delete(self, name):
+        with self._lock:
+            self._pop(name)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+    def _pop(self, name):
+        entry = self._data.pop(name, None)
+        if entry is not None:
+            self._size -= len(entry[2])
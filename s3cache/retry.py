@@ -0,0 +1,171 @@
+"Retries of throttled requests, hedged reads and rate limits for the Amazon S3 cache backend"
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import os
+import time
+import random
+import threading
+from collections import deque
+
+# S3 answers 503 Slow Down when it throttles and 500 for internal errors,
+# both are worth another attempt
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# upper bound in seconds of the sleep before a retry
+MAX_BACKOFF = 2.0
+
+# hedging waits for this many samples before it trusts the percentile
+MIN_SAMPLES = 20
+# the percentile is computed again after this many samples
+RECOMPUTE_EVERY = 50
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared(cls, key, *args, **kwargs):
+    """
+        Returns the instance of cls for key which is shared by the cache
+        instances of the process, Django creates one for every thread.
+        Keyword arguments are only passed to cls when the instance is
+        created, unlike args they don't tell instances apart.
+    """
+    with _shared_lock:
+        instance = _shared.get((cls, key) + args)
+        if instance is None:
+            instance = _shared[(cls, key) + args] = cls(*args, **kwargs)
+        return instance
+
+
+def _after_fork():
+    """
+        A child process starts over, e.g. thread pools of the parent
+        have no threads in it
+    """
+    global _shared_lock  # pylint: disable=global-statement
+    _shared_lock = threading.Lock()
+    _shared.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class RetryBudget(object):
+    """
+        Token bucket which allows retries of up to ratio of the requests
+        plus min_per_second retries, so a throttled bucket isn't flooded
+        with retries by every thread of the process at once.
+    """
+    def __init__(self, ratio=0.1, min_per_second=10, max_tokens=100):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = float(max_tokens)
+        self._refilled_at = time.time()
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        """
+            Called for every request which is not a retry
+        """
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """
+            Returns True if a retry is allowed and takes it from the budget
+        """
+        now = time.time()
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens +
+                               (now - self._refilled_at) * self.min_per_second)
+            self._refilled_at = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RateLimiter(object):
+    """
+        Spaces the requests of all threads which call acquire() so no more
+        than rate of them are sent per second, e.g. while warming up a
+        cache. 0 means no limit.
+    """
+    def __init__(self, rate=0):
+        self.rate = rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + 1.0 / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class RetryPolicy(object):
+    """
+        Decides whether a request answered with one of RETRY_STATUSES is
+        sent again. Every request is attempted at most attempts + 1 times,
+        the sleep before the n-th retry is random between 0 and backoff *
+        2 ** n seconds, and retries are taken from budget. on_retry() is
+        called before every retry.
+    """
+    def __init__(self, attempts=3, backoff=0.05, budget=None, on_retry=None):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.budget = budget or RetryBudget()
+        self.on_retry = on_retry
+
+    def backoff_time(self, attempt):
+        return random.uniform(0, min(MAX_BACKOFF, self.backoff * 2 ** attempt))
+
+    def should_retry(self, status, attempt):
+        if attempt == 0:
+            self.budget.deposit()
+        if status not in RETRY_STATUSES or attempt >= self.attempts:
+            return False
+        if not self.budget.withdraw():
+            return False
+        if self.on_retry is not None:
+            self.on_retry()
+        return True
+
+
+class LatencyWindow(object):
+    """
+        Latencies of the last size reads. threshold() returns the given
+        percentile of them, it is computed again every RECOMPUTE_EVERY
+        samples so asking for it on every read is cheap.
+    """
+    def __init__(self, percentile=95, size=1000):
+        self.percentile = percentile
+        self._samples = deque(maxlen=size)
+        self._recorded = 0
+        self._threshold = None
+        self._lock = threading.Lock()
+
+    def record(self, duration):
+        with self._lock:
+            self._samples.append(duration)
+            self._recorded += 1
+            if self._recorded % RECOMPUTE_EVERY == 0 or \
+               (self._threshold is None and self._recorded >= MIN_SAMPLES):
+                ordered = sorted(self._samples)
+                index = int(len(ordered) * self.percentile / 100.0)
+                self._threshold = ordered[min(index, len(ordered) - 1)]
+
+    def threshold(self):
+        """
+            Returns the latency in seconds after which a read is hedged
+            or None until there are enough samples
+        """
+        return self._threshold
+
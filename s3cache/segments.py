@@ -0,0 +1,449 @@
+"Packed storage of small values for the Amazon S3 cache backend"
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import os
+import time
+import atexit
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from s3cache.storage import CacheContentFile
+
+# directory of the segment objects, relative to LOCATION
+SEGMENT_DIR = 'segments'
+DATA_SUFFIX = '.data'
+INDEX_SUFFIX = '.index'
+
+# kinds of index entries
+VALUE = 0
+# the key has been deleted
+DELETED = 1
+# the value is stored in an object of its own
+UNPACKED = 2
+
+
+def new_segment_id():
+    """
+        Segment ids sort in the order the segments were started
+    """
+    return '%014x-%s' % (int(time.time() * 1000000), os.urandom(4).hex())
+
+
+class Segment(object):
+    """
+        Values appended by this process which haven't been uploaded yet.
+        entries maps names to (kind, offset, length, expiry, fresh_until,
+        delta) tuples, the latest entry for a name replaces earlier ones.
+    """
+    def __init__(self, segment_id=None):
+        self.id = segment_id or new_segment_id()
+        self.data = bytearray()
+        self.entries = {}
+
+    def append(self, name, payload, exp, fresh_until=None, delta=None):
+        self.entries[name] = (VALUE, len(self.data), len(payload), exp, fresh_until, delta)
+        self.data.extend(payload)
+
+    def mark(self, name, kind):
+        self.entries[name] = (kind, None, None, None, None, None)
+
+    def read(self, offset, length):
+        return bytes(self.data[offset:offset + length])
+
+    def dump_index(self):
+        return pickle.dumps([(name,) + entry for (name, entry) in self.entries.items()],
+                            pickle.HIGHEST_PROTOCOL)
+
+
+class SegmentStore(object):
+    """
+        Packs values of up to max_value_size bytes into segment objects of
+        about segment_size bytes. Every segment is uploaded as two objects,
+        <id>.data with the values and <id>.index which maps names to
+        (kind, offset, length, expiry, fresh_until, delta) entries. Values
+        are read back with ranged GET requests. Entries of newer segments
+        replace those of older ones.
+
+        A segment is uploaded when it is full or flush_interval seconds
+        after its first entry. Until then its values are only visible to
+        this process. Indexes uploaded by other processes are read every
+        refresh_interval seconds. compact() rewrites segments which are
+        mostly expired or overwritten values.
+
+        Names are relative to the storage location. prefix() returns the
+        directory of the segments, list_keys(directory) the keys in it,
+        delete(names) deletes objects and submit(func, *args) runs func in
+        the background. Upload errors are passed to error(err).
+    """
+    def __init__(self, storage, prefix, list_keys, delete, submit, error,
+                 max_value_size=1024, segment_size=1024 * 1024,
+                 flush_interval=1, refresh_interval=60):
+        self._storage = storage
+        self._prefix = prefix
+        self._list_keys = list_keys
+        self._delete = delete
+        self._submit = submit
+        self._error = error
+        self.max_value_size = max_value_size
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+
+        self._open = None
+        self._sealed = []
+        self._timer = None
+        self._index = {}
+        self._segments = set()
+        self._refreshed_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._uploaded = threading.Condition(self._lock)
+        self._refresh_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def accepts(self, payload):
+        return len(payload) <= self.max_value_size
+
+    def append(self, name, payload, exp, fresh_until=None, delta=None):
+        with self._lock:
+            segment = self._open_segment()
+            segment.append(name, payload, exp, fresh_until, delta)
+            full = len(segment.data) >= self.segment_size
+            if full:
+                self._seal()
+        if full:
+            self._submit(self._upload, segment)
+
+    def mark(self, name, kind):
+        """
+            Records that name has been deleted or is stored elsewhere.
+            The mark is appended even if the index of this process doesn't
+            know name, another process may have packed a value of it since
+            the last refresh which would otherwise hide the change.
+        """
+        with self._lock:
+            self._open_segment().mark(name, kind)
+
+    def get(self, name):
+        """
+            Returns (payload, expiry, fresh_until, delta) of name, DELETED
+            if it has been deleted or expired, None if it isn't packed.
+        """
+        self._maybe_refresh()
+        with self._lock:
+            found = self._find(name)
+        if found is None:
+            return None
+
+        source, (kind, offset, length, exp, fresh_until, delta) = found
+        if kind == UNPACKED:
+            return None
+        if kind == DELETED or exp < time.time():
+            return DELETED
+
+        if isinstance(source, Segment):
+            return source.read(offset, length), exp, fresh_until, delta
+
+        try:
+            payload = self._storage.read_range(self._name(source, DATA_SUFFIX), offset, length)
+        except FileNotFoundError:
+            # compacted by another process, its values are found after a refresh
+            with self._lock:
+                self._forget(set([source]))
+                self._refreshed_at = 0
+            return DELETED
+        return payload, exp, fresh_until, delta
+
+    def contains(self, name):
+        """
+            Same as get() but returns True or False instead of the value
+            or None if name isn't packed
+        """
+        self._maybe_refresh()
+        with self._lock:
+            found = self._find(name)
+        if found is None or found[1][0] == UNPACKED:
+            return None
+        kind, exp = found[1][0], found[1][3]
+        return kind == VALUE and exp >= time.time()
+
+    def flush(self, timeout=None):
+        """
+            Uploads the open segment and waits for the segments being
+            uploaded. Returns False if that didn't happen within timeout
+            seconds.
+        """
+        with self._lock:
+            segment = self._seal()
+        if segment is not None:
+            self._upload(segment)
+        with self._lock:
+            return self._uploaded.wait_for(lambda: not self._sealed, timeout)
+
+    def clear(self):
+        """
+            Forgets all entries, the caller deletes the segments
+        """
+        with self._lock:
+            self._open = None
+            self._index = {}
+            self._segments = set()
+            self._refreshed_at = time.time()
+
+    def after_fork(self):
+        """
+            Forgets the segments which the parent process is filling
+            or uploading, it uploads them
+        """
+        self._open = None
+        self._sealed = []
+        self._timer = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._uploaded = threading.Condition(self._lock)
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self):
+        """
+            Reads the indexes of the segments uploaded since the last
+            refresh and forgets the segments which have been compacted.
+        """
+        with self._lock:
+            known = set(self._segments)
+
+        listed = set(key.name.rsplit('/', 1)[-1][:-len(INDEX_SUFFIX)]
+                     for key in self._list_keys(self._prefix())
+                     if key.name.endswith(INDEX_SUFFIX))
+        loaded = []
+        for segment_id in sorted(listed - known):
+            try:
+                loaded.append((segment_id, self._read_index(segment_id)))
+            except FileNotFoundError:
+                # compacted meanwhile
+                continue
+
+        with self._lock:
+            self._forget(known - listed)
+            for segment_id, entries in loaded:
+                self._merge(segment_id, entries)
+            self._refreshed_at = time.time()
+
+    def compact(self, min_garbage=0.5):
+        """
+            Rewrites segments in which at least min_garbage of the bytes
+            belong to expired, overwritten or deleted values, together
+            with segments which are less than half full, and deletes them.
+            Returns the number of bytes reclaimed.
+
+            Run it from a single process. Other processes don't find the
+            values of the deleted segments until their next refresh.
+        """
+        self.flush()
+
+        sizes = {}
+        for key in self._list_keys(self._prefix()):
+            name = key.name.rsplit('/', 1)[-1]
+            if name.endswith(INDEX_SUFFIX):
+                sizes.setdefault(name[:-len(INDEX_SUFFIX)], 0)
+            elif name.endswith(DATA_SUFFIX):
+                sizes[name[:-len(DATA_SUFFIX)]] = key.size
+
+        indexes = {}
+        for segment_id in sorted(sizes):
+            try:
+                indexes[segment_id] = self._read_index(segment_id)
+            except FileNotFoundError:
+                continue
+
+        latest = {}
+        for segment_id in sorted(indexes):
+            for entry in indexes[segment_id]:
+                latest[entry[0]] = segment_id
+
+        now = time.time()
+        small = []
+        selected = []
+        for segment_id, entries in indexes.items():
+            live = sum(length for (name, kind, _offset, length, exp, _fresh, _delta) in entries
+                       if kind == VALUE and exp >= now and latest[name] == segment_id)
+            if sizes[segment_id] and live <= sizes[segment_id] * (1 - min_garbage):
+                selected.append(segment_id)
+            elif live < self.segment_size / 2:
+                small.append(segment_id)
+        if len(small) > 1 or (small and selected):
+            selected.extend(small)
+        if not selected:
+            return 0
+
+        selected.sort()
+        # names which still have entries in the segments which are kept
+        kept = set(entry[0] for (segment_id, entries) in indexes.items()
+                   if segment_id not in selected for entry in entries)
+
+        # sorts right after the newest selected segment so it doesn't
+        # hide values written after the segments were listed
+        base_id = selected[-1] + '-c'
+        segments = [Segment('%s%04d' % (base_id, 0))]
+        for segment_id in selected:
+            data = None
+            for name, kind, offset, length, exp, fresh_until, delta in indexes[segment_id]:
+                if latest[name] != segment_id:
+                    continue
+                segment = segments[-1]
+                if kind == VALUE and exp >= now:
+                    if data is None:
+                        data = self._read(self._name(segment_id, DATA_SUFFIX))
+                    segment.append(name, data[offset:offset + length], exp, fresh_until, delta)
+                    if len(segment.data) >= self.segment_size:
+                        segments.append(Segment('%s%04d' % (base_id, len(segments))))
+                elif name in kept:
+                    # an older value of name must stay hidden
+                    segment.mark(name, DELETED if kind == VALUE else kind)
+
+        written = 0
+        for segment in segments:
+            if segment.entries:
+                self._write(segment)
+                written += len(segment.data)
+        self._delete([self._name(segment_id, suffix)
+                      for segment_id in selected for suffix in (INDEX_SUFFIX, DATA_SUFFIX)])
+
+        with self._lock:
+            self._forget(set(selected))
+            for segment in segments:
+                if segment.entries:
+                    self._merge(segment.id, [(name,) + entry
+                                             for (name, entry) in segment.entries.items()])
+        return sum(sizes[segment_id] for segment_id in selected) - written
+
+    def _name(self, segment_id, suffix):
+        return self._prefix() + segment_id + suffix
+
+    def _read(self, name):
+        key = self._storage.open_key(name)
+        try:
+            return key.read()
+        finally:
+            key.close()
+
+    def _read_index(self, segment_id):
+        return pickle.loads(self._read(self._name(segment_id, INDEX_SUFFIX)))
+
+    def _write(self, segment):
+        if segment.data:
+            self._storage.save(self._name(segment.id, DATA_SUFFIX),
+                               CacheContentFile(bytes(segment.data)))
+        # the index is written last so readers never find an index without data
+        self._storage.save(self._name(segment.id, INDEX_SUFFIX),
+                           CacheContentFile(segment.dump_index()))
+
+    def _maybe_refresh(self):
+        """
+            The first read waits for the indexes, later refreshes are made
+            in the background
+        """
+        if self._refreshed_at is None:
+            with self._refresh_lock:
+                if self._refreshed_at is None:
+                    self._run_refresh()
+            return
+
+        if self._refreshed_at + self.refresh_interval > time.time():
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        self._submit(self._run_refresh)
+
+    def _run_refresh(self):
+        try:
+            self.refresh()
+        except (IOError, OSError, EOFError, pickle.PickleError) as err:
+            self._error(err)
+            with self._lock:
+                # try again after refresh_interval
+                self._refreshed_at = time.time()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    # the methods below are called with the lock held
+
+    def _find(self, name):
+        """
+            Returns the segment, or segment id, and the latest entry of name
+            or None. Segments which haven't been uploaded come first.
+        """
+        for segment in [self._open] + self._sealed[::-1]:
+            if segment is not None and name in segment.entries:
+                return segment, segment.entries[name]
+        entry = self._index.get(name)
+        if entry is None:
+            return None
+        return entry[0], entry[1:]
+
+    def _open_segment(self):
+        if self._open is None:
+            self._open = Segment()
+            self._timer = threading.Timer(self.flush_interval, self._flush_open, [self._open])
+            self._timer.daemon = True
+            self._timer.start()
+        return self._open
+
+    def _seal(self):
+        segment, self._open = self._open, None
+        if segment is not None:
+            self._timer.cancel()
+            # ids sort in the order the segments were sealed so the latest
+            # entries win over those of segments other processes started later
+            segment.id = new_segment_id()
+            self._sealed.append(segment)
+        return segment
+
+    def _flush_open(self, segment):
+        with self._lock:
+            if self._open is not segment:
+                return
+            self._seal()
+        self._upload(segment)
+
+    def _merge(self, segment_id, entries, listed=True):
+        """
+            listed is False for a segment whose upload failed, refresh()
+            must not forget its entries because it isn't in the bucket
+        """
+        if listed:
+            self._segments.add(segment_id)
+        for entry in entries:
+            current = self._index.get(entry[0])
+            if current is None or current[0] <= segment_id:
+                self._index[entry[0]] = (segment_id,) + tuple(entry[1:])
+
+    def _forget(self, segment_ids):
+        if not segment_ids:
+            return
+        self._segments -= segment_ids
+        self._index = dict((name, entry) for (name, entry) in self._index.items()
+                           if entry[0] not in segment_ids)
+
+    def _upload(self, segment):
+        entries = [(name,) + entry for (name, entry) in segment.entries.items()]
+        uploaded = True
+        try:
+            self._write(segment)
+        except (IOError, OSError) as err:
+            self._error(err)
+            # the values are lost, the deletes still apply to this process
+            entries = [entry for entry in entries if entry[1] != VALUE]
+            uploaded = False
+
+        with self._lock:
+            self._merge(segment.id, entries, uploaded)
+            self._sealed.remove(segment)
+            self._uploaded.notify_all()
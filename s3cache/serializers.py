@@ -0,0 +1,318 @@
+"Serializers and compressors for values stored by the Amazon S3 cache backend"
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import io
+import json
+import lzma
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from django.core.exceptions import ImproperlyConfigured
+
+# Values which are neither pickled nor compressed are stored as plain pickles,
+# same as before v1.5. Everything else starts with MAGIC, a serializer id and
+# a compressor id. Pickles start with the PROTO opcode (0x80) so they never
+# look like a header.
+MAGIC = b'S3C\x01'
+HEADER_SIZE = len(MAGIC) + 2
+
+# size of the chunks copied by the streaming methods
+CHUNK_SIZE = 64 * 1024
+
+
+class PickleSerializer(object):
+    id = 1
+
+    def dumps(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JSONSerializer(object):
+    id = 2
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data.decode('utf-8'))
+
+
+class MsgpackSerializer(object):
+    id = 3
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class RawSerializer(object):
+    """
+        Bytes stored as they are by Codec.dump_stream()
+    """
+    id = 4
+
+    def dumps(self, value):
+        return bytes(value)
+
+    def loads(self, data):
+        return data
+
+
+class ZlibCompressor(object):
+    id = 1
+
+    def __init__(self, level=None):
+        self.level = 6 if level is None else level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+    def compressobj(self):
+        return zlib.compressobj(self.level)
+
+    def decompressobj(self):
+        return zlib.decompressobj()
+
+
+class LzmaCompressor(object):
+    id = 2
+
+    def __init__(self, level=None):
+        self.level = level
+
+    def compress(self, data):
+        return lzma.compress(data, preset=self.level)
+
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+    def compressobj(self):
+        return lzma.LZMACompressor(preset=self.level)
+
+    def decompressobj(self):
+        return lzma.LZMADecompressor()
+
+
+SERIALIZERS = {
+    'pickle': PickleSerializer,
+    'json': JSONSerializer,
+    'msgpack': MsgpackSerializer,
+}
+
+COMPRESSORS = {
+    'zlib': ZlibCompressor,
+    'lzma': LzmaCompressor,
+}
+
+
+class Codec(object):
+    """
+        Turns values into bytes and back.
+
+        serializer - name of the serializer used for writing;
+        compressor - name of the compressor used for writing, None to disable;
+        level - compression level passed to the compressor;
+        min_size - serialized values smaller than this are not compressed.
+
+        Reading doesn't depend on the configuration, every value carries
+        the ids of the serializer and compressor it was written with.
+    """
+    def __init__(self, serializer='pickle', compressor=None, level=None, min_size=1024):
+        if serializer not in SERIALIZERS:
+            raise ImproperlyConfigured('Unknown SERIALIZER %r' % serializer)
+        if serializer == 'msgpack' and msgpack is None:
+            raise ImproperlyConfigured('SERIALIZER msgpack requires the msgpack package')
+        if compressor is not None and compressor not in COMPRESSORS:
+            raise ImproperlyConfigured('Unknown COMPRESSOR %r' % compressor)
+
+        self.serializer = SERIALIZERS[serializer]()
+        self.compressor = COMPRESSORS[compressor](level) if compressor else None
+        self.min_size = min_size
+
+        self._serializers = dict((cls.id, cls()) for cls in SERIALIZERS.values())
+        self._serializers[RawSerializer.id] = RawSerializer()
+        self._compressors = dict((cls.id, cls()) for cls in COMPRESSORS.values())
+
+    def dumps(self, value):
+        try:
+            data = self.serializer.dumps(value)
+        except (TypeError, ValueError) as err:
+            raise pickle.PicklingError(str(err))
+
+        compressor_id = 0
+        if self.compressor is not None and len(data) >= self.min_size:
+            compressed = self.compressor.compress(data)
+            # keep incompressible values as they are
+            if len(compressed) < len(data):
+                data = compressed
+                compressor_id = self.compressor.id
+
+        if compressor_id == 0 and self.serializer.id == PickleSerializer.id:
+            return data
+        return MAGIC + bytearray((self.serializer.id, compressor_id)) + data
+
+    def loads(self, data):
+        if not data.startswith(MAGIC):
+            return pickle.loads(data)
+
+        serializer_id, compressor_id = bytearray(data[len(MAGIC):HEADER_SIZE])
+        data = data[HEADER_SIZE:]
+        try:
+            if compressor_id:
+                data = self._compressors[compressor_id].decompress(data)
+            return self._serializers[serializer_id].loads(data)
+        except (KeyError, TypeError, ValueError, AttributeError,
+                zlib.error, lzma.LZMAError) as err:
+            # unknown ids, corrupted data or msgpack not installed
+            raise pickle.UnpicklingError(str(err))
+
+    def dump(self, value, fileobj):
+        """
+            Same as dumps() but writes to fileobj while the value is being
+            serialized. Pickles are never held in memory as a whole. Values
+            are always compressed if a compressor is configured because
+            their size is not known in advance.
+        """
+        if self.compressor is None and self.serializer.id == PickleSerializer.id:
+            pickle.dump(value, fileobj, pickle.HIGHEST_PROTOCOL)
+            return
+
+        out = self._start(self.serializer, fileobj)
+        if self.serializer.id == PickleSerializer.id:
+            pickle.dump(value, out, pickle.HIGHEST_PROTOCOL)
+        else:
+            try:
+                out.write(self.serializer.dumps(value))
+            except (TypeError, ValueError) as err:
+                raise pickle.PicklingError(str(err))
+        out.flush()
+
+    def dump_stream(self, source, fileobj):
+        """
+            Copies the bytes of source, a file-like object or an iterable
+            of bytes, to fileobj. Read them back with load_stream().
+        """
+        chunks = source
+        if hasattr(source, 'read'):
+            chunks = iter(lambda: source.read(CHUNK_SIZE), b'')
+
+        out = self._start(RawSerializer, fileobj)
+        for chunk in chunks:
+            out.write(chunk)
+        out.flush()
+
+    def _start(self, serializer, fileobj):
+        compressor_id = self.compressor.id if self.compressor is not None else 0
+        fileobj.write(MAGIC + bytearray((serializer.id, compressor_id)))
+        if self.compressor is None:
+            return _Writer(fileobj)
+        return _CompressingWriter(fileobj, self.compressor.compressobj())
+
+    def load(self, fileobj):
+        """
+            Same as loads() but reads from fileobj, which must support peek()
+            like io.BufferedReader. Pickles are read as they are unpickled.
+        """
+        if fileobj.peek(1)[:1] != MAGIC[:1]:
+            return pickle.load(fileobj)
+
+        serializer_id, reader = self._open(fileobj)
+        if serializer_id == PickleSerializer.id:
+            return pickle.load(reader)
+        return self.loads(MAGIC + bytearray((serializer_id, 0)) + reader.read())
+
+    def load_stream(self, fileobj):
+        """
+            Returns a file-like object which reads the bytes written by
+            dump_stream() from fileobj.
+        """
+        serializer_id, reader = self._open(fileobj)
+        if serializer_id != RawSerializer.id:
+            raise pickle.UnpicklingError('Value was not stored as a stream')
+        return reader
+
+    def _open(self, fileobj):
+        header = fileobj.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE or not header.startswith(MAGIC):
+            raise pickle.UnpicklingError('Invalid header')
+
+        serializer_id, compressor_id = bytearray(header[len(MAGIC):])
+        if not compressor_id:
+            return serializer_id, fileobj
+        if compressor_id not in self._compressors:
+            raise pickle.UnpicklingError('Unknown compressor %d' % compressor_id)
+
+        decompressor = self._compressors[compressor_id].decompressobj()
+        return serializer_id, io.BufferedReader(_DecompressingReader(fileobj, decompressor))
+
+
+class _Writer(object):
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def write(self, data):
+        return self._fileobj.write(data)
+
+    def flush(self):
+        pass
+
+
+class _CompressingWriter(_Writer):
+    def __init__(self, fileobj, compressobj):
+        _Writer.__init__(self, fileobj)
+        self._compressobj = compressobj
+
+    def write(self, data):
+        self._fileobj.write(self._compressobj.compress(data))
+        return len(data)
+
+    def flush(self):
+        self._fileobj.write(self._compressobj.flush())
+
+
+class _DecompressingReader(io.RawIOBase):
+    def __init__(self, fileobj, decompressobj):
+        io.RawIOBase.__init__(self)
+        self._fileobj = fileobj
+        self._decompressobj = decompressobj
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self._pending:
+            chunk = self._fileobj.read(CHUNK_SIZE)
+            if not chunk:
+                return 0
+            try:
+                self._pending = self._decompressobj.decompress(chunk)
+            except (zlib.error, lzma.LZMAError) as err:
+                raise pickle.UnpicklingError(str(err))
+
+        size = min(len(buf), len(self._pending))
+        buf[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def close(self):
+        self._fileobj.close()
+        io.RawIOBase.close(self)
@@ -0,0 +1,10 @@
+"Signals sent by the Amazon S3 cache backend"
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+from django.dispatch import Signal
+
+# sent after every measured operation with the keyword arguments
+# cache, operation, duration (seconds) and error (None or the exception
+# which escaped the operation), only when it has receivers
+cache_operation = Signal()
@@ -0,0 +1,128 @@
+"Metrics collected by the Amazon S3 cache backend"
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import time
+import threading
+from bisect import bisect_left
+
+from s3cache.signals import cache_operation
+
+OPERATIONS = ('get', 'set', 'touch', 'incr', 'delete', 'has_key', 'cull', 'clear')
+
+# upper bounds in seconds of the latency histogram buckets,
+# the last bucket counts everything slower
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+COUNTERS = ('hits', 'misses', 'bytes_read', 'bytes_written', 'retries', 'hedges')
+
+
+class _OperationStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.errors = {}
+
+    def percentile(self, fraction):
+        """
+            Returns the upper bound of the bucket which holds the given
+            fraction of the calls, None if it is the open-ended bucket.
+        """
+        if not self.calls:
+            return 0.0
+        rank = fraction * self.calls
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': dict(self.errors),
+            'total_time': self.total,
+            'max_time': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'histogram': list(zip(BUCKETS + (None,), self.buckets)),
+        }
+
+
+class _Measurement(object):
+    __slots__ = ('stats', 'operation', 'sender', 'started')
+
+    def __init__(self, stats, operation, sender):
+        self.stats = stats
+        self.operation = operation
+        self.sender = sender
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.started
+        self.stats.record(self.operation, duration, exc_value)
+        if cache_operation.receivers:
+            cache_operation.send(sender=type(self.sender), cache=self.sender,
+                                 operation=self.operation, duration=duration,
+                                 error=exc_value)
+        return False
+
+
+class CacheStats(object):
+    """
+        Per operation call counts, latency histograms and error counts by
+        exception type together with hit, miss and byte counters. Errors
+        which the cache swallows are counted with error().
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._operations = dict((name, _OperationStats()) for name in OPERATIONS)
+            self._counters = dict((name, 0) for name in COUNTERS)
+
+    def measure(self, operation, sender):
+        """
+            Returns a context manager which records how long its block took
+            and sends the cache_operation signal if anybody listens to it.
+        """
+        return _Measurement(self, operation, sender)
+
+    def record(self, operation, duration, error=None):
+        bucket = bisect_left(BUCKETS, duration)
+        with self._lock:
+            stats = self._operations[operation]
+            stats.calls += 1
+            stats.total += duration
+            stats.max = max(stats.max, duration)
+            stats.buckets[bucket] += 1
+        if error is not None:
+            self.error(operation, error)
+
+    def error(self, operation, error):
+        name = type(error).__name__
+        with self._lock:
+            errors = self._operations[operation].errors
+            errors[name] = errors.get(name, 0) + 1
+
+    def incr(self, counter, value=1):
+        with self._lock:
+            self._counters[counter] += value
+
+    def as_dict(self):
+        with self._lock:
+            result = dict(self._counters)
+            lookups = result['hits'] + result['misses']
+            result['hit_ratio'] = float(result['hits']) / lookups if lookups else None
+            for name, stats in self._operations.items():
+                result[name] = stats.as_dict()
+        return result
@@ -0,0 +1,413 @@
+"S3 storage used by the Amazon S3 cache backend"
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import io
+import os
+import time
+from io import BytesIO
+
+import boto
+from boto.connection import ConnectionPool, HostConnectionPool
+from boto.s3.connection import S3Connection
+from storages.backends import s3boto
+from django.core.files.base import ContentFile
+
+from s3cache.buckets import FAILURE_LATENCY
+from s3cache.retry import RETRY_STATUSES, shared
+
+# maximum number of keys in a single multi-object delete request, see
+# http://docs.aws.amazon.com/AmazonS3/latest/API/multiobjectdeleteapi.html
+DELETE_CHUNK_SIZE = 1000
+
+# minimum size of all but the last part of a multipart upload, see
+# http://docs.aws.amazon.com/AmazonS3/latest/dev/qfacts.html
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# name of the S3 user metadata which holds the expiry timestamp,
+# objects written before v1.5 only have it at the start of the body
+EXPIRY_METADATA = 'cache-expiry'
+
+# with STALE_TIMEOUT or EARLY_EXPIRATION_BETA the time after which a value
+# should be recomputed and how many seconds computing it took last time
+FRESH_METADATA = 'cache-fresh-until'
+DELTA_METADATA = 'cache-delta'
+
+
+class CacheContentFile(ContentFile):
+    """
+        ContentFile which carries user metadata for the S3 object
+        it is saved to.
+    """
+    def __init__(self, content, name=None, metadata=None):
+        ContentFile.__init__(self, content, name=name)
+        self.metadata = metadata or {}
+
+
+class CacheConnectionPool(ConnectionPool):
+    """
+        ConnectionPool which keeps at most max_size idle connections
+        open, the others are closed when they are returned
+    """
+    def __init__(self, max_size=50):
+        ConnectionPool.__init__(self)
+        self.max_size = max_size
+
+    def put_http_connection(self, host, port, is_secure, conn):
+        with self.mutex:
+            if not self.max_size or self.size() < self.max_size:
+                key = (host, port, is_secure)
+                if key not in self.host_to_pool:
+                    self.host_to_pool[key] = HostConnectionPool()
+                self.host_to_pool[key].put(conn)
+                return
+        conn.close()
+
+
+class S3CacheConnection(S3Connection):
+    """
+        S3Connection which asks retry_policy whether to retry responses
+        with a 5xx status. Without one boto retries them up to 6 times
+        and sleeps up to a minute in between.
+
+        Keep-alive connections are kept in a pool of pool_size shared by
+        the S3CacheConnection objects of the process, Django creates a
+        cache, and so a connection, for every thread.
+
+        The response time of every request is recorded in latency when
+        given, see s3cache.buckets.LatencyAverage.
+    """
+    def __init__(self, *args, **kwargs):
+        self.retry_policy = kwargs.pop('retry_policy', None)
+        self.latency = kwargs.pop('latency', None)
+        pool_size = kwargs.pop('pool_size', 50)
+        S3Connection.__init__(self, *args, **kwargs)
+        # the pid keeps a child process from using the sockets of its parent
+        self._pool = shared(CacheConnectionPool, (os.getpid(), self.proxy, self.proxy_port),
+                            pool_size)
+
+    def _mexe(self, request, sender=None, override_num_retries=None, retry_handler=None):
+        # pylint: disable=arguments-differ
+        if retry_handler is None and self.retry_policy is not None:
+            retry_handler = self._retry_handler
+            if override_num_retries is None:
+                # the loop of boto must allow every retry of the policy
+                override_num_retries = max(
+                    self.retry_policy.attempts,
+                    boto.config.getint('Boto', 'num_retries', self.num_retries))
+        if self.latency is None:
+            return S3Connection._mexe(self, request, sender, override_num_retries, retry_handler)
+
+        started = time.perf_counter()
+        try:
+            response = S3Connection._mexe(self, request, sender, override_num_retries,
+                                          retry_handler)
+        except Exception:
+            self.latency.record(max(time.perf_counter() - started, FAILURE_LATENCY))
+            raise
+        self.latency.record(time.perf_counter() - started)
+        return response
+
+    def _retry_handler(self, response, attempt, _next_sleep):
+        """
+            Returns the message, attempt and sleep of the next retry,
+            None for responses which boto handles itself, or raises
+            for 5xx responses which are not retried
+        """
+        if not self.retry_policy.should_retry(response.status, attempt):
+            if response.status in RETRY_STATUSES:
+                raise self.provider.storage_response_error(
+                    response.status, response.reason, response.read())
+            return None
+
+        response.read()
+        sleep = self.retry_policy.backoff_time(attempt)
+        return ('Received %d response, retrying in %.3f seconds' % (response.status, sleep),
+                attempt + 1, sleep)
+
+
+class S3CacheStorage(s3boto.S3BotoStorage):
+    """
+        S3BotoStorage which stores the metadata of CacheContentFile objects
+        as x-amz-meta-* headers of the uploaded key.
+    """
+    connection_class = S3CacheConnection
+    # see s3cache.retry.RetryPolicy
+    retry_policy = None
+    # see s3cache.buckets.LatencyAverage
+    latency = None
+    # the maximum number of idle keep-alive connections of the process
+    pool_size = 50
+    # the process which created the connection
+    _pid = None
+
+    @property
+    def connection(self):
+        """
+            Created on first use, and again in a child process after
+            a fork because it can't share the sockets of its parent
+        """
+        self._check_fork()
+        return s3boto.S3BotoStorage.connection.fget(self)
+
+    @property
+    def bucket(self):
+        self._check_fork()
+        return s3boto.S3BotoStorage.bucket.fget(self)
+
+    def _check_fork(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            if self._pid is not None:
+                self._connection = None
+                self._bucket = None
+            self._pid = pid
+
+    def _get_connection_kwargs(self):
+        kwargs = s3boto.S3BotoStorage._get_connection_kwargs(self)
+        kwargs['retry_policy'] = self.retry_policy
+        kwargs['pool_size'] = self.pool_size
+        kwargs['latency'] = self.latency
+        return kwargs
+
+    def _save(self, name, content):
+        """
+            Same as S3BotoStorage._save() but doesn't look up the key
+            before uploading it. Cache objects are always overwritten
+            and the lookup costs an extra HEAD request for every write.
+        """
+        cleaned_name = self._clean_name(name)
+        name = self._normalize_name(cleaned_name)
+        headers = self.headers.copy()
+        content_type = getattr(content, 'content_type', None) or \
+                       self.key_class.DefaultContentType
+        headers.update({'Content-Type': content_type})
+
+        if self.gzip and content_type in self.gzip_content_types:
+            content = self._compress_content(content)
+            headers.update({'Content-Encoding': 'gzip'})
+
+        content.name = cleaned_name
+        encoded_name = self._encode_name(name)
+        key = self.bucket.new_key(encoded_name)
+        if self.preload_metadata:
+            self._entries[encoded_name] = key
+
+        key.set_metadata('Content-Type', content_type)
+        self._save_content(key, content, headers=headers)
+        return cleaned_name
+
+    def _save_content(self, key, content, headers):
+        for name, value in getattr(content, 'metadata', {}).items():
+            key.set_metadata(name, value)
+        s3boto.S3BotoStorage._save_content(self, key, content, headers)
+
+    def _open(self, name, mode='rb'):
+        """
+            Same as S3BotoStorage._open() but raises FileNotFoundError
+            for missing files so they can be told from failed requests.
+        """
+        name = self._normalize_name(self._clean_name(name))
+        fobj = self.file_class(name, mode, self)
+        if not fobj.key:
+            raise FileNotFoundError('File does not exist: %s' % name)
+        return fobj
+
+    def create(self, name, content):
+        """
+            Same as save() but uploads content only if name doesn't exist,
+            with a conditional PUT. Returns False if it already exists.
+        """
+        # 409 is returned when a concurrent conditional PUT wins the race
+        return self._save_conditional(name, content, {'If-None-Match': '*'}, (409, 412))
+
+    def replace(self, name, content, etag):
+        """
+            Same as save() but uploads content only if name exists and
+            still has the given ETag, with a conditional PUT. Returns
+            False if it doesn't.
+        """
+        # 404 means the object has been deleted meanwhile
+        return self._save_conditional(name, content, {'If-Match': etag}, (404, 409, 412))
+
+    def _save_conditional(self, name, content, condition, conflicts):
+        """
+            Returns False if the PUT fails with one of the conflicts statuses
+        """
+        name = self._normalize_name(self._clean_name(name))
+        key = self.bucket.new_key(self._encode_name(name))
+        headers = self.headers.copy()
+        headers['Content-Type'] = self.key_class.DefaultContentType
+        headers.update(condition)
+        try:
+            self._save_content(key, content, headers=headers)
+        except self.connection_response_error as err:
+            if err.status in conflicts:
+                return False
+            raise
+        return True
+
+    def replace_metadata(self, name, metadata, etag=None):
+        """
+            Replaces the user metadata of name with a server-side copy of
+            the object onto itself, the body is not transferred. With etag
+            the copy is made only if the object still has that ETag.
+            Returns False if the object doesn't exist or has changed.
+        """
+        name = self._encode_name(self._normalize_name(self._clean_name(name)))
+        headers = self.headers.copy()
+        headers['Content-Type'] = self.key_class.DefaultContentType
+        if self.default_acl:
+            headers['x-amz-acl'] = self.default_acl
+        if etag is not None:
+            headers['x-amz-copy-source-if-match'] = etag
+        try:
+            self.bucket.copy_key(
+                name, self.bucket.name, name,
+                metadata=metadata,
+                storage_class='REDUCED_REDUNDANCY' if self.reduced_redundancy else 'STANDARD',
+                encrypt_key=self.encryption,
+                headers=headers,
+            )
+        except self.connection_response_error as err:
+            if err.status in (404, 412):
+                return False
+            raise
+        return True
+
+    def open_key(self, name, etag=None):
+        """
+            Sends a GET request for name and returns its key. Metadata
+            is available right away while the body is read with
+            KeyReader as it is needed. With etag the GET is conditional
+            and None is returned if the object still has that ETag.
+        """
+        name = self._normalize_name(self._clean_name(name))
+        key = self.bucket.new_key(self._encode_name(name))
+        headers = {'If-None-Match': etag} if etag is not None else None
+        try:
+            key.open_read(headers=headers)
+        except self.connection_response_error as err:
+            if err.status == 304:
+                return None
+            if err.status == 404:
+                raise FileNotFoundError('File does not exist: %s' % name)
+            raise
+        return key
+
+    def read_range(self, name, offset, length):
+        """
+            Returns length bytes of name starting at offset
+            with a single ranged GET request
+        """
+        if not length:
+            return b''
+        name = self._normalize_name(self._clean_name(name))
+        key = self.bucket.new_key(self._encode_name(name))
+        headers = {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}
+        try:
+            return key.get_contents_as_string(headers=headers)
+        except self.connection_response_error as err:
+            if err.status == 404:
+                raise FileNotFoundError('File does not exist: %s' % name)
+            raise
+
+    def open_writer(self, name, metadata=None, part_size=MIN_PART_SIZE):
+        return MultipartWriter(self, name, metadata, part_size)
+
+
+class KeyReader(io.RawIOBase):
+    """
+        Readable stream over the body of a key opened by
+        S3CacheStorage.open_key(). Wrap it in io.BufferedReader.
+    """
+    def __init__(self, key):
+        io.RawIOBase.__init__(self)
+        self.key = key
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if not len(buf):
+            return 0
+        data = self.key.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            # don't download the rest of the body to reuse the connection
+            self.key.close(fast=True)
+        io.RawIOBase.close(self)
+
+
+class MultipartWriter(object):
+    """
+        Writable stream which uploads whatever is written to it with
+        a multipart upload, one part every part_size bytes, so at most
+        part_size bytes are held in memory. Data which fits in a single
+        part is uploaded with a plain PUT on close().
+
+        Call abort() instead of close() to discard what was written.
+    """
+    def __init__(self, storage, name, metadata=None, part_size=MIN_PART_SIZE):
+        self._storage = storage
+        self._name = name
+        self._metadata = metadata or {}
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self._buffer = bytearray()
+        self._upload = None
+        self._parts = 0
+        self.closed = False
+
+    def write(self, data):
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, data):
+        storage = self._storage
+        if self._upload is None:
+            name = storage._normalize_name(storage._clean_name(self._name))
+            headers = storage.headers.copy()
+            headers['Content-Type'] = storage.key_class.DefaultContentType
+            self._upload = storage.bucket.initiate_multipart_upload(
+                storage._encode_name(name),
+                headers=headers,
+                reduced_redundancy=storage.reduced_redundancy,
+                metadata=self._metadata,
+                encrypt_key=storage.encryption,
+                policy=storage.default_acl,
+            )
+        self._parts += 1
+        self._upload.upload_part_from_file(BytesIO(data), self._parts)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        if self._upload is None:
+            self._storage.save(self._name, CacheContentFile(bytes(self._buffer),
+                                                            metadata=self._metadata))
+        else:
+            try:
+                if self._buffer:
+                    self._upload_part(bytes(self._buffer))
+                self._upload.complete_upload()
+            except Exception:
+                self._upload.cancel_upload()
+                raise
+        self._buffer = bytearray()
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        if self._upload is not None:
+            self._upload.cancel_upload()
+        self._buffer = bytearray()
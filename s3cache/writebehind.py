@@ -0,0 +1,163 @@
+"Write-behind queue for the Amazon S3 cache backend"
+
+# Copyright (c) 2012,2017 Alexander Todorov <atodorov@MrSenko.com>
+
+import atexit
+import threading
+from collections import OrderedDict
+
+from s3cache.storage import DELETE_CHUNK_SIZE
+
+SET = 'set'
+DELETE = 'delete'
+
+# uploader threads exit after this many seconds without work
+IDLE_TIMEOUT = 60
+
+
+class WriteBehindQueue(object):
+    """
+        Bounded queue of pending writes drained by uploader threads.
+
+        Entries are (SET, expiry, body, metadata) or (DELETE, None, None, None)
+        tuples, at most one per name. A newer entry replaces a pending one for
+        the same name. Entries are handed to write(name, entry) one at a time,
+        deletes are grouped and handed to delete([name, ...]). An entry stays
+        visible to get() until it has been written. Writes of the same name
+        never run concurrently so they reach S3 in order.
+
+        put() returns False when maxsize entries are pending, the caller then
+        writes by itself. Whatever is pending is written on interpreter exit.
+        Uploader threads are started by put() and exit after IDLE_TIMEOUT
+        seconds without work.
+    """
+    def __init__(self, write, delete, maxsize=1000, workers=2):
+        self._write = write
+        self._delete = delete
+        self.maxsize = maxsize
+        self.workers = workers
+        self._pending = OrderedDict()
+        self._inflight = {}
+        self._threads = []
+        self._cond = threading.Condition()
+        atexit.register(self._flush_at_exit)
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending) + len(self._inflight)
+
+    def put(self, name, entry):
+        with self._cond:
+            if name not in self._pending and len(self._pending) >= self.maxsize:
+                return False
+            self._pending[name] = entry
+            self._start()
+            self._cond.notify_all()
+        return True
+
+    def get(self, name):
+        """
+            Returns the entry which is going to be written for name or None
+        """
+        with self._cond:
+            entry = self._pending.get(name)
+            if entry is None:
+                entry = self._inflight.get(name)
+            return entry
+
+    def discard(self, name):
+        with self._cond:
+            self._pending.pop(name, None)
+
+    def clear(self):
+        """
+            Drops all pending entries and waits for those being written
+        """
+        with self._cond:
+            self._pending.clear()
+            while self._inflight:
+                self._cond.wait()
+
+    def flush(self, timeout=None):
+        """
+            Waits until all pending entries are written.
+            Returns False if they were not written within timeout seconds.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._inflight,
+                                       timeout)
+
+    def after_fork(self):
+        """
+            Forgets the entries of the parent process, it writes them
+        """
+        self._pending = OrderedDict()
+        self._inflight = {}
+        self._threads = []
+        self._cond = threading.Condition()
+
+    def _flush_at_exit(self):
+        with self._cond:
+            running = any(thread.is_alive() for thread in self._threads)
+        if running:
+            self.flush()
+
+    def _start(self):
+        # called with the lock held
+        self._threads = [t for t in self._threads if t.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, name='s3cache-write-behind')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _take(self):
+        """
+            Moves the oldest entry which is not being written, together with
+            other pending deletes if it is a delete, to the in-flight entries.
+            Called with the lock held, returns an empty list if there is none.
+        """
+        batch = []
+        for name, entry in self._pending.items():
+            if name in self._inflight:
+                continue
+            if not batch:
+                batch.append((name, entry))
+                if entry[0] != DELETE:
+                    break
+            elif entry[0] == DELETE:
+                batch.append((name, entry))
+                if len(batch) >= DELETE_CHUNK_SIZE:
+                    break
+
+        for name, entry in batch:
+            del self._pending[name]
+            self._inflight[name] = entry
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch = self._take()
+                while not batch:
+                    idle = not self._cond.wait(IDLE_TIMEOUT)
+                    batch = self._take()
+                    if idle and not batch:
+                        # put() starts another thread when there is work again
+                        self._threads.remove(threading.current_thread())
+                        return
+
+            try:
+                name, entry = batch[0]
+                if entry[0] == DELETE:
+                    self._delete([name for (name, _entry) in batch])
+                else:
+                    self._write(name, entry)
+            except Exception:  # pylint: disable=broad-except
+                # same as a synchronous write, failures only mean a cache miss
+                pass
+            finally:
+                with self._cond:
+                    for name, _entry in batch:
+                        del self._inflight[name]
+                    self._cond.notify_all()
@@ -27,10 +27,15 @@ config = {
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
         'Framework :: Django',
     ],
     'zip_safe' : False,
+    'python_requires' : '>=3.5',
     'install_requires' : ['boto', 'django-storages>=1.1.8', 'Django'],
+    'extras_require' : {
+        'async' : ['aiobotocore'],
+    },
 }
 
 if (len(sys.argv) >= 2) and (sys.argv[1] == '--requires'):
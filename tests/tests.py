@@ -1,17 +1,53 @@
 # pylint: disable=missing-docstring,protected-access,invalid-name
 
+import io
+import os
+import pickle
+import shutil
+import asyncio
+import tempfile
+import threading
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from unittest import skipIf
 try:
-    from unittest.mock import patch
+    from unittest.mock import Mock, patch
 except ImportError:
-    from mock import patch
+    from mock import Mock, patch
 import time
-from django.test import TestCase
+from boto.exception import S3ResponseError
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+from storages.backends.s3boto import S3BotoStorage
 
-from s3cache import AmazonS3Cache
+import s3cache.aio
+import s3cache.retry
+from s3cache import AmazonS3Cache, EXPIRY_METADATA, _key_to_file
+from s3cache.bloom import BloomFilter
+from s3cache.buckets import HashRing, LatencyAverage, FAILURE_LATENCY
+from s3cache.disk import DiskCache
+from s3cache.locks import SingleFlight
+from s3cache.memory import LocalCache
+from s3cache.management.commands.s3cache_warm import Command as WarmCommand
+from s3cache.retry import LatencyWindow, RateLimiter, RetryBudget, RetryPolicy, MIN_SAMPLES
+from s3cache.segments import Segment, SegmentStore, DELETED, UNPACKED
+from s3cache.serializers import Codec, MAGIC
+from s3cache.signals import cache_operation
+from s3cache.stats import CacheStats
+from s3cache.storage import CacheConnectionPool, CacheContentFile, KeyReader, S3CacheConnection, \
+    S3CacheStorage, DELTA_METADATA, FRESH_METADATA
+from s3cache.writebehind import WriteBehindQueue, DELETE, SET
 
 class S3CacheTestCase(TestCase):
-    pass
+    def setUp(self):
+        # every test starts without the state shared by the cache
+        # instances of the process, see s3cache.retry.shared()
+        patcher = patch.dict('s3cache.retry._shared', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
 class CacheConfigurationTest(S3CacheTestCase):
     def test_old_style_options(self):
@@ -106,7 +142,7 @@ class CacheConfigurationTest(S3CacheTestCase):
         self.assertEqual(cache._options['bucket_name'], 'bucket_low')
 
 # pylint: disable=no-member,too-many-public-methods
-class FunctionalTests(TestCase):
+class FunctionalTests(S3CacheTestCase):
     def _dump_object(self, value, timeout=None):
         io_obj = BytesIO()
         io_obj.write(self.cache._dump_object(value, timeout))
@@ -114,6 +150,7 @@ class FunctionalTests(TestCase):
         return io_obj
 
     def setUp(self):
+        super(FunctionalTests, self).setUp()
         self.cache = AmazonS3Cache(None, {})
 
     def test_is_expired_with_expired_object(self):
@@ -128,7 +165,7 @@ class FunctionalTests(TestCase):
 
     def test_max_entries_great_than_1000(self):
         cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 1001}})
-        self.assertEqual(cache._max_entries, 1000)
+        self.assertEqual(cache._max_entries, 1001)
 
     def test_max_entries_less_than_1000(self):
         cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 200}})
@@ -213,7 +250,8 @@ class FunctionalTests(TestCase):
                 'get_all_keys.return_value': key_list
             })
             cache.clear()
-            self.assertEqual(_bucket.get_all_keys.call_count, 2)
+            # doesn't count the entries before deleting them
+            self.assertEqual(_bucket.get_all_keys.call_count, 1)
             self.assertEqual(_bucket.delete_keys.call_count, 1)
             # all keys were deleted
             _bucket.delete_keys.assert_called_with(key_list, quiet=True)
@@ -310,3 +348,2937 @@ class FunctionalTests(TestCase):
             cache._cull()
             self.assertEqual(_bucket.get_all_keys.call_count, 2)
             self.assertEqual(_bucket.delete_keys.call_count, 1)
+
+
+class LocalCacheTest(TestCase):
+    def test_get_missing_entry(self):
+        local = LocalCache(max_entries=10)
+        self.assertIsNone(local.get('missing'))
+
+    def test_get_expired_entry(self):
+        local = LocalCache(max_entries=10)
+        local.set('name', time.time() - 1, b'payload')
+        self.assertIsNone(local.get('name'))
+        self.assertEqual(local.size, 0)
+
+    def test_get_entry_held_longer_than_timeout(self):
+        local = LocalCache(max_entries=10, timeout=0)
+        local.set('name', time.time() + 10, b'payload')
+        time.sleep(0.01)
+        self.assertIsNone(local.get('name'))
+
+    def test_evicts_least_recently_used_entry(self):
+        local = LocalCache(max_entries=2)
+        local.set('one', time.time() + 10, b'1')
+        local.set('two', time.time() + 10, b'2')
+        # mark 'one' as recently used
+        self.assertEqual(local.get('one'), b'1')
+        local.set('three', time.time() + 10, b'3')
+        self.assertEqual(len(local), 2)
+        self.assertIsNone(local.get('two'))
+        self.assertEqual(local.get('one'), b'1')
+
+    def test_evicts_entries_over_max_bytes(self):
+        local = LocalCache(max_entries=10, max_bytes=5)
+        local.set('one', time.time() + 10, b'123')
+        local.set('two', time.time() + 10, b'456')
+        self.assertIsNone(local.get('one'))
+        self.assertEqual(local.size, 3)
+
+    def test_payload_larger_than_max_bytes_is_not_stored(self):
+        local = LocalCache(max_entries=10, max_bytes=2)
+        local.set('one', time.time() + 10, b'123')
+        self.assertEqual(len(local), 0)
+
+
+class LocalTierTest(S3CacheTestCase):
+    def _dump_object(self, value, timeout=None):
+        return BytesIO(self.cache._dump_object(value, timeout))
+
+    def setUp(self):
+        super(LocalTierTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'LOCAL_MAX_ENTRIES': 10}})
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(AmazonS3Cache(None, {})._local)
+
+    def test_get_is_served_locally(self):
+        with patch.object(self.cache._storage, 'open',
+                          return_value=self._dump_object('TEST', +10)) as open_mock:
+            self.assertEqual(self.cache.get('my-key'), 'TEST')
+            self.assertEqual(self.cache.get('my-key'), 'TEST')
+            self.assertTrue(self.cache.has_key('my-key'))
+            self.assertEqual(open_mock.call_count, 1)
+
+    def test_expired_object_is_not_stored_locally(self):
+        with patch.object(self.cache._storage, 'open',
+                          return_value=self._dump_object('TEST', -1)), \
+             patch.object(AmazonS3Cache, '_delete'):
+            self.assertIsNone(self.cache.get('my-key'))
+        self.assertEqual(len(self.cache._local), 0)
+
+    def test_set_invalidates_local_entry(self):
+        with patch.object(self.cache._storage, 'open',
+                          return_value=self._dump_object('TEST', +10)):
+            self.cache.get('my-key')
+        with patch.object(self.cache._storage, 'save'), \
+             patch.object(self.cache, '_cull'):
+            self.cache.set('my-key', 'NEW')
+        self.assertEqual(len(self.cache._local), 0)
+
+    def test_delete_invalidates_local_entry(self):
+        with patch.object(self.cache._storage, 'open',
+                          return_value=self._dump_object('TEST', +10)):
+            self.cache.get('my-key')
+        with patch.object(self.cache._storage, 'delete', side_effect=IOError):
+            self.cache.delete('my-key')
+        self.assertEqual(len(self.cache._local), 0)
+
+    def test_tier_is_shared_by_instances(self):
+        other = AmazonS3Cache(None, {'OPTIONS': {'LOCAL_MAX_ENTRIES': 10}})
+        with patch.object(self.cache._storage, 'open',
+                          return_value=self._dump_object('TEST', +10)):
+            self.cache.get('my-key')
+        with patch.object(other._storage, 'open') as open_mock:
+            self.assertEqual(other.get('my-key'), 'TEST')
+            self.assertFalse(open_mock.called)
+        with patch.object(other._storage, 'save'), \
+             patch.object(other, '_cull'):
+            other.set('my-key', 'NEW')
+        self.assertEqual(len(self.cache._local), 0)
+
+
+class BatchOperationsTest(S3CacheTestCase):
+    def setUp(self):
+        super(BatchOperationsTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_WORKERS': 4}})
+
+    def test_get_many(self):
+        def _open(fname, _mode):
+            if fname == _key_to_file(self.cache.make_key('missing')):
+                raise IOError
+            return BytesIO(self.cache._dump_object(fname, +10))
+
+        with patch.object(self.cache._storage, 'open', side_effect=_open) as open_mock:
+            result = self.cache.get_many(['one', 'two', 'missing'])
+            self.assertEqual(open_mock.call_count, 3)
+
+        self.assertEqual(sorted(result.keys()), ['one', 'two'])
+        self.assertEqual(result['one'], _key_to_file(self.cache.make_key('one')))
+
+    def test_set_many(self):
+        with patch.object(self.cache, '_cull') as cull_mock, \
+             patch.object(self.cache._storage, 'save') as save_mock:
+            failed = self.cache.set_many({'one': 1, 'two': 2, 'three': 3})
+            self.assertEqual(cull_mock.call_count, 1)
+            self.assertEqual(save_mock.call_count, 3)
+        self.assertEqual(failed, [])
+
+    def test_set_many_returns_failed_keys(self):
+        bad_fname = _key_to_file(self.cache.make_key('bad'))
+
+        def _save(fname, _content):
+            if fname == bad_fname:
+                raise IOError
+            return fname
+
+        with patch.object(self.cache, '_cull'), \
+             patch.object(self.cache._storage, 'save', side_effect=_save):
+            failed = self.cache.set_many({'good': 1, 'bad': 2})
+        self.assertEqual(failed, ['bad'])
+
+    def test_delete_many_uses_multi_object_delete(self):
+        with patch.object(self.cache._storage, '_bucket') as _bucket:
+            self.cache.delete_many(['one', 'two'])
+            self.assertEqual(_bucket.delete_keys.call_count, 1)
+            _bucket.delete_keys.assert_called_with(
+                [_key_to_file(self.cache.make_key('one')),
+                 _key_to_file(self.cache.make_key('two'))],
+                quiet=True)
+
+    def test_delete_many_in_chunks(self):
+        with patch.object(self.cache._storage, '_bucket') as _bucket:
+            self.cache.delete_many(['key-%d' % i for i in range(2500)])
+            self.assertEqual(_bucket.delete_keys.call_count, 3)
+
+    def test_delete_many_bucket_raises_exception(self):
+        with patch.object(self.cache._storage, '_bucket') as _bucket:
+            _bucket.configure_mock(**{'delete_keys.side_effect': OSError})
+            # doesn't raise an exception
+            self.cache.delete_many(['one', 'two'])
+
+
+class ExpiryMetadataTest(S3CacheTestCase):
+    def setUp(self):
+        super(ExpiryMetadataTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {})
+
+    def _s3_file(self, value, timeout, metadata_timeout, body=None):
+        """
+            Mimics S3BotoStorageFile: metadata is available from the key
+            while the body is read from the file object itself.
+        """
+        if body is None:
+            body = self.cache._dump_object(value, timeout)
+        fobj = BytesIO(body)
+        fobj.key = Mock()
+        fobj.key.get_metadata.return_value = repr(time.time() + metadata_timeout)
+        return fobj
+
+    def test_set_stores_expiry_in_metadata(self):
+        with patch.object(self.cache, '_cull'), \
+             patch.object(self.cache._storage, 'save') as save_mock:
+            self.cache.set('my-key', 'TEST', 10)
+            content = save_mock.call_args[0][1]
+            exp = float(content.metadata[EXPIRY_METADATA])
+            self.assertTrue(time.time() < exp <= time.time() + 10)
+
+    def test_storage_sends_metadata(self):
+        key = Mock()
+        content = CacheContentFile(b'data', metadata={EXPIRY_METADATA: '1.5'})
+        with patch.object(S3BotoStorage, '_save_content') as save_mock:
+            self.cache._storage._save_content(key, content, {})
+            key.set_metadata.assert_called_with(EXPIRY_METADATA, '1.5')
+            self.assertEqual(save_mock.call_count, 1)
+
+    def test_has_key_does_not_read_body(self):
+        # reading this body raises UnpicklingError
+        fobj = self._s3_file('TEST', +10, +10, body=b'not a pickle')
+        with patch.object(self.cache._storage, 'open', return_value=fobj):
+            self.assertTrue(self.cache.has_key('my-key'))
+
+    def test_has_key_with_expired_metadata(self):
+        fobj = self._s3_file('TEST', +10, -1, body=b'not a pickle')
+        with patch.object(self.cache._storage, 'open', return_value=fobj), \
+             patch.object(AmazonS3Cache, '_delete') as delete_mock:
+            self.assertFalse(self.cache.has_key('my-key'))
+            # expired objects are deleted on the worker pool
+            self.cache._executor.shutdown()
+            self.assertEqual(delete_mock.call_count, 1)
+
+    def test_get_with_expired_metadata_does_not_read_body(self):
+        fobj = self._s3_file('TEST', +10, -1, body=b'not a pickle')
+        with patch.object(self.cache._storage, 'open', return_value=fobj), \
+             patch.object(AmazonS3Cache, '_delete') as delete_mock:
+            self.assertIsNone(self.cache.get('my-key'))
+            self.cache._executor.shutdown()
+            self.assertEqual(delete_mock.call_count, 1)
+
+    def test_metadata_takes_precedence_over_body(self):
+        fobj = self._s3_file('TEST', -1, +10)
+        with patch.object(self.cache._storage, 'open', return_value=fobj):
+            self.assertEqual(self.cache.get('my-key'), 'TEST')
+
+    def test_invalid_metadata_falls_back_to_body(self):
+        fobj = self._s3_file('TEST', -1, +10)
+        fobj.key.get_metadata.return_value = 'invalid'
+        with patch.object(self.cache._storage, 'open', return_value=fobj), \
+             patch.object(AmazonS3Cache, '_delete'):
+            self.assertIsNone(self.cache.get('my-key'))
+
+
+class CullScheduleTest(S3CacheTestCase):
+    def setUp(self):
+        super(CullScheduleTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 10, 'CULL_EVERY': 5}})
+
+    def test_first_write_counts_entries_in_background(self):
+        threads = []
+        with patch.object(self.cache._storage, '_bucket') as _bucket:
+            _bucket.configure_mock(**{'get_all_keys.side_effect': lambda **kwargs: (
+                threads.append(threading.current_thread()), KeyPage(['a', 'b', 'c'], False))[1]})
+            self.cache._maybe_cull()
+            self.cache._executor.shutdown(wait=True)
+            self.assertEqual(_bucket.get_all_keys.call_count, 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+        self.assertEqual(self.cache._culls.count, 3)
+
+    def test_bucket_is_listed_every_n_writes(self):
+        with patch.object(self.cache, '_cull') as cull_mock:
+            self.cache._culls.count = 0
+            for _i in range(4):
+                self.cache._maybe_cull()
+            self.assertEqual(cull_mock.call_count, 0)
+            self.cache._maybe_cull()
+            self.assertEqual(cull_mock.call_count, 1)
+
+    def test_estimate_reaching_max_entries_triggers_cull(self):
+        with patch.object(self.cache, '_cull') as cull_mock:
+            self.cache._culls.count = 8
+            self.cache._maybe_cull()
+            self.assertEqual(cull_mock.call_count, 0)
+            self.cache._maybe_cull()
+            self.assertEqual(cull_mock.call_count, 1)
+
+    def test_estimate_is_shared_by_instances(self):
+        others = [AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 10, 'CULL_EVERY': 5}})
+                  for _i in range(3)]
+        self.cache._culls.count = 0
+        with patch.object(AmazonS3Cache, '_cull') as cull_mock:
+            for cache in [self.cache] + others:
+                cache._maybe_cull()
+            self.assertEqual(cull_mock.call_count, 0)
+            others[0]._maybe_cull()
+            self.assertEqual(cull_mock.call_count, 1)
+
+    def test_cull_without_max_entries(self):
+        self.cache._max_entries = 0
+        with patch.object(self.cache, '_cull') as cull_mock:
+            self.cache._maybe_cull()
+            self.assertEqual(cull_mock.call_count, 0)
+
+    def test_cull_in_background(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'CULL_IN_BACKGROUND': True}})
+        with patch.object(cache, '_cull') as cull_mock, \
+             patch.object(cache._storage, 'save') as save_mock:
+            cache.set('my-key', 'TEST')
+            self.assertEqual(save_mock.call_count, 1)
+            cache._executor.shutdown(wait=True)
+            self.assertEqual(cull_mock.call_count, 1)
+        self.assertFalse(cache._culls.running)
+
+    def test_cull_updates_estimate(self):
+        self.cache._cull_frequency = 2
+        with patch.object(self.cache._storage, '_bucket') as _bucket:
+            _bucket.configure_mock(**{'get_all_keys.return_value': list(range(10))})
+            self.cache._cull()
+        self.assertEqual(self.cache._culls.count, 5)
+
+
+class StorageTest(S3CacheTestCase):
+    def test_save_does_not_look_up_key(self):
+        storage = AmazonS3Cache(None, {})._storage
+        with patch.object(storage, '_bucket') as _bucket:
+            storage.save('name', CacheContentFile(b'data', metadata={EXPIRY_METADATA: '1.5'}))
+            self.assertEqual(_bucket.get_key.call_count, 0)
+            self.assertEqual(_bucket.new_key.call_count, 1)
+            key = _bucket.new_key.return_value
+            key.set_metadata.assert_called_with(EXPIRY_METADATA, '1.5')
+            self.assertEqual(key.set_contents_from_file.call_count, 1)
+
+
+class KeyPage(list):
+    """
+        Mimics boto's ResultSet returned by Bucket.get_all_keys()
+    """
+    def __init__(self, names, is_truncated):
+        list.__init__(self, [Mock(name=name) for name in names])
+        for key, name in zip(self, names):
+            key.name = name
+        self.is_truncated = is_truncated
+
+
+class PaginatedListingTest(S3CacheTestCase):
+    def setUp(self):
+        super(PaginatedListingTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 3}})
+        self.pages = [
+            KeyPage(['a', 'b', 'c'], True),
+            KeyPage(['d', 'e', 'f'], True),
+            KeyPage(['g'], False),
+        ]
+
+    def test_iter_key_pages(self):
+        with patch.object(self.cache._storage, '_bucket') as _bucket:
+            _bucket.configure_mock(**{'get_all_keys.side_effect': self.pages})
+            pages = list(self.cache._iter_key_pages())
+            self.assertEqual(pages, self.pages)
+            markers = [call[1]['marker'] for call in _bucket.get_all_keys.call_args_list]
+            self.assertEqual(markers, ['', 'c', 'f'])
+
+    def test_num_entries_over_multiple_pages(self):
+        with patch.object(self.cache._storage, '_bucket') as _bucket:
+            _bucket.configure_mock(**{'get_all_keys.side_effect': self.pages})
+            self.assertEqual(self.cache._num_entries, 7)
+
+    def test_cull_over_multiple_pages(self):
+        self.cache._cull_frequency = 2
+        with patch.object(AmazonS3Cache, '_num_entries', 7), \
+             patch.object(self.cache._storage, '_bucket') as _bucket:
+            _bucket.configure_mock(**{'get_all_keys.side_effect': self.pages})
+            self.cache._cull()
+            self.assertEqual(_bucket.delete_keys.call_count, 3)
+            deleted = sorted(key.name for call in _bucket.delete_keys.call_args_list
+                             for key in call[0][0])
+        # every second key across all pages
+        self.assertEqual(deleted, ['a', 'c', 'e', 'g'])
+        self.assertEqual(self.cache._culls.count, 3)
+
+    def test_clear_deletes_every_page(self):
+        with patch.object(self.cache._storage, '_bucket') as _bucket:
+            _bucket.configure_mock(**{'get_all_keys.side_effect': self.pages})
+            self.cache.clear()
+            self.assertEqual(_bucket.delete_keys.call_count, 3)
+        self.assertEqual(self.cache._culls.count, 0)
+
+    def test_clear_without_max_entries(self):
+        self.cache._max_entries = 0
+        with patch.object(self.cache._storage, '_bucket') as _bucket:
+            _bucket.configure_mock(**{'get_all_keys.side_effect': self.pages})
+            self.cache.clear()
+            self.assertEqual(_bucket.delete_keys.call_count, 3)
+
+
+class GenerationsTest(S3CacheTestCase):
+    def setUp(self):
+        super(GenerationsTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'GENERATIONS': True,
+                                                       'LOCATION': 'cache'}})
+
+    def test_disabled_by_default(self):
+        cache = AmazonS3Cache(None, {})
+        self.assertEqual(cache._key_to_fname('my-key'), _key_to_file('my-key'))
+
+    def test_key_is_stored_under_generation(self):
+        with patch.object(self.cache._storage, 'open', return_value=BytesIO(b'7')):
+            self.assertEqual(self.cache._key_to_fname('my-key'),
+                             '7/' + _key_to_file('my-key'))
+
+    def test_generation_is_memoized(self):
+        with patch.object(self.cache._storage, 'open',
+                          return_value=BytesIO(b'7')) as open_mock:
+            self.cache._key_to_fname('one')
+            self.cache._key_to_fname('two')
+            self.assertEqual(open_mock.call_count, 1)
+
+    def test_missing_generation(self):
+        with patch.object(self.cache._storage, 'open', side_effect=FileNotFoundError):
+            self.assertEqual(self.cache._get_generation(), 0)
+
+    def test_failed_read_without_known_generation(self):
+        with patch.object(self.cache._storage, 'open', side_effect=IOError) as open_mock:
+            self.assertIsNone(self.cache._get_generation())
+            self.assertIsNone(self.cache._get_generation())
+            # the failure is remembered for GENERATION_TIMEOUT seconds
+            self.assertEqual(open_mock.call_count, 1)
+            self.assertRaises(IOError, self.cache._key_to_fname, 'my-key')
+
+        self.cache._generation = (None, 0)
+        with patch.object(self.cache._storage, 'open', return_value=BytesIO(b'7')):
+            self.assertEqual(self.cache._get_generation(), 7)
+
+    def test_unknown_generation_is_a_miss(self):
+        with patch.object(self.cache._storage, 'open', side_effect=IOError), \
+             patch.object(self.cache._storage, 'save') as save_mock, \
+             patch.object(self.cache._storage, 'delete') as delete_mock:
+            self.cache.set('my-key', 'TEST')
+            self.assertEqual(self.cache.set_many({'one': 1}), ['one'])
+            self.assertFalse(self.cache.add('my-key', 'TEST'))
+            self.assertEqual(self.cache.get_or_set('my-key', lambda: 'TEST'), 'TEST')
+            self.assertIsNone(self.cache.get('my-key'))
+            self.assertFalse(self.cache.has_key('my-key'))
+            self.cache.delete('my-key')
+            self.assertFalse(save_mock.called)
+            self.assertFalse(delete_mock.called)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_failed_read_keeps_known_generation(self):
+        with patch.object(self.cache._storage, 'open', return_value=BytesIO(b'7')):
+            self.assertEqual(self.cache._get_generation(), 7)
+        self.cache._generation = (7, 0)
+        with patch.object(self.cache._storage, 'open', side_effect=IOError) as open_mock:
+            self.assertEqual(self.cache._get_generation(), 7)
+            self.assertEqual(self.cache._get_generation(), 7)
+            self.assertEqual(open_mock.call_count, 1)
+
+    def test_clear_after_failed_read(self):
+        with patch.object(self.cache._storage, 'open', side_effect=IOError), \
+             patch.object(self.cache._storage, 'save') as save_mock:
+            self.cache.clear()
+            self.assertFalse(save_mock.called)
+        self.assertEqual(self.cache.stats()['clear']['errors'], {'OSError': 1})
+
+    def test_sweep_after_failed_read(self):
+        with patch.object(self.cache._storage, 'open', side_effect=IOError), \
+             patch.object(self.cache._storage, '_bucket') as _bucket:
+            self.cache.sweep()
+            self.assertFalse(_bucket.get_all_keys.called)
+            self.assertFalse(_bucket.delete_keys.called)
+
+    def test_list_prefix(self):
+        with patch.object(self.cache._storage, 'open', return_value=BytesIO(b'7')):
+            self.assertEqual(self.cache._list_prefix(), 'cache/7/')
+
+    def test_clear_starts_new_generation(self):
+        with patch.object(self.cache._storage, 'open', return_value=BytesIO(b'7')), \
+             patch.object(self.cache._storage, 'save') as save_mock, \
+             patch.object(self.cache._storage, '_bucket') as _bucket:
+            self.cache.clear()
+            self.assertEqual(_bucket.get_all_keys.call_count, 0)
+            self.assertEqual(_bucket.delete_keys.call_count, 0)
+            self.assertEqual(save_mock.call_count, 1)
+            self.assertEqual(save_mock.call_args[0][1].read(), b'8')
+        self.assertEqual(self.cache._get_generation(), 8)
+
+    def test_sweep_deletes_older_generations(self):
+        names = ['cache/generation', 'cache/6/aaa', 'cache/7/bbb',
+                 'cache/8/ccc', 'cache/ddd']
+        with patch.object(self.cache._storage, 'open', return_value=BytesIO(b'7')), \
+             patch.object(self.cache._storage, '_bucket') as _bucket:
+            _bucket.configure_mock(**{'get_all_keys.return_value': KeyPage(names, False)})
+            self.cache.sweep()
+            _bucket.get_all_keys.assert_called_with(prefix='cache', marker='')
+            deleted = [key.name for key in _bucket.delete_keys.call_args[0][0]]
+        self.assertEqual(deleted, ['cache/6/aaa', 'cache/ddd'])
+
+
+class FakeBody(object):
+    def __init__(self, data):
+        self.data = data
+
+    async def read(self):
+        return self.data
+
+    def close(self):
+        pass
+
+
+class FakeAsyncClient(object):
+    """
+        Minimal in-memory stand-in for the aiobotocore S3 client
+    """
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+
+    def _missing(self, operation):
+        from botocore.exceptions import ClientError
+        return ClientError({'Error': {'Code': 'NoSuchKey'}}, operation)
+
+    async def put_object(self, **kwargs):
+        self.calls.append(('put_object', kwargs))
+        self.objects[kwargs['Key']] = (kwargs['Body'], kwargs['Metadata'])
+
+    async def get_object(self, Bucket, Key, Range=None):
+        self.calls.append(('get_object', {'Bucket': Bucket, 'Key': Key, 'Range': Range}))
+        if Key not in self.objects:
+            raise self._missing('GetObject')
+        body, metadata = self.objects[Key]
+        return {'Body': FakeBody(body), 'Metadata': metadata}
+
+    async def head_object(self, Bucket, Key):
+        self.calls.append(('head_object', {'Bucket': Bucket, 'Key': Key}))
+        if Key not in self.objects:
+            raise self._missing('HeadObject')
+        return {'Metadata': self.objects[Key][1]}
+
+    async def delete_object(self, Bucket, Key):
+        self.calls.append(('delete_object', {'Bucket': Bucket, 'Key': Key}))
+        self.objects.pop(Key, None)
+
+    async def delete_objects(self, Bucket, Delete):
+        self.calls.append(('delete_objects', {'Bucket': Bucket, 'Delete': Delete}))
+        for obj in Delete['Objects']:
+            self.objects.pop(obj['Key'], None)
+
+
+@skipIf(s3cache.aio.get_session is None, 'aiobotocore is not installed')
+class AsyncCacheTest(S3CacheTestCase):
+    def setUp(self):
+        super(AsyncCacheTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'BUCKET_NAME': 'bucket'}})
+        self.client = FakeAsyncClient()
+
+        async def _aclient():
+            return self.client
+
+        patcher = patch.object(self.cache, '_aclient', _aclient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(self.cache, '_cull')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _name(self, key):
+        return _key_to_file(self.cache.make_key(key))
+
+    def _calls(self, operation):
+        return [kwargs for (name, kwargs) in self.client.calls if name == operation]
+
+    def test_aset_and_aget(self):
+        asyncio.run(self.cache.aset('my-key', 'TEST', 10))
+        self.assertEqual(asyncio.run(self.cache.aget('my-key')), 'TEST')
+
+        put = self._calls('put_object')[0]
+        self.assertEqual(put['Bucket'], 'bucket')
+        self.assertEqual(put['Key'], self._name('my-key'))
+        self.assertEqual(put['ACL'], 'private')
+        self.assertIn(EXPIRY_METADATA, put['Metadata'])
+
+    def test_aset_uses_same_format_as_set(self):
+        asyncio.run(self.cache.aset('my-key', 'TEST', 10))
+        body = self.client.objects[self._name('my-key')][0]
+        with patch.object(self.cache._storage, 'open', return_value=BytesIO(body)):
+            self.assertEqual(self.cache.get('my-key'), 'TEST')
+
+    def test_aget_missing_key(self):
+        self.assertEqual(asyncio.run(self.cache.aget('my-key', 'default')), 'default')
+
+    def test_missing_key_is_remembered(self):
+        self.cache._misses = LocalCache(timeout=5)
+        self.assertIsNone(asyncio.run(self.cache.aget('my-key')))
+        self.assertIsNone(asyncio.run(self.cache.aget('my-key')))
+        self.assertFalse(asyncio.run(self.cache.ahas_key('my-key')))
+        self.assertEqual(len(self._calls('get_object')), 1)
+        self.assertEqual(len(self._calls('head_object')), 0)
+
+        self.assertFalse(asyncio.run(self.cache.ahas_key('other')))
+        self.assertFalse(asyncio.run(self.cache.ahas_key('other')))
+        self.assertEqual(len(self._calls('head_object')), 1)
+
+    def test_aget_expired_object(self):
+        asyncio.run(self.cache.aset('my-key', 'TEST', -1))
+        with patch.object(self.cache, '_reclaim') as reclaim_mock:
+            self.assertIsNone(asyncio.run(self.cache.aget('my-key')))
+            self.assertFalse(asyncio.run(self.cache.ahas_key('my-key')))
+            self.cache._executor.shutdown()
+        # deleted on the worker pool instead of by the read
+        self.assertEqual(len(self._calls('delete_object')), 0)
+        self.assertEqual(reclaim_mock.call_count, 2)
+
+    def test_expired_object_is_remembered(self):
+        self.cache._misses = LocalCache(timeout=5)
+        asyncio.run(self.cache.aset('my-key', 'TEST', -1))
+        with patch.object(self.cache, '_reclaim'):
+            self.assertIsNone(asyncio.run(self.cache.aget('my-key')))
+            self.assertIsNone(asyncio.run(self.cache.aget('my-key')))
+        self.assertEqual(len(self._calls('get_object')), 1)
+
+    def test_aget_object_without_metadata(self):
+        self.client.objects[self._name('my-key')] = (self.cache._dump_object('TEST', 10), {})
+        self.assertEqual(asyncio.run(self.cache.aget('my-key')), 'TEST')
+
+    def test_aget_keeps_value_locally_while_fresh(self):
+        self.cache._local = LocalCache(max_entries=10)
+        fresh_until = time.time() + 5
+        self.client.objects[self._name('my-key')] = (
+            self.cache._dump_object('TEST', 60),
+            {EXPIRY_METADATA: repr(time.time() + 60), FRESH_METADATA: repr(fresh_until)})
+        self.assertEqual(asyncio.run(self.cache.aget('my-key')), 'TEST')
+        self.assertEqual(self.cache._local._data[self._name('my-key')][0], fresh_until)
+
+    def test_ahas_key_uses_head_request(self):
+        asyncio.run(self.cache.aset('my-key', 'TEST', 10))
+        self.assertTrue(asyncio.run(self.cache.ahas_key('my-key')))
+        self.assertEqual(len(self._calls('get_object')), 0)
+
+    def test_ahas_key_object_without_metadata(self):
+        self.client.objects[self._name('my-key')] = (self.cache._dump_object('TEST', -1), {})
+        self.assertFalse(asyncio.run(self.cache.ahas_key('my-key')))
+        self.assertEqual(self._calls('get_object')[0]['Range'], 'bytes=0-63')
+
+    def test_aadd(self):
+        self.assertTrue(asyncio.run(self.cache.aadd('my-key', 'TEST')))
+        self.assertFalse(asyncio.run(self.cache.aadd('my-key', 'OTHER')))
+        self.assertEqual(asyncio.run(self.cache.aget('my-key')), 'TEST')
+
+    def test_aget_many(self):
+        asyncio.run(self.cache.aset_many({'one': 1, 'two': 2}))
+        result = asyncio.run(self.cache.aget_many(['one', 'two', 'missing']))
+        self.assertEqual(result, {'one': 1, 'two': 2})
+        self.assertEqual(self.cache._cull.call_count, 1)
+
+    def test_adelete(self):
+        asyncio.run(self.cache.aset('my-key', 'TEST'))
+        asyncio.run(self.cache.adelete('my-key'))
+        self.assertIsNone(asyncio.run(self.cache.aget('my-key')))
+
+    def test_adelete_many_in_chunks(self):
+        asyncio.run(self.cache.adelete_many(['key-%d' % i for i in range(1500)]))
+        self.assertEqual(len(self._calls('delete_objects')), 2)
+
+
+class AsyncFallbackTest(S3CacheTestCase):
+    def test_aget_without_aiobotocore(self):
+        cache = AmazonS3Cache(None, {})
+        with patch('s3cache.aio.get_session', None), \
+             patch.object(cache, 'get', return_value='TEST') as get_mock:
+            self.assertEqual(asyncio.run(cache.aget('my-key')), 'TEST')
+            get_mock.assert_called_with('my-key', None, version=None)
+
+
+class CodecTest(S3CacheTestCase):
+    def test_plain_pickle_without_compression(self):
+        codec = Codec()
+        data = codec.dumps({'a': 1})
+        # same format as before v1.5
+        self.assertEqual(pickle.loads(data), {'a': 1})
+        self.assertEqual(codec.loads(data), {'a': 1})
+
+    def test_json(self):
+        codec = Codec(serializer='json')
+        data = codec.dumps({'a': [1, 2]})
+        self.assertTrue(data.startswith(MAGIC))
+        self.assertEqual(codec.loads(data), {'a': [1, 2]})
+
+    def test_json_with_unsupported_value(self):
+        with self.assertRaises(pickle.PicklingError):
+            Codec(serializer='json').dumps(object())
+
+    def test_compression_above_min_size(self):
+        for compressor in ('zlib', 'lzma'):
+            codec = Codec(compressor=compressor, min_size=100)
+            value = 'x' * 1000
+            data = codec.dumps(value)
+            self.assertTrue(data.startswith(MAGIC))
+            self.assertLess(len(data), 1000)
+            self.assertEqual(codec.loads(data), value)
+
+    def test_no_compression_below_min_size(self):
+        codec = Codec(compressor='zlib', min_size=100)
+        data = codec.dumps('x' * 10)
+        self.assertFalse(data.startswith(MAGIC))
+
+    def test_incompressible_value_is_stored_as_is(self):
+        codec = Codec(compressor='zlib', min_size=0)
+        self.assertFalse(codec.dumps(os.urandom(2000)).startswith(MAGIC))
+
+    def test_reads_any_format(self):
+        data = Codec(serializer='json', compressor='lzma', min_size=0).dumps(['x'] * 100)
+        self.assertEqual(Codec().loads(data), ['x'] * 100)
+
+    def test_corrupted_value(self):
+        data = Codec(compressor='zlib', min_size=0).dumps('x' * 100)
+        with self.assertRaises(pickle.UnpicklingError):
+            Codec().loads(data[:-5])
+
+    def test_unknown_serializer(self):
+        with self.assertRaises(ImproperlyConfigured):
+            Codec(serializer='yaml')
+
+    def test_unknown_compressor(self):
+        with self.assertRaises(ImproperlyConfigured):
+            Codec(compressor='bz2')
+
+    def test_cache_uses_configured_codec(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'SERIALIZER': 'json',
+                                                  'COMPRESSOR': 'zlib',
+                                                  'COMPRESS_MIN_SIZE': 10}})
+        body = cache._dump_object(['x'] * 100, +10)
+        with patch.object(cache._storage, 'open', return_value=BytesIO(body)):
+            self.assertEqual(cache.get('my-key'), ['x'] * 100)
+        self.assertLess(len(body), 100)
+
+
+class FakeStreamingKey(object):
+    """
+        Mimics a boto key after open_read()
+    """
+    def __init__(self, body, metadata=None):
+        self._body = BytesIO(body)
+        self.metadata = metadata or {}
+        self.closed_fast = None
+
+    def read(self, size=0):
+        return self._body.read(size or -1)
+
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+
+    def close(self, fast=False):
+        self.closed_fast = fast
+
+    @property
+    def position(self):
+        return self._body.tell()
+
+
+class StreamingTest(S3CacheTestCase):
+    def setUp(self):
+        super(StreamingTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'STREAMING': True,
+                                                       'STREAM_PART_SIZE': 10}})
+        patcher = patch('s3cache.storage.MIN_PART_SIZE', 10)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _capture_writes(self, storage):
+        """
+            Collects what MultipartWriter uploads, with a single PUT or in parts
+        """
+        uploaded = {'parts': []}
+
+        def _save(name, content):
+            uploaded['body'] = content.read()
+            uploaded['metadata'] = content.metadata
+
+        def _upload_part(fileobj, _part_num):
+            uploaded['parts'].append(fileobj.read())
+
+        bucket = Mock()
+        bucket.initiate_multipart_upload.return_value.upload_part_from_file.side_effect = _upload_part
+        return uploaded, bucket, _save
+
+    def test_writer_uses_single_put_for_small_values(self):
+        storage = self.cache._storage
+        uploaded, bucket, _save = self._capture_writes(storage)
+        with patch.object(storage, '_bucket', bucket), \
+             patch.object(storage, 'save', side_effect=_save):
+            writer = storage.open_writer('name', metadata={'a': '1'}, part_size=100)
+            writer.write(b'small')
+            writer.close()
+        self.assertEqual(uploaded['body'], b'small')
+        self.assertEqual(uploaded['metadata'], {'a': '1'})
+        self.assertEqual(bucket.initiate_multipart_upload.call_count, 0)
+
+    def test_writer_uploads_parts(self):
+        storage = self.cache._storage
+        uploaded, bucket, _save = self._capture_writes(storage)
+        with patch.object(storage, '_bucket', bucket):
+            writer = storage.open_writer('name', metadata={'a': '1'}, part_size=10)
+            for _i in range(5):
+                writer.write(b'12345')
+            writer.close()
+        self.assertEqual(uploaded['parts'], [b'1234512345', b'1234512345', b'12345'])
+        self.assertEqual(bucket.initiate_multipart_upload.call_args[1]['metadata'], {'a': '1'})
+        mp_upload = bucket.initiate_multipart_upload.return_value
+        self.assertEqual(mp_upload.complete_upload.call_count, 1)
+
+    def test_writer_abort_cancels_upload(self):
+        storage = self.cache._storage
+        with patch.object(storage, '_bucket') as _bucket, \
+             patch.object(storage, 'save') as save_mock:
+            writer = storage.open_writer('name', part_size=10)
+            writer.write(b'x' * 15)
+            writer.abort()
+            writer.close()
+            mp_upload = _bucket.initiate_multipart_upload.return_value
+            self.assertEqual(mp_upload.cancel_upload.call_count, 1)
+            self.assertEqual(mp_upload.complete_upload.call_count, 0)
+            self.assertEqual(save_mock.call_count, 0)
+
+    def test_key_reader(self):
+        key = FakeStreamingKey(b'x' * 100)
+        reader = io.BufferedReader(KeyReader(key), buffer_size=16)
+        self.assertEqual(reader.read(10), b'x' * 10)
+        reader.close()
+        self.assertTrue(key.closed_fast)
+        self.assertLess(key.position, 100)
+
+    def test_codec_dump_and_load(self):
+        for options in ({}, {'compressor': 'zlib'}, {'serializer': 'json', 'compressor': 'lzma'}):
+            codec = Codec(**options)
+            fobj = BytesIO()
+            codec.dump(['x'] * 1000, fobj)
+            self.assertEqual(codec.loads(fobj.getvalue()), ['x'] * 1000)
+            fobj.seek(0)
+            self.assertEqual(codec.load(io.BufferedReader(fobj)), ['x'] * 1000)
+
+    def test_codec_dump_stream_and_load_stream(self):
+        codec = Codec(compressor='zlib')
+        fobj = BytesIO()
+        codec.dump_stream(BytesIO(b'x' * 200000), fobj)
+        data = fobj.getvalue()
+        self.assertLess(len(data), 200000)
+        fobj.seek(0)
+        self.assertEqual(codec.load_stream(io.BufferedReader(fobj)).read(), b'x' * 200000)
+        # get() can read the whole value too
+        self.assertEqual(codec.loads(data), b'x' * 200000)
+
+    def test_codec_load_stream_of_regular_value(self):
+        fobj = BytesIO(Codec(serializer='json').dumps('TEST'))
+        with self.assertRaises(pickle.UnpicklingError):
+            Codec().load_stream(io.BufferedReader(fobj))
+
+    def test_set_and_get(self):
+        storage = self.cache._storage
+        uploaded, bucket, _save = self._capture_writes(storage)
+        with patch.object(storage, '_bucket', bucket), \
+             patch.object(storage, 'save', side_effect=_save), \
+             patch.object(self.cache, '_cull'):
+            self.cache.set('my-key', 'x' * 100)
+
+        body = b''.join(uploaded['parts'])
+        self.assertGreater(len(uploaded['parts']), 1)
+        metadata = bucket.initiate_multipart_upload.call_args[1]['metadata']
+        key = FakeStreamingKey(body, metadata)
+        with patch.object(storage, 'open_key', return_value=key):
+            self.assertEqual(self.cache.get('my-key'), 'x' * 100)
+        self.assertTrue(key.closed_fast)
+
+    def test_get_expired_object_does_not_read_body(self):
+        key = FakeStreamingKey(self.cache._dump_object('TEST', +10),
+                               {EXPIRY_METADATA: repr(time.time() - 1)})
+        with patch.object(self.cache._storage, 'open_key', return_value=key), \
+             patch.object(AmazonS3Cache, '_delete'):
+            self.assertIsNone(self.cache.get('my-key'))
+        self.assertEqual(key.position, 0)
+
+    def test_get_object_without_metadata(self):
+        key = FakeStreamingKey(self.cache._dump_object('TEST', +10))
+        with patch.object(self.cache._storage, 'open_key', return_value=key):
+            self.assertEqual(self.cache.get('my-key'), 'TEST')
+
+    def test_get_missing_key(self):
+        with patch.object(self.cache._storage, 'open_key', side_effect=IOError):
+            self.assertIsNone(self.cache.get('my-key'))
+
+    def test_set_stream_and_get_stream(self):
+        storage = self.cache._storage
+        uploaded, bucket, _save = self._capture_writes(storage)
+        with patch.object(storage, '_bucket', bucket), \
+             patch.object(storage, 'save', side_effect=_save), \
+             patch.object(self.cache, '_cull'):
+            self.assertTrue(self.cache.set_stream('my-key', [b'abc', b'def']))
+
+        key = FakeStreamingKey(b''.join(uploaded['parts']),
+                               bucket.initiate_multipart_upload.call_args[1]['metadata'])
+        with patch.object(storage, 'open_key', return_value=key):
+            stream = self.cache.get_stream('my-key')
+            self.assertEqual(stream.read(), b'abcdef')
+            stream.close()
+
+    def test_get_stream_of_regular_value(self):
+        key = FakeStreamingKey(self.cache._dump_object('TEST', +10))
+        with patch.object(self.cache._storage, 'open_key', return_value=key):
+            self.assertEqual(self.cache.get_stream('my-key', 'default'), 'default')
+        self.assertTrue(key.closed_fast)
+
+    def test_set_stream_aborts_on_error(self):
+        def _chunks():
+            yield b'x' * 15
+            raise IOError
+
+        with patch.object(self.cache._storage, '_bucket') as _bucket, \
+             patch.object(self.cache, '_cull'):
+            self.assertFalse(self.cache.set_stream('my-key', _chunks()))
+            mp_upload = _bucket.initiate_multipart_upload.return_value
+            self.assertEqual(mp_upload.cancel_upload.call_count, 1)
+
+
+class SingleFlightTest(TestCase):
+    def test_concurrent_calls_share_result(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def _compute():
+            calls.append(1)
+            release.wait(5)
+            return object()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flights.do('key', _compute)))
+                   for _i in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(set(id(r) for r in results)), 1)
+
+    def test_calls_after_completion_run_again(self):
+        flights = SingleFlight()
+        self.assertEqual(flights.do('key', lambda: 1), 1)
+        self.assertEqual(flights.do('key', lambda: 2), 2)
+
+    def test_exception_is_raised_and_forgotten(self):
+        flights = SingleFlight()
+
+        def _fail():
+            raise IOError
+
+        self.assertRaises(IOError, flights.do, 'key', _fail)
+        self.assertEqual(flights.do('key', lambda: 1), 1)
+
+
+class GetOrSetTest(S3CacheTestCase):
+    def setUp(self):
+        super(GetOrSetTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 0}})
+
+    def test_hit_does_not_call_default(self):
+        default = Mock()
+        with patch.object(self.cache._storage, 'open',
+                          return_value=BytesIO(self.cache._dump_object('TEST', +10))):
+            self.assertEqual(self.cache.get_or_set('my-key', default), 'TEST')
+        self.assertFalse(default.called)
+
+    def test_miss_stores_result_of_callable(self):
+        with patch.object(self.cache._storage, 'open', side_effect=IOError), \
+             patch.object(self.cache, '_set') as set_mock:
+            self.assertEqual(self.cache.get_or_set('my-key', lambda: 'TEST', 60), 'TEST')
+        fname, value, timeout = set_mock.call_args[0]
+        self.assertEqual((fname, value, timeout),
+                         (_key_to_file(self.cache.make_key('my-key')), 'TEST', 60))
+
+    def test_none_is_not_stored(self):
+        with patch.object(self.cache._storage, 'open', side_effect=IOError), \
+             patch.object(self.cache, '_set') as set_mock:
+            self.assertIsNone(self.cache.get_or_set('my-key', lambda: None))
+        self.assertFalse(set_mock.called)
+
+    def test_concurrent_misses_share_fetch_and_recompute(self):
+        release = threading.Event()
+        calls = []
+
+        def _open(_fname, _mode):
+            release.wait(5)
+            raise IOError
+
+        def _compute():
+            calls.append(1)
+            return 'TEST'
+
+        results = []
+        with patch.object(self.cache._storage, 'open', side_effect=_open) as open_mock, \
+             patch.object(self.cache, '_set'):
+            threads = [threading.Thread(
+                target=lambda: results.append(self.cache.get_or_set('my-key', _compute)))
+                       for _i in range(5)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.1)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(open_mock.call_count, 1)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['TEST'] * 5)
+
+    def test_lease_is_released_after_recompute(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'LEASE_TIMEOUT': 5, 'MAX_ENTRIES': 0}})
+        fname = _key_to_file(cache.make_key('my-key'))
+        with patch.object(cache._storage, 'open', side_effect=IOError), \
+             patch.object(cache._storage, 'create', return_value=True) as create_mock, \
+             patch.object(cache, '_set'), \
+             patch.object(AmazonS3Cache, '_delete') as delete_mock:
+            self.assertEqual(cache.get_or_set('my-key', 'TEST'), 'TEST')
+        self.assertEqual(create_mock.call_args[0][0], fname + '.lock')
+        delete_mock.assert_called_once_with(fname + '.lock')
+
+    def test_waits_for_lease_holder(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'LEASE_TIMEOUT': 5,
+                                                 'LEASE_POLL_INTERVAL': 0.01}})
+        lease = Mock(metadata={EXPIRY_METADATA: repr(time.time() + 5)})
+        default = Mock()
+        bodies = [IOError, IOError, BytesIO(cache._dump_object('TEST', +10))]
+        with patch.object(cache._storage, 'open', side_effect=bodies), \
+             patch.object(cache._storage, 'create', return_value=False), \
+             patch.object(cache._storage, '_bucket') as _bucket:
+            _bucket.get_key.return_value = lease
+            self.assertEqual(cache.get_or_set('my-key', default), 'TEST')
+        self.assertFalse(default.called)
+
+    def test_waits_for_lease_holder_with_known_misses(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'LEASE_TIMEOUT': 5,
+                                                 'LEASE_POLL_INTERVAL': 0.01,
+                                                 'NEGATIVE_TIMEOUT': 5,
+                                                 'BLOOM_FILTER': True}})
+        cache._bloom.finish_build(BloomFilter(100, 0.01))
+        default = Mock()
+        bodies = [FileNotFoundError, BytesIO(cache._dump_object('TEST', +10))]
+        with patch.object(cache._storage, 'open', side_effect=bodies), \
+             patch.object(cache, '_acquire_lease', return_value=False):
+            self.assertEqual(cache.get_or_set('my-key', default), 'TEST')
+            self.assertFalse(default.called)
+            # the value is not reported missing any more
+            self.assertFalse(cache._known_missing(_key_to_file(cache.make_key('my-key'))))
+
+    def test_stale_lease_is_taken_over(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'LEASE_TIMEOUT': 5, 'MAX_ENTRIES': 0}})
+        fname = _key_to_file(cache.make_key('my-key'))
+        lease = Mock(metadata={EXPIRY_METADATA: repr(time.time() - 1)})
+        with patch.object(cache._storage, 'open', side_effect=IOError), \
+             patch.object(cache._storage, 'create', side_effect=[False, True]), \
+             patch.object(cache._storage, '_bucket') as _bucket, \
+             patch.object(cache, '_set'), \
+             patch.object(AmazonS3Cache, '_delete') as delete_mock:
+            _bucket.get_key.return_value = lease
+            self.assertEqual(cache.get_or_set('my-key', 'TEST'), 'TEST')
+        self.assertEqual(delete_mock.call_count, 2)
+        delete_mock.assert_called_with(fname + '.lock')
+
+    def test_create_with_existing_object(self):
+        storage = self.cache._storage
+        with patch.object(storage, '_bucket') as _bucket:
+            key = _bucket.new_key.return_value
+            key.set_contents_from_file.side_effect = S3ResponseError(412, 'Precondition Failed')
+            self.assertFalse(storage.create('name.lock', CacheContentFile(b'')))
+            headers = key.set_contents_from_file.call_args[1]['headers']
+            self.assertEqual(headers['If-None-Match'], '*')
+
+
+class StaleWhileRevalidateTest(S3CacheTestCase):
+    def setUp(self):
+        super(StaleWhileRevalidateTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'STALE_TIMEOUT': 60, 'MAX_ENTRIES': 0}})
+
+    def _s3_file(self, value, fresh_for, delta=None):
+        fobj = BytesIO(self.cache._dump_object(value, fresh_for + 60))
+        metadata = {EXPIRY_METADATA: repr(time.time() + fresh_for + 60),
+                    FRESH_METADATA: repr(time.time() + fresh_for)}
+        if delta is not None:
+            metadata[DELTA_METADATA] = repr(delta)
+        fobj.key = Mock()
+        fobj.key.get_metadata.side_effect = metadata.get
+        return fobj
+
+    def test_set_stores_fresh_and_hard_expiry(self):
+        with patch.object(self.cache._storage, 'save') as save_mock:
+            self.cache.set('my-key', 'TEST', 10)
+        metadata = save_mock.call_args[0][1].metadata
+        fresh_until = float(metadata[FRESH_METADATA])
+        self.assertAlmostEqual(float(metadata[EXPIRY_METADATA]), fresh_until + 60, places=3)
+        self.assertAlmostEqual(fresh_until, time.time() + 10, delta=1)
+
+    def test_no_extra_metadata_by_default(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 0}})
+        with patch.object(cache._storage, 'save') as save_mock:
+            cache.set('my-key', 'TEST', 10)
+        self.assertEqual(list(save_mock.call_args[0][1].metadata), [EXPIRY_METADATA])
+
+    def test_get_returns_stale_value(self):
+        with patch.object(self.cache._storage, 'open', return_value=self._s3_file('TEST', -1)):
+            self.assertEqual(self.cache.get('my-key'), 'TEST')
+
+    def test_get_or_set_refreshes_stale_value_in_background(self):
+        fname = _key_to_file(self.cache.make_key('my-key'))
+        with patch.object(self.cache._storage, 'open', return_value=self._s3_file('OLD', -1)), \
+             patch.object(self.cache, '_set') as set_mock:
+            self.assertEqual(self.cache.get_or_set('my-key', lambda: 'NEW', 10), 'OLD')
+            self.cache._executor.shutdown()
+        self.assertEqual(set_mock.call_args[0][:3], (fname, 'NEW', 10))
+        self.assertIn('delta', set_mock.call_args[1])
+
+    def test_get_or_set_does_not_refresh_fresh_value(self):
+        with patch.object(self.cache._storage, 'open', return_value=self._s3_file('OLD', +10)), \
+             patch.object(self.cache, '_set') as set_mock:
+            self.assertEqual(self.cache.get_or_set('my-key', lambda: 'NEW', 10), 'OLD')
+            self.cache._executor.shutdown()
+        self.assertFalse(set_mock.called)
+
+    def test_early_expiration(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'EARLY_EXPIRATION_BETA': 1}})
+        fresh_until = time.time() + 10
+        with patch('s3cache.random.random', return_value=0.0):
+            # -log(1.0) == 0 so the value is fresh no matter how long it took
+            self.assertTrue(cache._is_fresh(fresh_until, 100))
+        with patch('s3cache.random.random', return_value=0.99):
+            # -log(0.01) * 5 is about 23 seconds before it expires
+            self.assertFalse(cache._is_fresh(fresh_until, 5))
+            self.assertTrue(cache._is_fresh(fresh_until, 1))
+            self.assertTrue(cache._is_fresh(None, 5))
+
+    def test_expired_object_is_deleted_inline_without_worker_pool(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_WORKERS': 1}})
+        with patch.object(AmazonS3Cache, '_delete', side_effect=IOError) as delete_mock:
+            self.assertTrue(cache._has_expired(time.time() - 1, 'fname'))
+            self.assertEqual(delete_mock.call_count, 1)
+
+
+class ShardingTest(S3CacheTestCase):
+    def setUp(self):
+        super(ShardingTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'SHARDS': 16, 'LOCATION': 'cache'}})
+
+    def test_disabled_by_default(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'SHARDS': 1}})
+        self.assertEqual(cache._key_to_fname('my-key'), _key_to_file('my-key'))
+        self.assertEqual(cache._list_prefixes(), [''])
+
+    def test_key_is_stored_under_shard(self):
+        digest = _key_to_file('my-key')
+        shard = '%x' % (int(digest[:8], 16) % 16)
+        self.assertEqual(self.cache._key_to_fname('my-key'), '%s/%s' % (shard, digest))
+
+    def test_keys_are_spread_over_shards(self):
+        shards = set(self.cache._key_to_fname('key-%d' % i).split('/')[0] for i in range(200))
+        self.assertEqual(len(shards), 16)
+
+    def test_shard_names_have_same_width(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'SHARDS': 20}})
+        prefixes = cache._list_prefixes()
+        self.assertEqual(prefixes[0], '00/')
+        self.assertEqual(prefixes[-1], '13/')
+        self.assertEqual(len(set(prefixes)), 20)
+
+    def test_generations_are_inside_shards(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'SHARDS': 16, 'GENERATIONS': True}})
+        with patch.object(cache._storage, 'open', return_value=BytesIO(b'7')):
+            shard, generation, _digest = cache._key_to_fname('my-key').split('/')
+            self.assertEqual(generation, '7')
+            self.assertIn(cache._list_prefix(shard), cache._list_prefixes())
+            self.assertEqual(cache._list_prefix(shard), '%s/7/' % shard)
+
+    def test_every_shard_is_listed(self):
+        def _get_all_keys(prefix, marker):
+            if prefix == 'cache/0/' and not marker:
+                return KeyPage(['cache/0/a', 'cache/0/b'], True)
+            if prefix == 'cache/0/':
+                return KeyPage(['cache/0/c'], False)
+            return KeyPage([prefix + 'x'], False)
+
+        with patch.object(self.cache._storage, '_bucket') as _bucket:
+            _bucket.configure_mock(**{'get_all_keys.side_effect': _get_all_keys})
+            self.assertEqual(self.cache._num_entries, 18)
+            prefixes = set(call[1]['prefix'] for call in _bucket.get_all_keys.call_args_list)
+        self.assertEqual(len(prefixes), 16)
+
+    def test_clear_deletes_every_shard(self):
+        with patch.object(self.cache._storage, '_bucket') as _bucket:
+            _bucket.configure_mock(**{'get_all_keys.side_effect':
+                                      lambda prefix, marker: KeyPage([prefix + 'x'], False)})
+            self.cache.clear()
+            self.assertEqual(_bucket.delete_keys.call_count, 16)
+
+    def test_sweep_deletes_keys_outside_shards(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'SHARDS': 16, 'GENERATIONS': True,
+                                                 'LOCATION': 'cache'}})
+        names = ['cache/generation', 'cache/a/6/aaa', 'cache/a/7/bbb',
+                 'cache/7/ccc', 'cache/ddd']
+        with patch.object(cache._storage, 'open', return_value=BytesIO(b'7')), \
+             patch.object(cache._storage, '_bucket') as _bucket:
+            _bucket.configure_mock(**{'get_all_keys.return_value': KeyPage(names, False)})
+            cache.sweep()
+            deleted = [key.name for key in _bucket.delete_keys.call_args[0][0]]
+        self.assertEqual(deleted, ['cache/a/6/aaa', 'cache/7/ccc', 'cache/ddd'])
+
+
+class WriteBehindQueueTest(TestCase):
+    def test_coalesces_writes_of_same_name(self):
+        queue = WriteBehindQueue(Mock(), Mock(), workers=0)
+        self.assertTrue(queue.put('one', (SET, 1, b'old', {})))
+        self.assertTrue(queue.put('one', (SET, 2, b'new', {})))
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.get('one'), (SET, 2, b'new', {}))
+        self.assertIsNone(queue.get('two'))
+
+    def test_full_queue(self):
+        queue = WriteBehindQueue(Mock(), Mock(), maxsize=1, workers=0)
+        self.assertTrue(queue.put('one', (SET, 1, b'', {})))
+        self.assertFalse(queue.put('two', (SET, 1, b'', {})))
+        # replacing a pending entry is always possible
+        self.assertTrue(queue.put('one', (DELETE, None, None, None)))
+
+    def test_deletes_are_batched(self):
+        queue = WriteBehindQueue(Mock(), Mock(), workers=0)
+        queue.put('one', (DELETE, None, None, None))
+        queue.put('two', (SET, 1, b'', {}))
+        queue.put('three', (DELETE, None, None, None))
+        self.assertEqual([name for (name, _entry) in queue._take()], ['one', 'three'])
+        self.assertEqual([name for (name, _entry) in queue._take()], ['two'])
+        self.assertEqual(queue._take(), [])
+        # in-flight entries are still visible
+        self.assertEqual(queue.get('two'), (SET, 1, b'', {}))
+
+    def test_same_name_is_not_written_concurrently(self):
+        queue = WriteBehindQueue(Mock(), Mock(), workers=0)
+        queue.put('one', (SET, 1, b'old', {}))
+        queue._take()
+        queue.put('one', (SET, 2, b'new', {}))
+        self.assertEqual(queue._take(), [])
+        self.assertEqual(queue.get('one'), (SET, 2, b'new', {}))
+
+    def test_flush_waits_for_uploader_threads(self):
+        written = []
+        release = threading.Event()
+
+        def _write(name, entry):
+            release.wait(5)
+            written.append((name, entry[2]))
+
+        queue = WriteBehindQueue(_write, Mock())
+        queue.put('one', (SET, 1, b'1', {}))
+        queue.put('two', (SET, 1, b'2', {}))
+        self.assertFalse(queue.flush(0.05))
+        release.set()
+        self.assertTrue(queue.flush(5))
+        self.assertEqual(sorted(written), [('one', b'1'), ('two', b'2')])
+        self.assertEqual(len(queue), 0)
+
+    def test_failed_write_is_dropped(self):
+        queue = WriteBehindQueue(Mock(side_effect=IOError), Mock())
+        queue.put('one', (SET, 1, b'', {}))
+        self.assertTrue(queue.flush(5))
+        self.assertIsNone(queue.get('one'))
+
+
+class WriteBehindTest(S3CacheTestCase):
+    def setUp(self):
+        super(WriteBehindTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'WRITE_BEHIND': True,
+                                                       'WRITE_BEHIND_QUEUE_SIZE': 2,
+                                                       'MAX_ENTRIES': 0}})
+        # nothing is uploaded unless a test starts the uploader threads
+        self.cache._write_behind.workers = 0
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(AmazonS3Cache(None, {})._write_behind)
+
+    def test_set_is_read_back_before_upload(self):
+        with patch.object(self.cache._storage, 'save') as save_mock, \
+             patch.object(self.cache._storage, 'open') as open_mock:
+            self.cache.set('my-key', 'TEST')
+            self.assertEqual(self.cache.get('my-key'), 'TEST')
+            self.assertTrue(self.cache.has_key('my-key'))
+            self.assertFalse(save_mock.called)
+            self.assertFalse(open_mock.called)
+
+    def test_pending_value_is_a_copy(self):
+        value = ['TEST']
+        self.cache.set('my-key', value)
+        value.append('changed')
+        self.assertEqual(self.cache.get('my-key'), ['TEST'])
+
+    def test_expired_pending_value(self):
+        self.cache.set('my-key', 'TEST', -1)
+        self.assertIsNone(self.cache.get('my-key'))
+        self.assertFalse(self.cache.has_key('my-key'))
+
+    def test_delete_hides_pending_value(self):
+        with patch.object(self.cache._storage, 'delete') as delete_mock, \
+             patch.object(self.cache._storage, 'open') as open_mock:
+            self.cache.set('my-key', 'TEST')
+            self.cache.delete('my-key')
+            self.assertEqual(self.cache.get('my-key', 'default'), 'default')
+            self.assertFalse(delete_mock.called)
+            self.assertFalse(open_mock.called)
+
+    def test_full_queue_writes_synchronously(self):
+        with patch.object(self.cache._storage, 'save') as save_mock:
+            self.assertEqual(self.cache.set_many({'one': 1, 'two': 2, 'three': 3}), [])
+            self.assertEqual(save_mock.call_count, 1)
+        self.assertEqual(len(self.cache._write_behind), 2)
+
+    def test_uploader_writes_same_format_as_set(self):
+        # another location has a queue of its own
+        cache = AmazonS3Cache(None, {'OPTIONS': {'WRITE_BEHIND': True, 'MAX_ENTRIES': 0,
+                                                 'LOCATION': 'uploads'}})
+        with patch.object(cache._storage, 'save') as save_mock:
+            cache.set('my-key', 'TEST', 10)
+            self.assertTrue(cache.flush(5))
+        fname, content = save_mock.call_args[0]
+        self.assertEqual(fname, _key_to_file(cache.make_key('my-key')))
+        self.assertIn(EXPIRY_METADATA, content.metadata)
+        with patch.object(cache._storage, 'open', return_value=BytesIO(content.read())):
+            self.assertEqual(cache.get('my-key'), 'TEST')
+
+    def test_uploader_batches_deletes(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'WRITE_BEHIND': True, 'LOCATION': 'uploads'}})
+        cache._write_behind.workers = 0
+        with patch.object(cache._storage, '_bucket') as _bucket:
+            cache.delete_many(['one', 'two'])
+            cache._write_behind.workers = 1
+            cache.delete('three')
+            self.assertTrue(cache.flush(5))
+            self.assertEqual(_bucket.delete_keys.call_count, 1)
+            self.assertEqual(len(_bucket.delete_keys.call_args[0][0]), 3)
+
+    def test_clear_drops_pending_writes(self):
+        with patch.object(self.cache._storage, '_bucket') as _bucket:
+            _bucket.configure_mock(**{'get_all_keys.return_value': KeyPage([], False)})
+            self.cache.set('my-key', 'TEST')
+            self.cache.clear()
+        self.assertEqual(len(self.cache._write_behind), 0)
+
+
+class BloomFilterTest(TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        names = ['cache/%s' % _key_to_file('key-%d' % i) for i in range(1000)]
+        for name in names:
+            bloom.add(name)
+        self.assertTrue(all(name in bloom for name in names))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add('key-%d' % i)
+        false_positives = sum('other-%d' % i in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class NegativeCacheTest(S3CacheTestCase):
+    def setUp(self):
+        super(NegativeCacheTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'NEGATIVE_TIMEOUT': 5, 'MAX_ENTRIES': 0}})
+
+    def test_disabled_by_default(self):
+        cache = AmazonS3Cache(None, {})
+        self.assertIsNone(cache._misses)
+        self.assertIsNone(cache._bloom)
+
+    def test_miss_is_shared_by_instances(self):
+        other = AmazonS3Cache(None, {'OPTIONS': {'NEGATIVE_TIMEOUT': 5, 'MAX_ENTRIES': 0}})
+        with patch.object(self.cache._storage, 'open',
+                          side_effect=FileNotFoundError) as open_mock:
+            self.assertIsNone(self.cache.get('my-key'))
+        with patch.object(other._storage, 'open') as other_open_mock:
+            self.assertIsNone(other.get('my-key'))
+        self.assertEqual(open_mock.call_count, 1)
+        self.assertFalse(other_open_mock.called)
+
+    def test_miss_is_remembered(self):
+        with patch.object(self.cache._storage, 'open',
+                          side_effect=FileNotFoundError) as open_mock:
+            self.assertIsNone(self.cache.get('my-key'))
+            self.assertIsNone(self.cache.get('my-key'))
+            self.assertFalse(self.cache.has_key('my-key'))
+            self.assertEqual(open_mock.call_count, 1)
+
+    def test_failed_request_is_not_remembered(self):
+        with patch.object(self.cache._storage, 'open', side_effect=IOError) as open_mock:
+            self.assertIsNone(self.cache.get('my-key'))
+            self.assertIsNone(self.cache.get('my-key'))
+            self.assertEqual(open_mock.call_count, 2)
+
+    def test_expired_object_is_remembered(self):
+        with patch.object(self.cache._storage, 'open',
+                          return_value=BytesIO(self.cache._dump_object('TEST', -1))) as open_mock, \
+             patch.object(AmazonS3Cache, '_delete'):
+            self.assertFalse(self.cache.has_key('my-key'))
+            self.assertIsNone(self.cache.get('my-key'))
+            self.assertEqual(open_mock.call_count, 1)
+
+    def test_set_forgets_miss(self):
+        with patch.object(self.cache._storage, 'open', side_effect=FileNotFoundError):
+            self.assertIsNone(self.cache.get('my-key'))
+        with patch.object(self.cache._storage, 'save'):
+            self.cache.set('my-key', 'TEST')
+        with patch.object(self.cache._storage, 'open',
+                          return_value=BytesIO(self.cache._dump_object('TEST', +10))):
+            self.assertEqual(self.cache.get('my-key'), 'TEST')
+
+    def test_missing_file_raises_file_not_found(self):
+        storage = self.cache._storage
+        with patch.object(storage, '_bucket') as _bucket:
+            _bucket.get_key.return_value = None
+            self.assertRaises(FileNotFoundError, storage.open, 'missing')
+
+
+class KeyFilterTest(S3CacheTestCase):
+    def setUp(self):
+        super(KeyFilterTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'BLOOM_FILTER': True, 'MAX_ENTRIES': 0,
+                                                       'LOCATION': 'cache'}})
+        self.stored = _key_to_file(self.cache.make_key('stored'))
+
+    def _build(self):
+        with patch.object(self.cache._storage, '_bucket') as _bucket:
+            _bucket.configure_mock(**{'get_all_keys.return_value':
+                                      KeyPage(['cache/' + self.stored], False)})
+            self.cache._rebuild_bloom()
+            self.cache._executor.shutdown()
+            # the next batch gets a new pool
+            s3cache.retry._shared.pop((ThreadPoolExecutor, 'batch', self.cache._max_workers))
+
+    def test_unknown_until_built(self):
+        with patch.object(self.cache, '_rebuild_bloom') as rebuild_mock:
+            self.assertFalse(self.cache._known_missing(self.stored))
+            self.assertEqual(rebuild_mock.call_count, 1)
+
+    def test_definite_miss_is_not_requested(self):
+        self._build()
+        with patch.object(self.cache._storage, 'open',
+                          return_value=BytesIO(self.cache._dump_object('TEST', +10))) as open_mock:
+            self.assertIsNone(self.cache.get('missing'))
+            self.assertFalse(self.cache.has_key('missing'))
+            self.assertEqual(open_mock.call_count, 0)
+            self.assertEqual(self.cache.get('stored'), 'TEST')
+            self.assertEqual(open_mock.call_count, 1)
+
+    def test_local_writes_are_added(self):
+        self._build()
+        with patch.object(self.cache._storage, 'save'):
+            self.cache.set('new', 'TEST')
+        self.assertFalse(self.cache._known_missing(_key_to_file(self.cache.make_key('new'))))
+
+    def test_filter_is_rebuilt_after_refresh(self):
+        self._build()
+        self.cache._bloom.built_at -= 301
+        with patch.object(self.cache, '_rebuild_bloom') as rebuild_mock:
+            self.cache._known_missing(self.stored)
+            self.assertEqual(rebuild_mock.call_count, 1)
+
+    def test_filter_is_shared_by_instances(self):
+        self._build()
+        other = AmazonS3Cache(None, {'OPTIONS': {'BLOOM_FILTER': True, 'MAX_ENTRIES': 0,
+                                                 'LOCATION': 'cache'}})
+        self.assertIs(other._bloom, self.cache._bloom)
+        self.assertTrue(other._known_missing(_key_to_file(other.make_key('missing'))))
+
+    def test_clear_empties_filter(self):
+        self._build()
+        with patch.object(self.cache._storage, '_bucket') as _bucket:
+            _bucket.configure_mock(**{'get_all_keys.return_value': KeyPage([], False)})
+            self.cache.clear()
+        self.assertTrue(self.cache._known_missing(self.stored))
+
+
+class CacheStatsTest(TestCase):
+    def test_latency_histogram(self):
+        stats = CacheStats()
+        for duration in (0.0005, 0.002, 0.002, 0.3, 20):
+            stats.record('get', duration)
+        result = stats.as_dict()['get']
+        self.assertEqual(result['calls'], 5)
+        self.assertEqual(result['max_time'], 20)
+        self.assertEqual(result['p50'], 0.0025)
+        self.assertIsNone(result['p99'])
+        self.assertEqual(dict(result['histogram'])[0.0025], 2)
+        self.assertEqual(dict(result['histogram'])[None], 1)
+
+    def test_errors_by_type(self):
+        stats = CacheStats()
+        stats.error('set', IOError())
+        stats.error('set', pickle.PicklingError())
+        stats.record('set', 0.1, ValueError())
+        self.assertEqual(stats.as_dict()['set']['errors'],
+                         {'OSError': 1, 'PicklingError': 1, 'ValueError': 1})
+
+    def test_hit_ratio(self):
+        stats = CacheStats()
+        self.assertIsNone(stats.as_dict()['hit_ratio'])
+        stats.incr('hits', 3)
+        stats.incr('misses')
+        self.assertEqual(stats.as_dict()['hit_ratio'], 0.75)
+        stats.reset()
+        self.assertEqual(stats.as_dict()['hits'], 0)
+
+
+class CacheMetricsTest(S3CacheTestCase):
+    def setUp(self):
+        super(CacheMetricsTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 0}})
+
+    def test_get_counters(self):
+        body = self.cache._dump_object('TEST', +10)
+        with patch.object(self.cache._storage, 'open', side_effect=[BytesIO(body), IOError]):
+            self.cache.get('my-key')
+            self.cache.get('other-key')
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['get']['calls'], 2)
+        self.assertEqual(stats['get']['errors'], {'OSError': 1})
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['bytes_read'], len(pickle.dumps('TEST', pickle.HIGHEST_PROTOCOL)))
+
+    def test_missing_key_is_not_an_error(self):
+        with patch.object(self.cache._storage, 'open', side_effect=FileNotFoundError):
+            self.assertFalse(self.cache.has_key('my-key'))
+        self.assertEqual(self.cache.stats()['has_key']['errors'], {})
+
+    def test_set_counters(self):
+        with patch.object(self.cache._storage, 'save', side_effect=[None, IOError]):
+            self.cache.set('my-key', 'TEST')
+            self.assertEqual(self.cache.set_many({'one': 1}), ['one'])
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['set']['calls'], 2)
+        self.assertEqual(stats['set']['errors'], {'OSError': 1})
+        self.assertEqual(stats['bytes_written'], len(self.cache._dump_object('TEST')))
+
+    def test_cull_is_measured(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 10}})
+        with patch.object(cache._storage, '_bucket') as _bucket:
+            _bucket.configure_mock(**{'get_all_keys.side_effect': OSError})
+            cache._run_cull()
+        self.assertEqual(cache.stats()['cull']['calls'], 1)
+        self.assertEqual(cache.stats()['cull']['errors'], {'OSError': 1})
+
+    def test_signal(self):
+        received = []
+
+        def _receiver(sender, **kwargs):
+            received.append((sender, kwargs['operation'], kwargs['error']))
+
+        cache_operation.connect(_receiver)
+        self.addCleanup(cache_operation.disconnect, _receiver)
+        with patch.object(self.cache._storage, 'delete'):
+            self.cache.delete('my-key')
+        self.assertEqual(received, [(AmazonS3Cache, 'delete', None)])
+
+
+class TouchTest(S3CacheTestCase):
+    def setUp(self):
+        super(TouchTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 0}})
+
+    def _key(self, timeout, **metadata):
+        key = Mock()
+        key.etag = '"etag"'
+        key.metadata = dict(metadata)
+        if timeout is not None:
+            key.metadata[EXPIRY_METADATA] = repr(time.time() + timeout)
+        return key
+
+    def test_touch_replaces_metadata(self):
+        fname = _key_to_file(self.cache.make_key('my-key'))
+        with patch.object(self.cache._storage, '_bucket') as _bucket, \
+             patch.object(self.cache._storage, 'replace_metadata',
+                          return_value=True) as replace_mock, \
+             patch.object(self.cache._storage, 'save') as save_mock:
+            _bucket.get_key.return_value = self._key(+10)
+            self.assertTrue(self.cache.touch('my-key', 100))
+            self.assertFalse(save_mock.called)
+            self.assertFalse(_bucket.get_key.return_value.get_contents_as_string.called)
+
+        args, kwargs = replace_mock.call_args
+        self.assertEqual(args[0], fname)
+        self.assertTrue(time.time() + 90 < float(args[1][EXPIRY_METADATA]) <= time.time() + 100)
+        self.assertEqual(kwargs['etag'], '"etag"')
+
+    def test_touch_missing_key(self):
+        with patch.object(self.cache._storage, '_bucket') as _bucket, \
+             patch.object(self.cache._storage, 'replace_metadata') as replace_mock:
+            _bucket.get_key.return_value = None
+            self.assertFalse(self.cache.touch('my-key'))
+            self.assertFalse(replace_mock.called)
+
+    def test_touch_expired_key(self):
+        with patch.object(self.cache._storage, '_bucket') as _bucket, \
+             patch.object(self.cache._storage, 'replace_metadata') as replace_mock, \
+             patch.object(AmazonS3Cache, '_delete'):
+            _bucket.get_key.return_value = self._key(-1)
+            self.assertFalse(self.cache.touch('my-key', 100))
+            self.assertFalse(replace_mock.called)
+
+    def test_touch_retries_when_object_changed(self):
+        with patch.object(self.cache._storage, '_bucket') as _bucket, \
+             patch.object(self.cache._storage, 'replace_metadata',
+                          side_effect=[False, True]) as replace_mock:
+            _bucket.get_key.return_value = self._key(+10)
+            self.assertTrue(self.cache.touch('my-key'))
+            self.assertEqual(_bucket.get_key.call_count, 2)
+            self.assertEqual(replace_mock.call_count, 2)
+
+    def test_touch_object_without_metadata_reads_only_expiry(self):
+        key = self._key(None)
+        key.get_contents_as_string.return_value = self.cache._dump_object('TEST', +10)[:64]
+        with patch.object(self.cache._storage, '_bucket') as _bucket, \
+             patch.object(self.cache._storage, 'replace_metadata', return_value=True):
+            _bucket.get_key.return_value = key
+            self.assertTrue(self.cache.touch('my-key'))
+        key.get_contents_as_string.assert_called_with(headers={'Range': 'bytes=0-63'})
+
+    def test_touch_keeps_delta(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'STALE_TIMEOUT': 30}})
+        with patch.object(cache._storage, '_bucket') as _bucket, \
+             patch.object(cache._storage, 'replace_metadata', return_value=True) as replace_mock:
+            _bucket.get_key.return_value = self._key(+10, **{DELTA_METADATA: '2.5'})
+            self.assertTrue(cache.touch('my-key', 100))
+
+        metadata = replace_mock.call_args[0][1]
+        self.assertEqual(metadata[DELTA_METADATA], '2.5')
+        self.assertAlmostEqual(float(metadata[EXPIRY_METADATA]) - float(metadata[FRESH_METADATA]), 30)
+
+    def test_touch_error(self):
+        with patch.object(self.cache._storage, '_bucket') as _bucket:
+            _bucket.get_key.side_effect = IOError
+            self.assertFalse(self.cache.touch('my-key'))
+        self.assertEqual(self.cache.stats()['touch']['errors'], {'OSError': 1})
+
+    def test_touch_pending_write(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'WRITE_BEHIND': True, 'MAX_ENTRIES': 0}})
+        cache._write_behind.workers = 0
+        with patch.object(cache._storage, '_bucket') as _bucket:
+            cache.set('my-key', 'TEST', 1)
+            self.assertTrue(cache.touch('my-key', 100))
+            self.assertFalse(_bucket.called)
+
+        entry = cache._write_behind.get(_key_to_file(cache.make_key('my-key')))
+        self.assertTrue(time.time() + 90 < entry[1] <= time.time() + 100)
+        self.assertEqual(float(entry[3][EXPIRY_METADATA]), entry[1])
+        self.assertEqual(cache.get('my-key'), 'TEST')
+
+    def test_touch_pending_delete(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'WRITE_BEHIND': True, 'MAX_ENTRIES': 0}})
+        cache._write_behind.workers = 0
+        cache.delete('my-key')
+        self.assertFalse(cache.touch('my-key'))
+
+    def test_storage_copies_object_onto_itself(self):
+        storage = self.cache._storage
+        with patch.object(storage, '_bucket') as _bucket:
+            _bucket.name = 'bucket'
+            self.assertTrue(storage.replace_metadata('name', {EXPIRY_METADATA: '1.5'},
+                                                     etag='"etag"'))
+            args, kwargs = _bucket.copy_key.call_args
+            self.assertEqual(args, ('name', 'bucket', 'name'))
+            self.assertEqual(kwargs['metadata'], {EXPIRY_METADATA: '1.5'})
+            self.assertEqual(kwargs['headers']['x-amz-copy-source-if-match'], '"etag"')
+
+            _bucket.copy_key.side_effect = S3ResponseError(412, 'Precondition Failed')
+            self.assertFalse(storage.replace_metadata('name', {}))
+            _bucket.copy_key.side_effect = S3ResponseError(500, 'Internal Error')
+            with self.assertRaises(S3ResponseError):
+                storage.replace_metadata('name', {})
+
+
+class IncrTest(S3CacheTestCase):
+    def setUp(self):
+        super(IncrTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 0}})
+
+    def _key(self, value, timeout=+10, etag='"etag"'):
+        key = Mock()
+        key.etag = etag
+        key.metadata = {EXPIRY_METADATA: repr(time.time() + timeout)}
+        key.read.return_value = self.cache._dump_object(value, timeout)
+        return key
+
+    def test_incr_is_a_conditional_put(self):
+        key = self._key(41)
+        with patch.object(self.cache._storage, 'open_key', return_value=key), \
+             patch.object(self.cache._storage, 'replace', return_value=True) as replace_mock, \
+             patch.object(self.cache._storage, 'save') as save_mock, \
+             patch.object(self.cache, '_maybe_cull') as cull_mock:
+            self.assertEqual(self.cache.incr('my-key'), 42)
+            self.assertFalse(save_mock.called)
+            self.assertFalse(cull_mock.called)
+
+        fname, content, etag = replace_mock.call_args[0]
+        self.assertEqual(fname, _key_to_file(self.cache.make_key('my-key')))
+        self.assertEqual(etag, '"etag"')
+        # the expiry time is kept
+        self.assertEqual(content.metadata[EXPIRY_METADATA], key.metadata[EXPIRY_METADATA])
+        self.assertEqual(pickle.loads(content.read()), float(key.metadata[EXPIRY_METADATA]))
+
+    def test_decr(self):
+        with patch.object(self.cache._storage, 'open_key', return_value=self._key(10)), \
+             patch.object(self.cache._storage, 'replace', return_value=True):
+            self.assertEqual(self.cache.decr('my-key', 3), 7)
+
+    def test_incr_retries_when_value_changed(self):
+        keys = [self._key(1, etag='"one"'), self._key(5, etag='"two"')]
+        with patch.object(self.cache._storage, 'open_key', side_effect=keys), \
+             patch.object(self.cache._storage, 'replace',
+                          side_effect=[False, True]) as replace_mock, \
+             patch('s3cache.INCR_BACKOFF', 0):
+            self.assertEqual(self.cache.incr('my-key'), 6)
+        self.assertEqual(replace_mock.call_args[0][2], '"two"')
+
+    def test_incr_gives_up(self):
+        with patch.object(self.cache._storage, 'open_key', side_effect=lambda _f: self._key(1)), \
+             patch.object(self.cache._storage, 'replace', return_value=False), \
+             patch('s3cache.INCR_BACKOFF', 0):
+            with self.assertRaises(IOError):
+                self.cache.incr('my-key')
+        self.assertEqual(self.cache.stats()['incr']['errors'], {'OSError': 1})
+
+    def test_incr_missing_key(self):
+        with patch.object(self.cache._storage, 'open_key', side_effect=FileNotFoundError):
+            with self.assertRaises(ValueError):
+                self.cache.incr('my-key')
+
+    def test_incr_expired_key(self):
+        with patch.object(self.cache._storage, 'open_key', return_value=self._key(1, -1)), \
+             patch.object(self.cache._storage, 'replace') as replace_mock, \
+             patch.object(AmazonS3Cache, '_delete'):
+            with self.assertRaises(ValueError):
+                self.cache.incr('my-key')
+            self.assertFalse(replace_mock.called)
+
+    def test_storage_replace_sends_if_match(self):
+        storage = self.cache._storage
+        with patch.object(storage, '_bucket'), \
+             patch.object(storage, '_save_content') as save_mock:
+            self.assertTrue(storage.replace('name', CacheContentFile(b''), '"etag"'))
+            self.assertEqual(save_mock.call_args[1]['headers']['If-Match'], '"etag"')
+
+            save_mock.side_effect = S3ResponseError(412, 'Precondition Failed')
+            self.assertFalse(storage.replace('name', CacheContentFile(b''), '"etag"'))
+
+
+class BatchedIncrTest(S3CacheTestCase):
+    def setUp(self):
+        super(BatchedIncrTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 0,
+                                                       'COUNTER_FLUSH_INTERVAL': 60}})
+        self.fname = _key_to_file(self.cache.make_key('my-key'))
+
+    def tearDown(self):
+        with self.cache._counters._lock:
+            if self.cache._counters._timer is not None:
+                self.cache._counters._timer.cancel()
+        self.cache._counters.clear()
+
+    def test_increments_are_added_up(self):
+        with patch.object(self.cache, '_incr', return_value=10) as incr_mock:
+            self.assertEqual(self.cache.incr('my-key'), 10)
+            self.assertEqual(self.cache.incr('my-key'), 11)
+            self.assertEqual(self.cache.incr('my-key', 5), 16)
+            self.assertEqual(self.cache.decr('my-key', 2), 14)
+            self.assertEqual(incr_mock.call_count, 1)
+
+            self.cache.flush()
+            incr_mock.assert_called_with(self.fname, 4)
+            self.assertEqual(incr_mock.call_count, 2)
+
+        # read again after a flush
+        self.assertEqual(self.cache._counters._counters, {})
+
+    def test_flush_is_scheduled(self):
+        self.cache._counters.interval = 0.01
+        with patch.object(self.cache, '_incr', return_value=1) as incr_mock:
+            self.cache.incr('my-key')
+            self.cache.incr('my-key')
+            timer = self.cache._counters._timer
+            timer.join()
+            incr_mock.assert_called_with(self.fname, 1)
+
+    def test_set_drops_increments(self):
+        with patch.object(self.cache, '_incr', return_value=1) as incr_mock, \
+             patch.object(self.cache._storage, 'save'):
+            self.cache.incr('my-key')
+            self.cache.incr('my-key')
+            self.cache.set('my-key', 0)
+            self.cache.flush()
+            self.assertEqual(incr_mock.call_count, 1)
+
+    def test_delete_drops_increments(self):
+        with patch.object(self.cache, '_incr', return_value=1) as incr_mock, \
+             patch.object(self.cache._storage, 'delete'):
+            self.cache.incr('my-key')
+            self.cache.incr('my-key')
+            self.cache.delete('my-key')
+            self.cache.flush()
+            self.assertEqual(incr_mock.call_count, 1)
+
+    def test_instances_share_counters(self):
+        other = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 0,
+                                                  'COUNTER_FLUSH_INTERVAL': 60}})
+        self.assertIs(other._counters, self.cache._counters)
+        with patch.object(self.cache, '_incr', return_value=10) as incr_mock, \
+             patch.object(other, '_incr', return_value=10) as other_mock, \
+             patch.object(other._storage, 'delete'):
+            self.assertEqual(self.cache.incr('my-key'), 10)
+            self.assertEqual(other.incr('my-key'), 11)
+            self.assertEqual(self.cache.incr('my-key'), 12)
+            self.assertEqual(other_mock.call_count, 0)
+
+            # deleted by another thread
+            other.delete('my-key')
+            self.cache.flush()
+            self.assertEqual(incr_mock.call_count, 1)
+
+
+class FakeSegmentKey(object):
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+
+class FakeSegmentStorage(object):
+    """
+        The subset of S3CacheStorage which SegmentStore uses
+    """
+    def __init__(self):
+        self.objects = {}
+        self.ranges = 0
+        self.fail = False
+
+    def save(self, name, content):
+        if self.fail:
+            raise IOError('upload failed')
+        self.objects[name] = content.read()
+
+    def open_key(self, name):
+        if name not in self.objects:
+            raise FileNotFoundError(name)
+        return BytesIO(self.objects[name])
+
+    def read_range(self, name, offset, length):
+        if name not in self.objects:
+            raise FileNotFoundError(name)
+        self.ranges += 1
+        return self.objects[name][offset:offset + length]
+
+    def list_keys(self, prefix):
+        return [FakeSegmentKey(name, len(body)) for (name, body) in sorted(self.objects.items())
+                if name.startswith(prefix)]
+
+    def delete(self, names):
+        for name in names:
+            self.objects.pop(name, None)
+
+    def store(self, **kwargs):
+        return SegmentStore(self, lambda: 'segments/', self.list_keys, self.delete,
+                            lambda func, *args: func(*args), Mock(), **kwargs)
+
+
+class SegmentTest(TestCase):
+    def test_append_and_read(self):
+        segment = Segment()
+        segment.append('a', b'first', 10)
+        segment.append('b', b'second', 20, 5, 0.1)
+        self.assertEqual(segment.entries['b'], (0, 5, 6, 20, 5, 0.1))
+        self.assertEqual(segment.read(5, 6), b'second')
+
+    def test_latest_entry_wins(self):
+        segment = Segment()
+        segment.append('a', b'first', 10)
+        segment.mark('a', DELETED)
+        self.assertEqual(pickle.loads(segment.dump_index()),
+                         [('a', DELETED, None, None, None, None, None)])
+
+    def test_ids_sort_in_start_order(self):
+        first = Segment()
+        time.sleep(0.001)
+        self.assertTrue(first.id < Segment().id)
+
+
+class SegmentStoreTest(TestCase):
+    def setUp(self):
+        self.storage = FakeSegmentStorage()
+        self.store = self.storage.store(flush_interval=60)
+        self.expiry = time.time() + 100
+
+    def tearDown(self):
+        self.store.clear()
+
+    def test_value_is_read_from_open_segment(self):
+        self.store.append('a', b'value', self.expiry)
+        self.assertEqual(self.store.get('a'), (b'value', self.expiry, None, None))
+        self.assertTrue(self.store.contains('a'))
+        self.assertEqual(self.storage.objects, {})
+
+    def test_unknown_name(self):
+        self.assertIsNone(self.store.get('a'))
+        self.assertIsNone(self.store.contains('a'))
+
+    def test_flush_uploads_data_and_index(self):
+        self.store.append('a', b'value', self.expiry)
+        self.assertTrue(self.store.flush())
+        self.assertEqual(sorted(name.rsplit('.', 1)[1] for name in self.storage.objects),
+                         ['data', 'index'])
+
+        # read with a ranged request
+        self.assertEqual(self.store.get('a'), (b'value', self.expiry, None, None))
+        self.assertEqual(self.storage.ranges, 1)
+
+    def test_full_segment_is_uploaded(self):
+        store = self.storage.store(segment_size=10, flush_interval=60)
+        store.append('a', b'0123456789', self.expiry)
+        self.assertEqual(len(self.storage.objects), 2)
+        self.assertEqual(store.get('a')[0], b'0123456789')
+
+    def test_other_process_reads_uploaded_values(self):
+        self.store.append('a', b'value', self.expiry)
+        self.store.flush()
+
+        other = self.storage.store()
+        self.assertEqual(other.get('a'), (b'value', self.expiry, None, None))
+        self.assertIsNone(other.get('b'))
+
+    def test_newer_segment_wins(self):
+        self.store.append('a', b'old', self.expiry)
+        self.store.flush()
+        time.sleep(0.001)
+        self.store.append('a', b'new', self.expiry)
+        self.store.flush()
+
+        other = self.storage.store()
+        self.assertEqual(other.get('a')[0], b'new')
+
+    def test_expired_value(self):
+        self.store.append('a', b'value', time.time() - 1)
+        self.assertEqual(self.store.get('a'), DELETED)
+        self.assertFalse(self.store.contains('a'))
+
+    def test_mark(self):
+        self.store.append('a', b'value', self.expiry)
+        self.store.flush()
+        self.store.mark('a', DELETED)
+        self.assertEqual(self.store.get('a'), DELETED)
+        self.store.mark('a', UNPACKED)
+        self.assertIsNone(self.store.get('a'))
+
+    def test_mark_unknown_name(self):
+        self.store.mark('a', DELETED)
+        self.assertEqual(self.store.get('a'), DELETED)
+        self.store.mark('a', UNPACKED)
+        self.assertIsNone(self.store.get('a'))
+
+    def test_mark_with_stale_index(self):
+        stale = self.storage.store(flush_interval=60, refresh_interval=3600)
+        self.assertIsNone(stale.get('a'))
+
+        # packed by another process after the last refresh of stale
+        time.sleep(0.001)
+        self.store.append('a', b'old', self.expiry)
+        self.store.append('b', b'old', self.expiry)
+        self.store.flush()
+
+        time.sleep(0.001)
+        stale.mark('a', DELETED)
+        stale.mark('b', UNPACKED)
+        stale.flush()
+        stale.refresh()
+        for store in (stale, self.storage.store()):
+            self.assertEqual(store.get('a'), DELETED)
+            self.assertIsNone(store.get('b'))
+
+    def test_failed_upload_keeps_deletes(self):
+        self.store.append('a', b'value', self.expiry)
+        self.store.flush()
+        self.store.mark('a', DELETED)
+        self.store.append('b', b'value', self.expiry)
+
+        self.storage.fail = True
+        self.store.flush()
+        self.assertEqual(self.store.get('a'), DELETED)
+        self.assertIsNone(self.store.get('b'))
+        self.assertEqual(self.store._error.call_count, 1)
+
+    def test_deleted_segment_is_forgotten(self):
+        self.store.append('a', b'value', self.expiry)
+        self.store.flush()
+        self.assertTrue(self.store.contains('a'))
+        self.storage.objects.clear()
+        self.assertEqual(self.store.get('a'), DELETED)
+        self.assertIsNone(self.store.get('a'))
+
+    def test_compact(self):
+        for i in range(10):
+            self.store.append('key-%d' % i, b'x' * 100, self.expiry)
+        self.store.flush()
+        time.sleep(0.001)
+        for i in range(8):
+            self.store.append('key-%d' % i, b'y' * 100, self.expiry)
+        self.store.mark('key-9', DELETED)
+        self.store.flush()
+
+        # the second segment is merged as it is less than half full
+        self.assertEqual(self.store.compact(), 900)
+        self.assertEqual(len(self.storage.objects), 2)
+        for store in (self.store, self.storage.store()):
+            self.assertEqual(store.get('key-0')[0], b'y' * 100)
+            self.assertEqual(store.get('key-8')[0], b'x' * 100)
+            self.assertIsNone(store.get('key-9'))
+
+    def test_compact_keeps_full_segments(self):
+        store = self.storage.store(segment_size=100, flush_interval=60)
+        store.append('a', b'x' * 100, self.expiry)
+        store.append('b', b'x' * 100, self.expiry)
+        objects = dict(self.storage.objects)
+        self.assertEqual(store.compact(), 0)
+        self.assertEqual(self.storage.objects, objects)
+
+    def test_compact_keeps_delete_of_older_value(self):
+        store = self.storage.store(segment_size=100, flush_interval=60)
+        store.append('a', b'x' * 10, self.expiry)
+        store.append('b', b'x' * 90, self.expiry)
+        time.sleep(0.001)
+        store.mark('a', DELETED)
+        store.append('c', b'x' * 10, self.expiry)
+        store.flush()
+        time.sleep(0.001)
+        store.append('c', b'y' * 10, self.expiry)
+        store.flush()
+
+        # the first segment is kept, its value of a must stay hidden
+        self.assertEqual(store.compact(), 10)
+        other = self.storage.store()
+        self.assertEqual(other.get('a'), DELETED)
+        self.assertEqual(other.get('b')[0], b'x' * 90)
+        self.assertEqual(other.get('c')[0], b'y' * 10)
+
+
+class PackedCacheTest(S3CacheTestCase):
+    def setUp(self):
+        super(PackedCacheTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 0, 'PACKED': True,
+                                                       'PACK_FLUSH_INTERVAL': 60}})
+        self.storage = FakeSegmentStorage()
+        packer = self.cache._packer
+        packer._storage = self.storage
+        packer._list_keys = self.storage.list_keys
+        packer._delete = self.storage.delete
+
+    def tearDown(self):
+        self.cache._packer.clear()
+
+    def test_small_values_are_packed(self):
+        with patch.object(self.cache._storage, 'save') as save_mock:
+            self.cache.set('my-key', 'TEST')
+            self.assertFalse(save_mock.called)
+        self.assertEqual(self.cache.get('my-key'), 'TEST')
+        self.assertTrue(self.cache.has_key('my-key'))
+
+        self.cache.flush()
+        self.assertEqual(len(self.storage.objects), 2)
+
+    def test_large_values_are_not_packed(self):
+        self.cache._packer.max_value_size = 10
+        with patch.object(self.cache._storage, 'save') as save_mock:
+            self.cache.set('my-key', 'TEST' * 10)
+            self.assertTrue(save_mock.called)
+        # only the mark which hides packed values of other processes
+        fname = _key_to_file(self.cache.make_key('my-key'))
+        self.assertEqual(list(self.cache._packer._open.entries), [fname])
+        self.assertIsNone(self.cache._packer.get(fname))
+
+    def test_large_value_replaces_packed_one(self):
+        self.cache.set('my-key', 'TEST')
+        self.cache._packer.max_value_size = 10
+        with patch.object(self.cache._storage, 'save'), \
+             patch.object(self.cache, '_fetch', return_value=None) as fetch_mock:
+            self.cache.set('my-key', 'TEST' * 10)
+            self.cache.get('my-key')
+            self.assertTrue(fetch_mock.called)
+
+    def test_delete(self):
+        self.cache.set('my-key', 'TEST')
+        with patch.object(self.cache._storage, '_bucket'):
+            self.cache.delete('my-key')
+        self.assertIsNone(self.cache.get('my-key'))
+        self.assertFalse(self.cache.has_key('my-key'))
+
+    def test_touch(self):
+        self.cache.set('my-key', 'TEST', 10)
+        with patch.object(self.cache._storage, 'replace_metadata') as replace_mock:
+            self.assertTrue(self.cache.touch('my-key', 100))
+            self.assertFalse(replace_mock.called)
+        exp = self.cache._packer.get(self.cache._key_to_fname(self.cache.make_key('my-key')))[1]
+        self.assertTrue(time.time() + 90 < exp <= time.time() + 100)
+
+    def test_incr_moves_value_to_own_object(self):
+        self.cache.set('my-key', 10)
+        with patch.object(self.cache._storage, 'create', return_value=True) as create_mock:
+            self.assertEqual(self.cache.incr('my-key', 5), 15)
+        fname = self.cache._key_to_fname(self.cache.make_key('my-key'))
+        self.assertEqual(create_mock.call_args[0][0], fname)
+        self.assertIsNone(self.cache._packer.get(fname))
+
+    def test_compact(self):
+        with patch.object(self.cache._packer, 'compact', return_value=10) as compact_mock:
+            self.assertEqual(self.cache.compact(0.3), 10)
+            compact_mock.assert_called_with(0.3)
+
+    def test_compact_without_packed(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 0}})
+        self.assertEqual(cache.compact(), 0)
+
+    def test_cull_skips_segments(self):
+        self.cache._max_entries = 1
+        self.cache._cull_frequency = 1
+        page = KeyPage([self.cache._key_name('segments/0.data'),
+                        self.cache._key_name('0' * 40)], False)
+        with patch.object(self.cache._storage, '_bucket') as _bucket:
+            _bucket.get_all_keys.return_value = page
+            self.cache._cull()
+        self.assertEqual(_bucket.delete_keys.call_args[0][0], [page[1]])
+
+
+class DiskCacheTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.disk = DiskCache(self.path, 'bucket/', timeout=60)
+        self.expiry = time.time() + 100
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_set_and_get(self):
+        self.disk.set('my-key', '"etag"', self.expiry, None, 0.5, b'value')
+        self.assertEqual(self.disk.get('my-key'),
+                         (b'value', '"etag"', self.expiry, None, 0.5, True))
+        self.assertIsNone(self.disk.get('other-key'))
+
+    def test_shared_between_instances(self):
+        self.disk.set('my-key', '"etag"', self.expiry, None, None, b'value')
+        self.assertEqual(DiskCache(self.path, 'bucket/').get('my-key')[0], b'value')
+        self.assertIsNone(DiskCache(self.path, 'other-bucket/').get('my-key'))
+
+    def test_expired_entry_is_deleted(self):
+        self.disk.set('my-key', '"etag"', time.time() - 1, None, None, b'value')
+        self.assertIsNone(self.disk.get('my-key'))
+        self.assertEqual(list(self.disk._scan()), [])
+
+    def test_revalidation(self):
+        self.disk.timeout = 0
+        self.disk.set('my-key', '"etag"', self.expiry, None, None, b'value')
+        path = self.disk._path('my-key')
+        os.utime(path, (time.time() - 10, time.time() - 10))
+        self.assertFalse(self.disk.get('my-key')[5])
+
+        self.disk.timeout = 5
+        self.disk.revalidated('my-key')
+        self.assertTrue(self.disk.get('my-key')[5])
+
+    def test_corrupt_file_is_deleted(self):
+        self.disk.set('my-key', '"etag"', self.expiry, None, None, b'value')
+        with open(self.disk._path('my-key'), 'wb') as fobj:
+            fobj.write(b'garbage')
+        self.assertIsNone(self.disk.get('my-key'))
+        self.assertFalse(os.path.exists(self.disk._path('my-key')))
+
+    def test_delete_and_clear(self):
+        self.disk.set('a', '"etag"', self.expiry, None, None, b'value')
+        self.disk.set('b', '"etag"', self.expiry, None, None, b'value')
+        self.disk.delete('a')
+        self.disk.delete('missing')
+        self.assertIsNone(self.disk.get('a'))
+        self.disk.clear()
+        self.assertIsNone(self.disk.get('b'))
+
+    def test_least_recently_read_are_evicted(self):
+        self.disk.max_bytes = 1000
+        for i in range(3):
+            self.disk.set('key-%d' % i, '"etag"', self.expiry, None, None, b'x' * 200)
+            os.utime(self.disk._path('key-%d' % i), (time.time() - 100 + i, time.time()))
+        self.disk.get('key-0')
+        self.disk.set('key-3', '"etag"', self.expiry, None, None, b'x' * 300)
+
+        self.assertIsNotNone(self.disk.get('key-0'))
+        self.assertIsNone(self.disk.get('key-1'))
+        self.assertIsNotNone(self.disk.get('key-2'))
+        self.assertIsNotNone(self.disk.get('key-3'))
+
+    def test_too_large_value_is_not_stored(self):
+        self.disk.max_bytes = 100
+        self.disk.set('my-key', '"etag"', self.expiry, None, None, b'x' * 200)
+        self.assertIsNone(self.disk.get('my-key'))
+
+
+class DiskTierTest(S3CacheTestCase):
+    def setUp(self):
+        super(DiskTierTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 0, 'DISK_PATH': self.path}})
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _key(self, value, timeout=+10, etag='"etag"'):
+        key = Mock()
+        key.etag = etag
+        key.metadata = {EXPIRY_METADATA: repr(time.time() + timeout)}
+        key.read.return_value = self.cache._dump_object(value, timeout)
+        return key
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(AmazonS3Cache(None, {})._disk)
+
+    def test_get_is_served_from_disk(self):
+        with patch.object(self.cache._storage, 'open_key',
+                          return_value=self._key('TEST')) as open_mock:
+            self.assertEqual(self.cache.get('my-key'), 'TEST')
+            open_mock.assert_called_with(self.cache._key_to_fname(self.cache.make_key('my-key')),
+                                         etag=None)
+
+        # a new process on the same host
+        cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 0, 'DISK_PATH': self.path}})
+        with patch.object(cache._storage, 'open_key') as open_mock:
+            self.assertEqual(cache.get('my-key'), 'TEST')
+            self.assertTrue(cache.has_key('my-key'))
+            self.assertFalse(open_mock.called)
+
+    def test_unchanged_object_is_not_downloaded(self):
+        with patch.object(self.cache._storage, 'open_key', return_value=self._key('TEST')):
+            self.cache.get('my-key')
+        self.cache._disk.timeout = 0
+        os.utime(self.cache._disk._path(self.cache._key_to_fname(self.cache.make_key('my-key'))),
+                 (time.time() - 10, time.time() - 10))
+        with patch.object(self.cache._storage, 'open_key', return_value=None) as open_mock:
+            self.assertEqual(self.cache.get('my-key'), 'TEST')
+            self.assertEqual(open_mock.call_args[1], {'etag': '"etag"'})
+
+    def test_changed_object_is_downloaded(self):
+        with patch.object(self.cache._storage, 'open_key', return_value=self._key('TEST')):
+            self.cache.get('my-key')
+        self.cache._disk.timeout = -1
+        with patch.object(self.cache._storage, 'open_key',
+                          return_value=self._key('NEW', etag='"new"')):
+            self.assertEqual(self.cache.get('my-key'), 'NEW')
+        self.assertEqual(self.cache._disk.get(
+            self.cache._key_to_fname(self.cache.make_key('my-key')))[1], '"new"')
+
+    def test_deleted_object(self):
+        with patch.object(self.cache._storage, 'open_key', return_value=self._key('TEST')):
+            self.cache.get('my-key')
+        self.cache._disk.timeout = -1
+        with patch.object(self.cache._storage, 'open_key', side_effect=FileNotFoundError):
+            self.assertIsNone(self.cache.get('my-key'))
+        self.assertEqual(list(self.cache._disk._scan()), [])
+
+    def test_write_invalidates_disk_entry(self):
+        with patch.object(self.cache._storage, 'open_key', return_value=self._key('TEST')):
+            self.cache.get('my-key')
+        with patch.object(self.cache._storage, 'save'):
+            self.cache.set('my-key', 'NEW')
+        self.assertEqual(list(self.cache._disk._scan()), [])
+
+    def test_expired_object_is_not_stored(self):
+        with patch.object(self.cache._storage, 'open_key', return_value=self._key('TEST', -1)), \
+             patch.object(AmazonS3Cache, '_delete'):
+            self.assertIsNone(self.cache.get('my-key'))
+        self.assertEqual(list(self.cache._disk._scan()), [])
+
+
+class RetryPolicyTest(S3CacheTestCase):
+    def test_budget(self):
+        budget = RetryBudget(ratio=0.5, min_per_second=0, max_tokens=2)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+    def test_budget_refills_over_time(self):
+        budget = RetryBudget(ratio=0, min_per_second=1000, max_tokens=1)
+        self.assertTrue(budget.withdraw())
+        time.sleep(0.01)
+        self.assertTrue(budget.withdraw())
+
+    def test_should_retry(self):
+        on_retry = Mock()
+        policy = RetryPolicy(attempts=2, on_retry=on_retry)
+        self.assertTrue(policy.should_retry(503, 0))
+        self.assertTrue(policy.should_retry(500, 1))
+        self.assertFalse(policy.should_retry(503, 2))
+        self.assertFalse(policy.should_retry(404, 0))
+        self.assertFalse(policy.should_retry(200, 0))
+        self.assertEqual(on_retry.call_count, 2)
+
+    def test_exhausted_budget(self):
+        policy = RetryPolicy(budget=RetryBudget(ratio=0, min_per_second=0, max_tokens=0))
+        self.assertFalse(policy.should_retry(503, 0))
+
+    def test_backoff_is_jittered_and_bounded(self):
+        policy = RetryPolicy(backoff=0.1)
+        for attempt in range(10):
+            self.assertTrue(0 <= policy.backoff_time(attempt) <= min(2.0, 0.1 * 2 ** attempt))
+
+    def test_cache_shares_budget(self):
+        options = {'BUCKET_NAME': 'bucket', 'ACCESS_KEY': 'access', 'SECRET_KEY': 'secret'}
+        first = AmazonS3Cache(None, {'OPTIONS': options})
+        second = AmazonS3Cache(None, {'OPTIONS': dict(options)})
+        self.assertIs(first._storage.retry_policy.budget, second._storage.retry_policy.budget)
+        self.assertIs(first._storage.connection.retry_policy, first._storage.retry_policy)
+
+
+class RetryHandlerTest(TestCase):
+    def setUp(self):
+        self.policy = RetryPolicy(attempts=1, backoff=0.01)
+        self.connection = S3CacheConnection('access', 'secret', retry_policy=self.policy)
+
+    def _response(self, status):
+        response = Mock(status=status, reason='Reason')
+        response.read.return_value = b'<Error><Code>SlowDown</Code></Error>'
+        return response
+
+    def test_success_is_left_to_boto(self):
+        self.assertIsNone(self.connection._retry_handler(self._response(200), 0, 1))
+        self.assertIsNone(self.connection._retry_handler(self._response(404), 0, 1))
+
+    def test_throttled_request_is_retried(self):
+        msg, attempt, sleep = self.connection._retry_handler(self._response(503), 0, 30)
+        self.assertEqual(attempt, 1)
+        self.assertTrue(0 <= sleep <= 0.01)
+
+    def test_last_attempt_raises(self):
+        with self.assertRaises(S3ResponseError) as context:
+            self.connection._retry_handler(self._response(503), 1, 30)
+        self.assertEqual(context.exception.status, 503)
+
+
+class LatencyWindowTest(TestCase):
+    def test_threshold(self):
+        window = LatencyWindow(percentile=90)
+        for i in range(MIN_SAMPLES - 1):
+            window.record(0.01)
+        self.assertIsNone(window.threshold())
+        for i in range(100):
+            window.record(1.0 if i % 10 == 0 else 0.01)
+        self.assertTrue(0.01 <= window.threshold() <= 1.0)
+
+        for i in range(1000):
+            window.record(0.5)
+        self.assertEqual(window.threshold(), 0.5)
+
+
+class HedgedReadTest(S3CacheTestCase):
+    def setUp(self):
+        super(HedgedReadTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 0, 'HEDGE_PERCENTILE': 95,
+                                                       'HEDGE_MIN_DELAY': 0.01}})
+        self.cache._hedge = LatencyWindow(95)
+        for _i in range(MIN_SAMPLES):
+            self.cache._hedge.record(0.001)
+        self.calls = []
+
+    def _download(self, fname):
+        self.calls.append(fname)
+        if len(self.calls) == 1:
+            time.sleep(0.5)
+            return b'SLOW', True
+        return self.cache._codec.dumps('FAST'), True
+
+    def test_slow_read_is_hedged(self):
+        with patch.object(self.cache, '_download', side_effect=self._download):
+            started = time.time()
+            self.assertEqual(self.cache.get('my-key'), 'FAST')
+            self.assertTrue(time.time() - started < 0.4)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.cache.stats()['hedges'], 1)
+
+    def test_first_value_wins(self):
+        def _download(fname):
+            self.calls.append(fname)
+            attempt = len(self.calls)
+            # the hedge answers first
+            time.sleep(0.3 if attempt == 1 else 0.05)
+            return self.cache._codec.dumps(attempt), True
+
+        with patch.object(self.cache, '_download', side_effect=_download):
+            started = time.time()
+            self.assertEqual(self.cache.get('my-key'), 2)
+            self.assertTrue(time.time() - started < 0.25)
+        self.assertEqual(self.cache.stats()['hedges'], 1)
+
+    def test_failed_answer_waits_for_the_other(self):
+        def _download(fname):
+            self.calls.append(fname)
+            if len(self.calls) == 1:
+                time.sleep(0.2)
+                return self.cache._codec.dumps('SLOW'), True
+            # the hedge fails fast
+            return None
+
+        with patch.object(self.cache, '_download', side_effect=_download):
+            self.assertEqual(self.cache.get('my-key'), 'SLOW')
+
+    def test_reads_are_not_limited_by_hedge_workers(self):
+        self.cache._hedge_workers = 1
+        together = threading.Barrier(4, timeout=5)
+        results = []
+
+        def _download(fname):
+            together.wait()
+            return self.cache._codec.dumps('TEST'), True
+
+        with patch.object(self.cache, '_download', side_effect=_download), \
+             patch.object(self.cache._storage.retry_policy.budget, 'withdraw', return_value=False):
+            threads = [threading.Thread(target=lambda i=i: results.append(self.cache.get('key-%d' % i)))
+                       for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(results, ['TEST'] * 4)
+
+    def test_fast_read_is_not_hedged(self):
+        with patch.object(self.cache, '_download',
+                          return_value=(self.cache._codec.dumps('TEST'), True)) as download_mock:
+            self.assertEqual(self.cache.get('my-key'), 'TEST')
+            self.assertEqual(download_mock.call_count, 1)
+        self.assertEqual(self.cache.stats()['hedges'], 0)
+
+    def test_no_hedge_without_budget(self):
+        self.cache._storage.retry_policy.budget = RetryBudget(0, 0, 0)
+        with patch.object(self.cache, '_download',
+                          side_effect=lambda fname: (time.sleep(0.05), (b'', True))[1]) as download_mock:
+            self.cache.get('my-key')
+            self.assertEqual(download_mock.call_count, 1)
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(AmazonS3Cache(None, {})._hedge)
+
+
+class ConnectionPoolTest(S3CacheTestCase):
+    def setUp(self):
+        super(ConnectionPoolTest, self).setUp()
+        self.options = {'BUCKET_NAME': 'bucket', 'ACCESS_KEY': 'access', 'SECRET_KEY': 'secret',
+                        'MAX_ENTRIES': 0}
+
+    def test_idle_connections_are_limited(self):
+        pool = CacheConnectionPool(max_size=2)
+        connections = [Mock() for _i in range(3)]
+        for connection in connections:
+            pool.put_http_connection('s3.amazonaws.com', 443, True, connection)
+        self.assertEqual(pool.size(), 2)
+        self.assertFalse(connections[1].close.called)
+        self.assertTrue(connections[2].close.called)
+
+    def test_pool_is_shared_by_threads(self):
+        self.options['MAX_POOL_CONNECTIONS'] = 7
+        pools = []
+
+        def _connect():
+            pools.append(AmazonS3Cache(None, {'OPTIONS': dict(self.options)})._storage.connection._pool)
+
+        threads = [threading.Thread(target=_connect) for _i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIs(pools[0], pools[1])
+        self.assertEqual(pools[0].max_size, 7)
+
+    def test_connection_is_created_on_first_use(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': self.options})
+        self.assertIsNone(cache._storage._connection)
+        connection = cache._storage.connection
+        self.assertIs(cache._storage.connection, connection)
+
+    def test_connection_is_created_again_after_fork(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': self.options})
+        connection = cache._storage.connection
+        bucket = cache._storage.bucket
+        with patch('s3cache.storage.os.getpid', return_value=os.getpid() + 1):
+            self.assertIsNot(cache._storage.connection, connection)
+            self.assertIsNot(cache._storage.connection._pool, connection._pool)
+            self.assertIsNot(cache._storage.bucket, bucket)
+
+    def test_after_fork(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': dict(self.options, WRITE_BEHIND=True,
+                                                     COUNTER_FLUSH_INTERVAL=60)})
+        executor = cache._executor
+        cache._counters.seed('name', 1)
+        cache._write_behind._pending['name'] = (SET, None, b'', {})
+        s3cache.retry._after_fork()
+        cache._after_fork()
+        self.assertIsNot(cache._executor, executor)
+        self.assertEqual(cache._counters._counters, {})
+        self.assertEqual(len(cache._write_behind), 0)
+
+    def test_worker_pool_is_shared_by_instances(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': self.options})
+        other = AmazonS3Cache(None, {'OPTIONS': dict(self.options, LOCATION='other')})
+        self.assertIs(other._executor, cache._executor)
+
+    @skipIf(not hasattr(os, 'fork'), 'needs os.fork()')
+    def test_worker_pool_works_in_child(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': dict(self.options, MAX_WORKERS=2)})
+        self.assertEqual(cache._map(abs, [-1, -2, -3]), [1, 2, 3])
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            code = 1
+            try:
+                future = cache._executor.submit(cache._map, abs, [-1, -2])
+                code = 0 if future.result(5) == [1, 2] else 1
+            finally:
+                os._exit(code)
+        _pid, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+
+class HashRingTest(TestCase):
+    def setUp(self):
+        self.digests = [_key_to_file('key-%d' % i) for i in range(3000)]
+
+    def test_keys_are_spread(self):
+        ring = HashRing(['one', 'two', 'three'])
+        counts = [0, 0, 0]
+        for digest in self.digests:
+            counts[ring.lookup(digest)[0]] += 1
+        for count in counts:
+            self.assertTrue(600 < count < 1400, counts)
+
+    def test_replicas_are_different_buckets(self):
+        ring = HashRing(['one', 'two', 'three'])
+        for digest in self.digests[:100]:
+            found = ring.lookup(digest, 2)
+            self.assertEqual(len(set(found)), 2)
+            self.assertEqual(found[0], ring.lookup(digest)[0])
+        self.assertEqual(len(ring.lookup(self.digests[0], 5)), 3)
+
+    def test_removed_bucket_moves_only_its_keys(self):
+        before = HashRing(['one', 'two', 'three'])
+        after = HashRing(['one', 'three'])
+        names = ['one', 'two', 'three']
+        for digest in self.digests:
+            owner = names[before.lookup(digest)[0]]
+            if owner != 'two':
+                self.assertEqual(['one', 'three'][after.lookup(digest)[0]], owner)
+
+
+class MultiBucketTest(S3CacheTestCase):
+    def setUp(self):
+        super(MultiBucketTest, self).setUp()
+        self.options = {'BUCKETS': ['one', 'two', 'three'], 'MAX_ENTRIES': 0,
+                        'ACCESS_KEY': 'access', 'SECRET_KEY': 'secret'}
+
+    def _cache(self, **options):
+        return AmazonS3Cache(None, {'OPTIONS': dict(self.options, **options)})
+
+    def test_single_bucket(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'BUCKET_NAME': 'bucket'}})
+        self.assertEqual(cache._storages, [cache._storage])
+        self.assertEqual(cache._storage.bucket_name, 'bucket')
+        self.assertIsNone(cache._ring)
+        self.assertIsNone(cache._storage.latency)
+
+    def test_buckets(self):
+        cache = self._cache(BUCKETS=['one', {'BUCKET_NAME': 'two', 'host': 'example.com'}])
+        self.assertEqual([storage.bucket_name for storage in cache._storages], ['one', 'two'])
+        self.assertIs(cache._storage, cache._storages[0])
+        self.assertEqual(cache._storages[1].host, 'example.com')
+        self.assertEqual(cache._storages[1].access_key, 'access')
+        self.assertIs(cache._storages[0].retry_policy, cache._storages[1].retry_policy)
+        self.assertIsNotNone(cache._storages[0].latency)
+
+    def test_location_can_not_differ(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self._cache(BUCKETS=['one', {'BUCKET_NAME': 'two', 'LOCATION': 'other'}])
+
+    def test_key_is_stored_in_its_bucket(self):
+        cache = self._cache()
+        fname = cache._key_to_fname(cache.make_key('my-key'))
+        owner = cache._owner_of(fname)
+        saves = []
+        for storage in cache._storages:
+            patch.object(storage, 'save', side_effect=lambda name, content, storage=storage:
+                         saves.append(storage)).start()
+        try:
+            cache.set('my-key', 'value')
+        finally:
+            patch.stopall()
+        self.assertEqual(saves, [owner])
+        self.assertEqual(cache._storages_of(fname), [owner])
+
+    def test_replicas(self):
+        cache = self._cache(REPLICAS=2)
+        fname = cache._key_to_fname(cache.make_key('my-key'))
+        replicas = cache._storages_of(fname)
+        self.assertEqual(len(replicas), 2)
+        saves = []
+        for storage in cache._storages:
+            patch.object(storage, 'save', side_effect=lambda name, content, storage=storage:
+                         saves.append(storage)).start()
+        try:
+            cache.set('my-key', 'value')
+        finally:
+            patch.stopall()
+        self.assertEqual(sorted(saves, key=id), sorted(replicas, key=id))
+
+    def test_failed_replica_is_counted(self):
+        cache = self._cache(REPLICAS=2)
+        fname = cache._key_to_fname(cache.make_key('my-key'))
+        owner, replica = cache._storages_of(fname)
+        with patch.object(owner, 'save'), \
+             patch.object(replica, 'save', side_effect=IOError):
+            cache.set('my-key', 'value')
+        self.assertEqual(cache.stats()['set']['errors'], {'OSError': 1})
+
+    def test_read_from_fastest_replica(self):
+        cache = self._cache(REPLICAS=3)
+        slow, fast, other = cache._storages
+        for storage, latency in ((slow, 0.1), (fast, 0.01), (other, 0.05)):
+            storage.latency = LatencyAverage()
+            storage.latency.record(latency)
+        body = BytesIO(cache._dump_object('value', +10))
+        with patch('s3cache.random.random', return_value=0.5), \
+             patch.object(fast, 'open', return_value=body) as open_mock:
+            self.assertEqual(cache.get('my-key'), 'value')
+        self.assertEqual(open_mock.call_count, 1)
+
+    def test_delete_many_from_every_bucket(self):
+        cache = self._cache(REPLICAS=2)
+        buckets = []
+        for storage in cache._storages:
+            buckets.append(patch.object(storage, '_bucket').start())
+        try:
+            cache.delete_many(['key-%d' % i for i in range(20)])
+        finally:
+            patch.stopall()
+        deleted = []
+        for storage, bucket in zip(cache._storages, buckets):
+            for call in bucket.delete_keys.call_args_list:
+                deleted.extend((storage, name) for name in call[0][0])
+        self.assertEqual(len(deleted), 40)
+        for i in range(20):
+            fname = cache._key_to_fname(cache.make_key('key-%d' % i))
+            for storage in cache._storages_of(fname):
+                self.assertIn((storage, fname), deleted)
+
+    def test_incr_is_copied_to_replicas(self):
+        cache = self._cache(REPLICAS=2)
+        fname = cache._key_to_fname(cache.make_key('counter'))
+        owner, replica = cache._storages_of(fname)
+        key = Mock(metadata={}, etag='"etag"')
+        key.read.return_value = cache._dump_object(1, +10)
+        with patch.object(owner, 'open_key', return_value=key), \
+             patch.object(owner, 'replace', return_value=True) as replace_mock, \
+             patch.object(replica, 'save') as save_mock:
+            self.assertEqual(cache.incr('counter'), 2)
+        self.assertEqual(replace_mock.call_count, 1)
+        self.assertEqual(save_mock.call_count, 1)
+        self.assertEqual(save_mock.call_args[0][0], fname)
+
+    def test_num_entries_counts_every_key_once(self):
+        cache = self._cache(REPLICAS=2)
+        buckets = []
+        for storage in cache._storages:
+            bucket = patch.object(storage, '_bucket').start()
+            bucket.get_all_keys.return_value = [Mock(), Mock()]
+            buckets.append(bucket)
+        try:
+            self.assertEqual(cache._num_entries, 3)
+        finally:
+            patch.stopall()
+
+
+class LatencyAverageTest(TestCase):
+    def test_average(self):
+        latency = LatencyAverage(weight=0.5)
+        self.assertEqual(latency.value(), 0)
+        latency.record(0.2)
+        self.assertEqual(latency.value(), 0.2)
+        latency.record(0.1)
+        self.assertAlmostEqual(latency.value(), 0.15)
+
+    def test_connection_records_latency(self):
+        latency = LatencyAverage(weight=1)
+        connection = S3CacheConnection('access', 'secret', latency=latency)
+        with patch('s3cache.storage.S3Connection._mexe', return_value='response'):
+            self.assertEqual(connection._mexe(Mock()), 'response')
+        self.assertTrue(0 <= latency.value() < FAILURE_LATENCY)
+        with patch('s3cache.storage.S3Connection._mexe', side_effect=IOError):
+            self.assertRaises(IOError, connection._mexe, Mock())
+        self.assertEqual(latency.value(), FAILURE_LATENCY)
+
+
+class RateLimiterTest(TestCase):
+    def test_no_limit(self):
+        with patch('s3cache.retry.time.sleep') as sleep_mock:
+            for _i in range(10):
+                RateLimiter(0).acquire()
+        self.assertFalse(sleep_mock.called)
+
+    def test_requests_are_spaced(self):
+        limiter = RateLimiter(10)
+        with patch('s3cache.retry.time.time', return_value=100.0), \
+             patch('s3cache.retry.time.sleep') as sleep_mock:
+            for _i in range(3):
+                limiter.acquire()
+        self.assertEqual([round(call[0][0], 6) for call in sleep_mock.call_args_list], [0.1, 0.2])
+
+
+class WarmTest(S3CacheTestCase):
+    def setUp(self):
+        super(WarmTest, self).setUp()
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'LOCAL_MAX_ENTRIES': 10, 'MAX_WORKERS': 1,
+                                                      'MAX_ENTRIES': 0}})
+
+    def test_prefetch_fills_local_tier(self):
+        bodies = [BytesIO(self.cache._dump_object('one', +10)), FileNotFoundError]
+        with patch.object(self.cache._storage, 'open', side_effect=bodies), \
+             patch.object(RateLimiter, 'acquire') as acquire_mock:
+            self.assertEqual(self.cache.prefetch(['one', 'two']), 1)
+        self.assertEqual(acquire_mock.call_count, 2)
+
+        with patch.object(self.cache._storage, 'open') as open_mock:
+            self.assertEqual(self.cache.get('one'), 'one')
+            self.assertEqual(self.cache.prefetch(['one']), 1)
+        self.assertFalse(open_mock.called)
+
+    def test_prefetch_rate(self):
+        with patch.object(self.cache._storage, 'open', side_effect=FileNotFoundError), \
+             patch('s3cache.RateLimiter') as limiter_mock:
+            self.cache.prefetch(['one'], rate=5)
+            limiter_mock.assert_called_once_with(5)
+            self.cache.prefetch(['one'])
+            limiter_mock.assert_called_with(1000)
+
+    def test_prefetch_with_streaming(self):
+        cache = AmazonS3Cache(None, {'OPTIONS': {'STREAMING': True}})
+        with patch.object(cache._storage, 'open_key') as open_mock:
+            self.assertEqual(cache.prefetch(['one']), 0)
+        self.assertFalse(open_mock.called)
+
+    def test_warm(self):
+        def _save(fname, content):
+            if fname == _key_to_file(self.cache.make_key('bad')):
+                raise IOError()
+            return fname
+
+        with patch.object(self.cache._storage, 'save', side_effect=_save) as save_mock, \
+             patch.object(RateLimiter, 'acquire') as acquire_mock:
+            failed = self.cache.warm({'good': 1, 'bad': 2, 'other': 3})
+        self.assertEqual(failed, ['bad'])
+        self.assertEqual(save_mock.call_count, 3)
+        self.assertEqual(acquire_mock.call_count, 3)
+
+    def test_set_many_is_not_limited(self):
+        with patch.object(self.cache._storage, 'save'), \
+             patch.object(RateLimiter, 'acquire') as acquire_mock:
+            self.cache.set_many({'one': 1, 'two': 2})
+        self.assertFalse(acquire_mock.called)
+
+
+class WarmCommandTest(S3CacheTestCase):
+    def setUp(self):
+        super(WarmCommandTest, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'keys')
+        self.cache = AmazonS3Cache(None, {'OPTIONS': {'MAX_ENTRIES': 0,
+                                                       'DISK_PATH': os.path.join(self.tmp, 'disk')}})
+        patcher = patch('s3cache.management.commands.s3cache_warm.caches',
+                        {'default': self.cache, 'other': LocalCache(1)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def _write(self, content):
+        with open(self.path, 'w') as output:
+            output.write(content)
+
+    def test_prefetch(self):
+        self._write('one\n\ntwo\n')
+        stdout = io.StringIO()
+        with patch.object(self.cache, 'prefetch', return_value=1) as prefetch_mock:
+            call_command(WarmCommand(), self.path, rate=5, stdout=stdout)
+        prefetch_mock.assert_called_once_with(['one', 'two'], version=None, rate=5)
+        self.assertIn('Found 1 of 2 keys', stdout.getvalue())
+
+    def test_warm(self):
+        self._write('{"one": 1, "two": [2]}')
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        with patch.object(self.cache, 'warm', return_value=['two']) as warm_mock:
+            call_command(WarmCommand(), self.path, values=True, timeout=60, key_version=2,
+                         stdout=stdout, stderr=stderr)
+        warm_mock.assert_called_once_with({'one': 1, 'two': [2]}, timeout=60, version=2, rate=None)
+        self.assertIn('Stored 1 of 2 keys', stdout.getvalue())
+        self.assertIn('two', stderr.getvalue())
+
+    def test_errors(self):
+        self._write('[1, 2]')
+        with self.assertRaises(CommandError):
+            call_command(WarmCommand(), self.path, values=True)
+        with self.assertRaises(CommandError):
+            call_command(WarmCommand(), self.path, cache='other')
+        with self.assertRaises(CommandError):
+            call_command(WarmCommand(), os.path.join(self.tmp, 'missing'))
+
+    def test_prefetch_needs_disk_path(self):
+        self._write('one\n')
+        self.cache._disk = None
+        with patch.object(self.cache, 'prefetch') as prefetch_mock, \
+             self.assertRaises(CommandError):
+            call_command(WarmCommand(), self.path)
+        self.assertFalse(prefetch_mock.called)
+
+
+S3_CACHES = {
+    'default': {
+        'BACKEND': 's3cache.AmazonS3Cache',
+        'OPTIONS': {
+            'BUCKET_NAME': 'threads',
+            'ACCESS_KEY': 'access',
+            'SECRET_KEY': 'secret',
+            'MAX_ENTRIES': 0,
+        },
+    },
+}
+
+
+def _caches_with(**options):
+    """
+        Returns S3_CACHES with options added to those of the default cache
+    """
+    return {'default': dict(S3_CACHES['default'],
+                            OPTIONS=dict(S3_CACHES['default']['OPTIONS'], **options))}
+
+
+def _in_threads(func, count=8):
+    """
+        Calls func() from count threads at once, each of which gets its
+        own cache instance from django.core.cache.caches, and returns
+        the results
+    """
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def _run(index):
+        cache = caches['default']
+        barrier.wait()
+        results[index] = func(cache)
+
+    threads = [threading.Thread(target=_run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+@override_settings(CACHES=S3_CACHES)
+class DjangoCachesTest(TestCase):
+    """
+        Django creates a cache instance for every thread
+    """
+    def test_instance_per_thread(self):
+        instances = _in_threads(lambda cache: cache, 2)
+        self.assertIsNot(instances[0], instances[1])
+
+    def test_get_or_set_computes_once(self):
+        calls = []
+
+        def _compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'value'
+
+        def _fetch(_self, _fname):
+            time.sleep(0.05)
+
+        with patch.object(AmazonS3Cache, '_fetch', _fetch), \
+             patch.object(AmazonS3Cache, '_set'):
+            results = _in_threads(lambda cache: cache.get_or_set('hot', _compute))
+        self.assertEqual(results, ['value'] * 8)
+        self.assertEqual(len(calls), 1)
+
+    @override_settings(CACHES=_caches_with(BUCKET_NAME='stats'))
+    def test_stats_of_all_threads(self):
+        caches['default'].reset_stats()
+        with patch.object(S3CacheStorage, 'open', side_effect=FileNotFoundError):
+            _in_threads(lambda cache: cache.get('missing'))
+        stats = caches['default'].stats()
+        self.assertEqual(stats['misses'], 8)
+        self.assertEqual(stats['get']['calls'], 8)
+
+    @override_settings(CACHES=_caches_with(BUCKET_NAME='local', LOCAL_MAX_ENTRIES=10))
+    def test_prefetch_warms_all_threads(self):
+        body = caches['default']._dump_object('TEST', +10)
+        with patch.object(S3CacheStorage, 'open', return_value=BytesIO(body)):
+            _in_threads(lambda cache: cache.prefetch(['warm']), 1)
+        with patch.object(S3CacheStorage, 'open') as open_mock:
+            self.assertEqual(_in_threads(lambda cache: cache.get('warm')), ['TEST'] * 8)
+            self.assertFalse(open_mock.called)
+
+    @override_settings(CACHES=_caches_with(BUCKET_NAME='packed', PACKED=True,
+                                           PACK_FLUSH_INTERVAL=60))
+    def test_packed_values_are_seen_by_all_threads(self):
+        with patch.object(AmazonS3Cache, '_iter_dir_keys', side_effect=lambda directory: iter([])) \
+                as list_mock, \
+             patch.object(SegmentStore, '_write') as write_mock:
+            _in_threads(lambda cache: cache.set('packed', 'TEST'), 1)
+            results = _in_threads(lambda cache: (cache._packer, cache.get('packed')))
+            self.assertEqual(len(set(packer for (packer, _value) in results)), 1)
+            self.assertEqual([value for (_packer, value) in results], ['TEST'] * 8)
+            # the indexes are listed once for the process
+            self.assertEqual(list_mock.call_count, 1)
+            self.assertTrue(results[0][0].flush(5))
+            self.assertEqual(write_mock.call_count, 1)
+
+    @override_settings(CACHES=_caches_with(BUCKET_NAME='write-behind', WRITE_BEHIND=True))
+    def test_write_behind_queue_per_process(self):
+        uploaded = threading.Event()
+
+        def _save(_self, _fname, _body, _metadata):
+            uploaded.wait(5)
+
+        with patch.object(AmazonS3Cache, '_save', _save):
+            _in_threads(lambda cache: cache.set('w', 'new'), 1)
+            results = _in_threads(lambda cache: (cache._write_behind, cache.get('w')))
+            queues = set(queue for (queue, _value) in results)
+            self.assertEqual(len(queues), 1)
+            self.assertEqual([value for (_queue, value) in results], ['new'] * 8)
+
+            _in_threads(lambda cache: cache.set('w%d' % threading.get_ident(), 'x'))
+            queue = queues.pop()
+            self.assertLessEqual(len(queue._threads), queue.workers)
+            uploaded.set()
+            self.assertTrue(queue.flush(5))